@@ -0,0 +1,50 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Gunicorn configuration
+
+Set GUNICORN_PRELOAD=true to create the app once in the master and fork
+it into the workers. The database session is then opened lazily so that
+no worker inherits a socket from the master.
+"""
+import os
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "False").lower() == "true"  # pylint: disable=invalid-name
+
+if preload_app:
+    # must be set before the app reads its configuration
+    os.environ["DB_LAZY_CONNECT"] = "true"
+
+
+def post_fork(server, worker):
+    """
+    Opens the database session in each worker before it takes requests, and
+    starts the worker's write behind thread so that it replays the journals
+    of workers that died
+    """
+    if not preload_app:
+        return
+    from service.models import Pet  # pylint: disable=import-outside-toplevel
+
+    try:
+        Pet.ensure_connected()
+    except Exception as error:  # pylint: disable=broad-except
+        # the first request will try again
+        server.log.warning("Worker %s could not connect yet: %s", worker.pid, error)
+    writer = worker.app.wsgi().extensions.get("write_behind")
+    if writer:
+        writer.start()
@@ -21,8 +21,12 @@ This module contains the microservice code for
     models
 """
 import sys
+import time
 from flask import Flask
-from service.common import log_handlers
+from service.common import log_handlers, compression, admission
+from service.common.write_behind import WriteBehind
+from service.common.result_cache import ResultCache
+from service.common.rate_limit import key_limiter
 from service import config
 
 # NOTE: Do not change the order of this code
@@ -43,31 +47,97 @@ def create_app():
     # Turn off strict slashes because it violates best practices
     app.url_map.strict_slashes = False
 
+    timings = {}
+    started = time.perf_counter()
+
+    def lap(phase: str):
+        nonlocal started
+        now = time.perf_counter()
+        timings[phase] = round((now - started) * 1000, 1)
+        started = now
+
     with app.app_context():
         # Import the routes After the Flask app is created
         # pylint: disable=import-outside-toplevel
         from service import routes, models  # noqa: F401, E402
         from service.common import error_handlers  # pylint: disable=unused-import
 
+        lap("imports")
+
+        lazy = app.config["DB_LAZY_CONNECT"]
         try:
-            models.Pet.init_db(app.config["CLOUDANT_DBNAME"])
+            models.Pet.init_db(app.config["CLOUDANT_DBNAME"], connect=not lazy)
         except Exception as error:  # pylint: disable=broad-except
             app.logger.critical("%s: Cannot continue", error)
             # gunicorn requires exit code 4 to stop spawning workers when they die
             sys.exit(4)
+        if lazy:
+            # each worker opens its own session when it is first needed
+            app.before_request(routes.connect_database)
+        # a preloaded master leaves starting it to gunicorn's post_fork in each worker
+        init_write_behind(app, models.Pet.apply_changes, start=not lazy)
+        if app.config["LIST_CACHE_SIZE"]:
+            app.extensions["list_cache"] = ResultCache(app.config["LIST_CACHE_SIZE"])
+
+        lap("database")
+
+        # Turn requests away when too many of their class are in progress
+        admission.init_admission(app, routes.admission_class)
 
         # Set up logging for production
         log_handlers.init_logging(app, "gunicorn.error")
 
+        lap("logging")
+
+        # Compress large responses and the static files
+        compression.init_compression(app)
+
+        lap("compression")
+
+        # Build the OpenAPI spec now instead of on the first request for it
+        routes.cache_spec()
+
+        lap("spec")
+
         app.logger.info(70 * "*")
         app.logger.info("  P E T   S E R V I C E   R U N N I N G  ".center(70, "*"))
         app.logger.info(70 * "*")
 
+        # Give each API key its own quota
+        try:
+            app.extensions["api_keys"] = routes.parse_api_keys(
+                app.config["API_KEYS"], app.config["API_KEY_RATE"], app.config["API_KEY_BURST"]
+            )
+        except ValueError as error:
+            app.logger.critical("%s: Cannot continue", error)
+            sys.exit(4)
+        app.extensions["key_limiter"] = key_limiter(app.config["RATE_LIMIT_REDIS_URL"])
+
         # If an API Key was not provided, autogenerate one
         if not app.config["API_KEY"]:
             app.config["API_KEY"] = routes.generate_apikey()
             app.logger.info("Missing API Key! Autogenerated: %s", app.config["API_KEY"])
 
-        app.logger.info("Service initialized!")
+        app.config["STARTUP_TIMINGS"] = timings
+        app.logger.info(
+            "Service initialized in %.1f ms (%s)",
+            sum(timings.values()),
+            ", ".join(f"{phase}={ms} ms" for phase, ms in timings.items()),
+        )
 
         return app
+
+
+def init_write_behind(app: Flask, flush, start: bool):
+    """Sets up writing changes in the background when WRITE_BEHIND is on"""
+    if not app.config["WRITE_BEHIND"]:
+        return
+    writer = WriteBehind(
+        flush,
+        app.config["WRITE_BEHIND_JOURNAL"],
+        app.config["WRITE_BEHIND_QUEUE_SIZE"],
+        app.config["WRITE_BEHIND_BATCH_SIZE"],
+    )
+    app.extensions["write_behind"] = writer
+    if start:
+        writer.start()
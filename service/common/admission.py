@@ -0,0 +1,161 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Admission
+
+Limits how many requests of each class are handled at once and turns
+the rest away with 503 before they do any work, instead of letting them
+pile up on the database. Each class has its own limit, so a flood of
+expensive listings can't take the place of cheap lookups.
+
+The limits adapt to how long requests take: a request slower than its
+class's target shrinks the limit by a fraction, and each one that is
+on time lets it grow back a little, up to the configured limit.
+"""
+import time
+import threading
+from flask import g, jsonify
+from service.common import status
+
+# how much a slow request shrinks the limit by
+DECREASE_FACTOR = 0.9
+
+
+class AdaptiveLimit:  # pylint: disable=too-many-instance-attributes
+    """
+    A concurrency limit that shrinks when requests are slow and grows back when they are not
+
+    :param limit: the most requests that may be in flight at once
+    :param target: seconds a request should take, 0 to keep the limit fixed
+    :param min_limit: the limit never shrinks below this
+    """
+
+    def __init__(self, limit: int, target: float = 0.0, min_limit: int = 1):
+        self.max_limit = limit
+        self.min_limit = min(min_limit, limit)
+        self.target = target
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = 0
+        self._decreased = 0.0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        """Takes a slot if one is free and returns True, or returns False straight away"""
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def release(self, latency: float):
+        """Gives back a slot and adapts the limit to how long the request took"""
+        with self._lock:
+            self.in_flight -= 1
+            if not self.target:
+                return
+            now = time.monotonic()
+            if latency > self.target:
+                # the requests that were in flight together were all slow for the
+                # same reason, so only shrink once for each of them
+                if now - self._decreased > self.target:
+                    self.limit = max(self.min_limit, self.limit * DECREASE_FACTOR)
+                    self._decreased = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def stats(self) -> dict:
+        """Returns the limit and how many requests were let in or turned away"""
+        with self._lock:
+            return {
+                "limit": int(self.limit),
+                "max_limit": self.max_limit,
+                "in_flight": self.in_flight,
+                "admitted": self.admitted,
+                "shed": self.shed,
+            }
+
+
+class AdmissionControl:
+    """
+    Keeps an adaptive limit for each class of request
+
+    :param limits: the (limit, target latency) of each class, where a
+        limit of 0 means unlimited
+    :param classify: called during a request, returns its class or None
+        for requests that are always let in
+    """
+
+    def __init__(self, limits: dict, classify):
+        self.limits = {kind: AdaptiveLimit(limit, target) for kind, (limit, target) in limits.items() if limit > 0}
+        self.classify = classify
+
+    def admit(self) -> bool:
+        """Returns True if the current request may go ahead, and remembers it was let in"""
+        limit = self.limits.get(self.classify())
+        if limit is None:
+            return True
+        if not limit.try_acquire():
+            return False
+        g.admission = (limit, time.monotonic())
+        return True
+
+    def release(self):
+        """Gives back the current request's slot, if it took one"""
+        admission = g.pop("admission", None)
+        if admission:
+            limit, started = admission
+            limit.release(time.monotonic() - started)
+
+    def stats(self) -> dict:
+        """Returns the stats of each class"""
+        return {kind: limit.stats() for kind, limit in self.limits.items()}
+
+
+def init_admission(app, classify):
+    """Registers admission control as the first thing done for each request"""
+    config = app.config
+    control = AdmissionControl(
+        {
+            "lookup": (config["CONCURRENCY_LOOKUPS"], config["LATENCY_TARGET_LOOKUPS"]),
+            "query": (config["CONCURRENCY_QUERIES"], config["LATENCY_TARGET_QUERIES"]),
+            "scan": (config["CONCURRENCY_SCANS"], config["LATENCY_TARGET_SCANS"]),
+            "write": (config["CONCURRENCY_WRITES"], config["LATENCY_TARGET_WRITES"]),
+        },
+        classify,
+    )
+    app.extensions["admission"] = control
+
+    def admit():
+        if control.admit():
+            return None
+        response = jsonify(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            error="Service Unavailable",
+            message="The service is too busy to take this request, please try again later.",
+        )
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        response.headers["Retry-After"] = str(config["ADMISSION_RETRY_AFTER"])
+        return response
+
+    # turn requests away before anything else is done for them
+    app.before_request_funcs.setdefault(None, []).insert(0, admit)
+    app.teardown_request(lambda _error: control.release())
+    return control
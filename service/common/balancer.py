@@ -0,0 +1,257 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Balancer
+
+A transport adapter that spreads requests over the nodes of a CouchDB
+cluster. Each request goes to the healthy node with the fewest requests
+in flight. A node that can't be reached or answers 502, 503 or 504 is
+left out for a while, then given one request to show it has recovered.
+Reads that are slow to answer are sent to a second node as well, and
+whichever answers first is used.
+
+Requests made with a deadline are given no longer than the time that is
+left, and a node that is only too slow for the deadline is not blamed.
+"""
+import os
+import time
+import threading
+import contextvars
+from urllib.parse import urlsplit, urlunsplit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.exceptions import ConnectionError, ConnectTimeout, Timeout  # pylint: disable=redefined-builtin
+from urllib3.exceptions import NewConnectionError
+from cloudant.adapters import Replay429Adapter
+from service.common import deadline
+
+# answers that say the node, rather than the request, is in trouble
+UNHEALTHY_STATUSES = (502, 503, 504)
+
+# POST requests that only read and are safe to send twice
+READ_ONLY_POSTS = ("/_find", "/_all_docs", "/_explain")
+
+
+class Node:  # pylint: disable=too-few-public-methods
+    """A CouchDB node and how it has been doing"""
+
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        # credentials are sent by the session, not in the url
+        self.netloc = f"{parts.hostname}:{parts.port}" if parts.port else parts.hostname
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.down_until = 0.0
+
+    @property
+    def url(self) -> str:
+        """The base url of the node"""
+        return f"{self.scheme}://{self.netloc}"
+
+    def stats(self) -> dict:
+        """Returns how many requests the node has had and whether it is up"""
+        return {
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "healthy": self.down_until <= time.monotonic(),
+        }
+
+
+class BalancingAdapter(Replay429Adapter):  # pylint: disable=too-many-instance-attributes
+    """
+    Sends each request to one of several nodes, hedging slow reads
+
+    :param urls: the base url of each node
+    :param hedge_delay: seconds to wait on a read before sending it to a
+        second node as well, 0 to never do so
+    :param cooldown: seconds that a node is left out after it fails
+    """
+
+    def __init__(self, urls: list, hedge_delay: float = 0.0, cooldown: float = 5.0, **kwargs):
+        super().__init__(**kwargs)
+        self.nodes = [Node(url) for url in urls]
+        self.hedge_delay = hedge_delay
+        self.cooldown = cooldown
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+        self._turn = 0
+        self._executor = None
+        self._pid = None
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        """Sends a prepared request to the best node, falling back to the others"""
+        try:
+            return self._failover(request, kwargs)
+        except (ConnectionError, Timeout) as error:
+            # urllib3 reports a read timeout as a connection error after its retries
+            if deadline.expired():
+                raise deadline.DeadlineExceeded(f"No answer from the database in time: {error}") from error
+            raise
+
+    def close(self):
+        """Closes the connections and the hedging threads"""
+        if self._executor and self._pid == os.getpid():
+            self._executor.shutdown(wait=False)
+        self._executor = None
+        super().close()
+
+    def healthy(self) -> bool:
+        """Returns True unless every node is left out for failing"""
+        now = time.monotonic()
+        with self._lock:
+            return any(node.down_until <= now for node in self.nodes)
+
+    def stats(self) -> dict:
+        """Returns the stats of each node and how often reads were hedged"""
+        with self._lock:
+            return {
+                "nodes": {node.url: node.stats() for node in self.nodes},
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+            }
+
+    ######################################################################
+    # Internals
+    ######################################################################
+    def _failover(self, request, kwargs: dict):
+        """Tries the nodes in turn until one of them answers"""
+        idempotent = is_idempotent(request)
+        tried = []
+        while True:
+            deadline.check()
+            # each try gets only the time that is left
+            options = dict(kwargs, timeout=deadline.bounded(kwargs.get("timeout")))
+            node = self._pick(tried)
+            tried.append(node)
+            try:
+                if idempotent and self.hedge_delay > 0 and len(self.nodes) > 1:
+                    response, node = self._send_hedged(request, node, tried, options)
+                else:
+                    response = self._send_to(request, node, options)
+            except ConnectionError as error:
+                if len(tried) >= len(self.nodes) or not (idempotent or was_not_sent(error)):
+                    raise
+                continue
+            if response.status_code in UNHEALTHY_STATUSES and idempotent and len(tried) < len(self.nodes):
+                response.close()
+                continue
+            return response
+
+    def _pick(self, exclude: list) -> Node:
+        """Returns the healthy node with the fewest requests in flight"""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [node for node in self.nodes if node not in exclude] or self.nodes
+            healthy = [node for node in candidates if node.down_until <= now]
+            if not healthy:
+                # try the one that has been down the longest
+                return min(candidates, key=lambda node: node.down_until)
+            self._turn += 1
+            order = {id(node): (index - self._turn) % len(self.nodes) for index, node in enumerate(self.nodes)}
+            best = min(healthy, key=lambda node: (node.in_flight, order[id(node)]))
+            if best.down_until:
+                # give a recovering node one request before trusting it again
+                best.down_until = now + self.cooldown
+            return best
+
+    def _send_to(self, request, node: Node, kwargs: dict):
+        """Sends a request to one node and records how it went"""
+        prepared = request.copy()
+        prepared.url = urlunsplit(urlsplit(request.url)._replace(scheme=node.scheme, netloc=node.netloc))
+        with self._lock:
+            node.in_flight += 1
+            node.requests += 1
+        try:
+            response = super().send(prepared, **kwargs)
+        except Exception:
+            # a timeout says as much about the node as a refused connection,
+            # unless it was only cut short by the deadline
+            self._mark(node, None if deadline.expired() else False)
+            raise
+        self._mark(node, response.status_code not in UNHEALTHY_STATUSES)
+        return response
+
+    def _mark(self, node: Node, healthy: bool):
+        """Records the end of a request, where None says nothing about the node"""
+        with self._lock:
+            node.in_flight -= 1
+            if healthy:
+                node.down_until = 0.0
+            elif healthy is not None:
+                node.failures += 1
+                node.down_until = time.monotonic() + self.cooldown
+
+    def _send_hedged(self, request, node: Node, tried: list, kwargs: dict) -> tuple:
+        """Sends a read to a second node too if the first is slow, and returns the first answer"""
+        executor = self._get_executor()
+        # the threads need a copy of the caller's context to see its deadline
+        futures = {executor.submit(contextvars.copy_context().run, self._send_to, request, node, kwargs): node}
+        done, _ = wait(futures, timeout=self.hedge_delay)
+        if not done:
+            second = self._pick(tried)
+            if second not in tried:
+                tried.append(second)
+                futures[executor.submit(contextvars.copy_context().run, self._send_to, request, second, kwargs)] = second
+                with self._lock:
+                    self.hedges += 1
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception():
+                    error = future.exception()
+                    continue
+                for other in pending:
+                    # nobody is waiting for the slower answer
+                    other.add_done_callback(close_response)
+                if futures[future] is not node:
+                    with self._lock:
+                        self.hedge_wins += 1
+                return future.result(), futures[future]
+        raise error
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Returns the threads for hedged reads, starting them again after a fork"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(max(2, self._pool_maxsize), thread_name_prefix="hedge")
+        return self._executor
+
+
+def is_idempotent(request) -> bool:
+    """Returns True if sending the request twice does no harm"""
+    if request.method in ("GET", "HEAD"):
+        return True
+    return request.method == "POST" and urlsplit(request.url).path.endswith(READ_ONLY_POSTS)
+
+
+def was_not_sent(error: ConnectionError) -> bool:
+    """Returns True if the request failed before it reached the node"""
+    if isinstance(error, ConnectTimeout):
+        return True
+    reason = getattr(error.args[0] if error.args else None, "reason", None)
+    return isinstance(reason, NewConnectionError)
+
+
+def close_response(future):
+    """Closes the response of a request that lost the race"""
+    if not future.exception():
+        future.result().close()
@@ -0,0 +1,139 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+# spell: ignore brotli
+"""
+Compression
+
+Compresses responses that are large enough to be worth it, and serves
+static files from copies that were compressed once at startup.
+Brotli is used when the optional brotli package is installed.
+"""
+import os
+import gzip
+import hashlib
+import mimetypes
+from flask import request, current_app
+from service.common import status
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    "application/json",
+    "application/javascript",
+    "image/svg+xml",
+    "text/css",
+    "text/html",
+    "text/plain",
+)
+
+
+def get_encoders(level: int) -> dict:
+    """Returns the available encoders, best first"""
+    encoders = {}
+    if brotli:
+        encoders["br"] = lambda data: brotli.compress(data, quality=min(level, 11))
+    encoders["gzip"] = lambda data: gzip.compress(data, compresslevel=level, mtime=0)
+    return encoders
+
+
+def init_compression(app):
+    """Compresses the static files and registers the response compressor"""
+    level = app.config.get("COMPRESS_LEVEL", 6)
+    app.extensions["static_assets"] = build_static_assets(app.static_folder, get_encoders(level))
+    app.after_request(compress_response)
+
+
+######################################################################
+# Dynamic responses
+######################################################################
+def compress_response(response):
+    """Compresses a response when the client accepts it and it is big enough"""
+    if response.mimetype not in COMPRESSIBLE_TYPES:
+        return response
+    response.vary.add("Accept-Encoding")
+    if (
+        response.status_code != status.HTTP_200_OK
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+        or response.content_length is None
+        or response.content_length < current_app.config.get("COMPRESS_MIN_SIZE", 1024)
+    ):
+        return response
+
+    encoders = get_encoders(current_app.config.get("COMPRESS_LEVEL", 6))
+    encoding = request.accept_encodings.best_match(list(encoders))
+    if not encoding:
+        return response
+    response.set_data(encoders[encoding](response.get_data()))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+######################################################################
+# Static files
+######################################################################
+class StaticAsset:  # pylint: disable=too-few-public-methods
+    """A file held in memory along with its compressed copies"""
+
+    def __init__(self, data: bytes, mimetype: str, encoders: dict):
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(data).hexdigest()[:32]
+        self.variants = {}
+        for encoding, encode in encoders.items():
+            compressed = encode(data)
+            if len(compressed) < len(data):
+                self.variants[encoding] = compressed
+        self.variants["identity"] = data
+
+
+def build_static_assets(folder: str, encoders: dict) -> dict:
+    """Reads and compresses every compressible file in the static folder"""
+    assets = {}
+    for root, _, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            mimetype = mimetypes.guess_type(name)[0]
+            if mimetype not in COMPRESSIBLE_TYPES:
+                continue
+            with open(path, "rb") as file:
+                filename = os.path.relpath(path, folder).replace(os.sep, "/")
+                assets[filename] = StaticAsset(file.read(), mimetype, encoders)
+    return assets
+
+
+def send_static_asset(filename: str):
+    """Sends a precompressed static file, falling back to Flask for the rest"""
+    asset = current_app.extensions.get("static_assets", {}).get(filename)
+    if asset is None:
+        return current_app.send_static_file(filename)
+    return send_asset(asset, current_app.get_send_file_max_age(filename))
+
+
+def send_asset(asset: StaticAsset, max_age: int):
+    """Sends the best variant of an asset the client accepts with cache headers"""
+    encoding = request.accept_encodings.best_match(list(asset.variants)) or "identity"
+    response = current_app.response_class(asset.variants[encoding], mimetype=asset.mimetype)
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    response.set_etag(f"{asset.etag}-{encoding}")
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
@@ -0,0 +1,114 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Deadline
+
+Carries the time by which the current request must be answered down to
+the database calls it makes, so that none of them, nor the waits between
+their retries, run on after the caller has stopped waiting.
+
+The deadline lives in a context variable. Threads that work on behalf of
+a request must be started with a copy of its context to see it.
+"""
+import time
+import functools
+from contextvars import ContextVar
+
+_deadline = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Custom Exception when a request runs out of time"""
+
+
+def start(seconds: float):
+    """Gives the current context `seconds` to finish its work"""
+    _deadline.set(time.monotonic() + seconds)
+
+
+def clear():
+    """Removes the deadline from the current context"""
+    _deadline.set(None)
+
+
+def remaining() -> float:
+    """Returns the seconds left before the deadline, or None when there isn't one"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def expired() -> bool:
+    """Returns True if there is a deadline and it has passed"""
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def check():
+    """Raises DeadlineExceeded if the deadline has passed"""
+    if expired():
+        raise DeadlineExceeded("The request took longer than its deadline")
+
+
+def bounded(timeout):
+    """Returns a requests timeout that ends no later than the deadline"""
+    left = remaining()
+    if left is None:
+        return timeout
+    if isinstance(timeout, tuple):
+        return tuple(left if part is None else min(part, left) for part in timeout)
+    return left if timeout is None else min(timeout, left)
+
+
+# pylint: disable-next=too-many-arguments,too-many-positional-arguments
+def retry(exceptions, tries: int = -1, delay: float = 0, backoff: float = 1, logger=None, giveup=None):
+    """
+    Decorator that calls a function again when it raises one of `exceptions`
+
+    Works like the retry package's decorator, except that it gives up with
+    DeadlineExceeded rather than wait past the deadline for another try.
+
+    :param exceptions: an exception or a tuple of exceptions to retry on
+    :param tries: the most times to call the function, -1 for no limit
+    :param delay: seconds to wait before the first retry
+    :param backoff: how much longer each wait is than the one before
+    :param logger: where to log the failed tries, None to not log them
+    :param giveup: called with each error, returns True for errors that
+        another try would only repeat, which are raised straight away
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def decorated(*args, **kwargs):
+            tries_left, wait = tries, delay
+            while True:
+                try:
+                    return func(*args, **kwargs)
+                except exceptions as error:
+                    tries_left -= 1
+                    if not tries_left or (giveup and giveup(error)):
+                        raise
+                    left = remaining()
+                    if left is not None and left <= wait:
+                        raise DeadlineExceeded(f"No time left to retry {func.__name__}: {error}") from error
+                    if logger:
+                        logger.warning("%s in %s, retrying in %s seconds...", error, func.__qualname__, wait)
+                    time.sleep(wait)
+                    wait *= backoff
+
+        return decorated
+
+    return decorator
@@ -20,9 +20,11 @@ Error handlers
 Handles all of the HTTP Error Codes returning JSON messages
 """
 
+from flask import jsonify
 from flask import current_app as app  # Import Flask application
 from service.routes import api
 from service.models import DataValidationError, DatabaseConnectionError
+from service.common.deadline import DeadlineExceeded
 from . import status
 
 
@@ -51,3 +53,22 @@ def database_connection_error(error):
         "error": "Service Unavailable",
         "message": message,
     }, status.HTTP_503_SERVICE_UNAVAILABLE
+
+
+@app.errorhandler(DatabaseConnectionError)
+def connect_on_request_error(error):
+    """Handles Database Errors from the lazy connection, which is made before the API sees the request"""
+    body, code = database_connection_error(error)
+    return jsonify(body), code
+
+
+@api.errorhandler(DeadlineExceeded)
+def deadline_exceeded(error):
+    """Handles requests that ran out of time waiting on the database"""
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        "status_code": status.HTTP_504_GATEWAY_TIMEOUT,
+        "error": "Gateway Timeout",
+        "message": message,
+    }, status.HTTP_504_GATEWAY_TIMEOUT
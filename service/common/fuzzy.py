@@ -0,0 +1,70 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+# spell: ignore Levenshtein
+"""
+Fuzzy Matching
+
+Ranks names against a search term so that exact matches come first,
+then names that start with the term, then names that are a typo or two
+away from it
+"""
+
+
+def edit_distance(first: str, second: str) -> int:
+    """Returns the Levenshtein distance between two strings"""
+    if len(first) < len(second):
+        first, second = second, first
+    previous = list(range(len(second) + 1))
+    for i, char in enumerate(first, 1):
+        current = [i]
+        for j, other in enumerate(second, 1):
+            current.append(
+                min(
+                    previous[j] + 1,  # deletion
+                    current[j - 1] + 1,  # insertion
+                    previous[j - 1] + (char != other),  # substitution
+                )
+            )
+        previous = current
+    return previous[-1]
+
+
+def max_typos(term: str) -> int:
+    """Returns how many typos are forgiven in a term of this length"""
+    if len(term) < 3:
+        return 0
+    return 1 if len(term) < 6 else 2
+
+
+def match_rank(term: str, name: str):
+    """
+    Returns how well a name matches a search term, lower is better
+
+    0 is an exact match, 1 is a prefix match and 1 + N is a match with N
+    typos. None means the name doesn't match at all. Both strings are
+    expected to be lower case already.
+    """
+    if name == term:
+        return 0
+    if name.startswith(term):
+        return 1
+    allowed = max_typos(term)
+    if not allowed:
+        return None
+    # compare against the whole name and against a prefix of the same length
+    distance = min(edit_distance(term, name), edit_distance(term, name[: len(term)]))
+    return 1 + distance if distance <= allowed else None
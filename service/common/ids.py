@@ -0,0 +1,52 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+# spell: ignore ULID ULIDs Crockford
+"""
+Document Ids
+
+Generates ULIDs: 26 character ids that sort in the order they were made.
+The first 10 characters are the time in milliseconds and the last 16 are
+random, so new documents land next to each other in the database B-tree
+and ranges of _all_docs can be read by time.
+"""
+import os
+import time
+import threading
+
+# Crockford's base 32 leaves out I, L, O and U
+ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+_lock = threading.Lock()
+_last = [0, 0]  # the time and random part of the last id
+
+
+def ulid() -> str:
+    """Returns a new ULID that sorts after every id made before it"""
+    now = time.time_ns() // 1_000_000
+    with _lock:
+        if now <= _last[0]:
+            # same millisecond (or the clock went back): count up from the last id
+            now, randomness = _last[0], _last[1] + 1
+        else:
+            randomness = int.from_bytes(os.urandom(10), "big")
+        _last[:] = [now, randomness]
+    value = (now << 80) | (randomness & ((1 << 80) - 1))
+    chars = []
+    for _ in range(26):
+        value, index = divmod(value, 32)
+        chars.append(ALPHABET[index])
+    return "".join(reversed(chars))
@@ -20,19 +20,127 @@ Log Handlers
 This module contains utility functions to set up logging
 consistently
 """
+import os
+import time
+import queue
+import atexit
 import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# the handler that queues records and the listener that writes them to the real handlers
+_queue_handler: QueueHandler = None  # pylint: disable=invalid-name
+_listener: QueueListener = None  # pylint: disable=invalid-name
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Queues log records without formatting them
+
+    Formatting and I/O happen on the listener thread instead of the
+    request thread. When the queue is full records are dropped and
+    counted rather than blocking the caller.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """Leaves the message and its arguments for the listener to format"""
+        return record
+
+    def enqueue(self, record):
+        """Puts the record on the queue without ever waiting"""
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SamplingFilter(logging.Filter):  # pylint: disable=too-few-public-methods
+    """
+    Lets through one in every `rate` records for each message
+
+    Records at WARNING and above are never sampled. The counts start over
+    every `window` seconds, or sooner once `max_messages` messages are
+    being counted, so messages that stop being logged are forgotten.
+    """
+
+    def __init__(self, rate: int = 1, window: float = 60.0, max_messages: int = 1000):
+        super().__init__()
+        self.rate = max(1, rate)
+        self.window = window
+        self.max_messages = max_messages
+        self.counts = {}
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.rate == 1 or record.levelno >= logging.WARNING:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if now - self._started >= self.window or (
+                record.msg not in self.counts and len(self.counts) >= self.max_messages
+            ):
+                self.counts.clear()
+                self._started = now
+            count = self.counts.get(record.msg, 0)
+            self.counts[record.msg] = count + 1
+        return count % self.rate == 0
+
+
+def _restart_listener():
+    """
+    Starts the listener again in a forked worker, on a queue of its own
+
+    Only the thread that forked lives on in the child, so the listener is
+    gone and may have held the inherited queue's lock when it went, which
+    would block the first record logged. The records left on that queue
+    are written by the parent.
+    """
+    if _listener:
+        log_queue = queue.Queue(_listener.queue.maxsize)
+        _queue_handler.queue = log_queue
+        _listener.queue = log_queue
+        _listener._thread = None  # pylint: disable=protected-access
+        _listener.start()
+
+
+def _stop_listener():
+    """Flushes any queued records on the way out"""
+    if _listener and _listener._thread:
+        _listener.stop()
+
+
+os.register_at_fork(after_in_child=_restart_listener)
+atexit.register(_stop_listener)
 
 
 def init_logging(app, logger_name: str):
     """Set up logging for production"""
+    global _listener, _queue_handler
     app.logger.propagate = False
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
+    handlers = list(gunicorn_logger.handlers)
     app.logger.setLevel(gunicorn_logger.level)
     # Make all log formats consistent
     formatter = logging.Formatter(
         "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
     )
-    for handler in app.logger.handlers:
+    for handler in handlers:
         handler.setFormatter(formatter)
+
+    _stop_listener()
+    _listener = _queue_handler = None
+    app.logger.handlers = []
+    if handlers:
+        # Send records through a queue so the request thread never does the I/O
+        log_queue = queue.Queue(app.config.get("LOG_QUEUE_SIZE", 10000))
+        _queue_handler = LazyQueueHandler(log_queue)
+        _queue_handler.addFilter(SamplingFilter(app.config.get("LOG_SAMPLE_RATE", 1)))
+        app.logger.handlers = [_queue_handler]
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
     app.logger.info("Logging handler established")
@@ -0,0 +1,92 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Prefetch
+
+Reads the next items of an iterator on a background thread while the
+caller is still working on the current one
+"""
+import queue
+import threading
+import contextvars
+
+# marks the end of the items on the queue
+_DONE = object()
+
+
+class _Failure:  # pylint: disable=too-few-public-methods
+    """An error raised by the iterator, to be raised again for the caller"""
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+class _Reader:
+    """Reads an iterator into a bounded buffer until it ends or is stopped"""
+
+    def __init__(self, depth: int):
+        self.buffer = queue.Queue(max(1, depth))
+        self.stopped = threading.Event()
+
+    def put(self, item) -> bool:
+        """Waits for room in the buffer, returns False if stopped first"""
+        while not self.stopped.is_set():
+            try:
+                self.buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read(self, items):
+        """Puts every item in the buffer, followed by _DONE or the error raised"""
+        try:
+            for item in items:
+                if not self.put(item):
+                    return
+            self.put(_DONE)
+        except Exception as error:  # pylint: disable=broad-except
+            self.put(_Failure(error))
+
+
+def prefetch(items, depth: int = 1):
+    """
+    Yields the items of an iterator, reading up to `depth` of them ahead
+
+    The buffer is bounded, so a slow caller holds back the reader rather
+    than letting it pull everything into memory. The reader stops as soon
+    as the caller stops iterating.
+
+    :param items: the iterable to read, usually one page of results per item
+    :param depth: how many items may be read ahead of the caller
+    """
+    reader = _Reader(depth)
+    # the reader works for the caller, under the caller's deadline
+    thread = threading.Thread(
+        target=contextvars.copy_context().run, args=(reader.read, items), name="prefetch", daemon=True
+    )
+    thread.start()
+    try:
+        while True:
+            item = reader.buffer.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        reader.stopped.set()
@@ -0,0 +1,209 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+# spell: ignore GCRA
+"""
+Rate Limit
+
+Paces requests so they stay under a rate instead of being turned away
+for going over it, and holds each API key to its own quota, turning
+away its requests once it goes over.
+
+Quotas are kept with the generic cell rate algorithm (GCRA), which only
+needs the time the next request is due for each key. The times are kept
+in the process, or in Redis when the optional redis package is installed
+and the workers are to share them.
+"""
+import time
+import logging
+import threading
+from service.common import deadline
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# keeps the arrival time of each key in Redis, reading the clock there so
+# that every worker agrees on it. Times are returned as strings because
+# Redis turns Lua numbers into integers
+GCRA_SCRIPT = """
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local interval, tolerance = tonumber(ARGV[1]), tonumber(ARGV[2])
+local due = math.max(tonumber(redis.call("GET", KEYS[1]) or now), now)
+if due - now > tolerance then
+    return tostring(due - tolerance - now)
+end
+redis.call("SET", KEYS[1], tostring(due + interval), "PX", math.ceil((due + interval - now) * 1000))
+return "0"
+"""
+
+
+class TokenBucket:  # pylint: disable=too-many-instance-attributes
+    """
+    Hands out tokens at a steady rate, letting up to `burst` through at once
+
+    Callers that find the bucket empty reserve the next token and sleep
+    until it is theirs, so they are served in the order they arrived.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self, timeout: float = None) -> float:
+        """
+        Takes a token, waiting for one if there are none, and returns how long it waited
+
+        :param timeout: the longest to wait, after which None is returned
+            straight away without taking a token
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = (1 - self._tokens) / self.rate if self._tokens < 1 else 0.0
+            if timeout is not None and wait > timeout:
+                return None
+            self._tokens -= 1
+            self.requests += 1
+            if wait:
+                self.waits += 1
+                self.wait_time += wait
+                self.max_wait = max(self.max_wait, wait)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def stats(self) -> dict:
+        """Returns how many requests went through and how long they waited"""
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "requests": self.requests,
+                "waits": self.waits,
+                "wait_seconds": round(self.wait_time, 3),
+                "max_wait_seconds": round(self.max_wait, 3),
+            }
+
+
+class Governor:
+    """
+    Keeps a token bucket for each class of request
+
+    :param rates: requests per second for each class, where 0 means unlimited
+    """
+
+    def __init__(self, rates: dict):
+        self.buckets = {kind: TokenBucket(rate) for kind, rate in rates.items() if rate > 0}
+
+    def acquire(self, kind: str) -> float:
+        """
+        Waits until a request of the given class may be sent
+
+        Raises DeadlineExceeded rather than wait past the request's deadline
+        """
+        deadline.check()
+        bucket = self.buckets.get(kind)
+        if bucket is None:
+            return 0.0
+        wait = bucket.acquire(deadline.remaining())
+        if wait is None:
+            raise deadline.DeadlineExceeded(f"No time left to wait for a {kind} token")
+        return wait
+
+    def stats(self) -> dict:
+        """Returns the stats of each bucket"""
+        return {kind: bucket.stats() for kind, bucket in self.buckets.items()}
+
+
+class KeyLimiter:  # pylint: disable=too-few-public-methods
+    """
+    Holds each key to its own rate, turning away requests over it
+
+    Only the time that the next request of each key is due is kept, so
+    checking a key is a single comparison and update. Python has no
+    compare-and-set to do that without a lock, so each key takes one of
+    `stripes` locks instead, and requests of different keys seldom wait
+    for each other.
+
+    :param stripes: how many locks the keys are spread over
+    """
+
+    def __init__(self, stripes: int = 64):
+        self._due = {}
+        self._locks = [threading.Lock() for _ in range(max(1, stripes))]
+
+    def take(self, key: str, rate: float, burst: int) -> float:
+        """
+        Lets a request of `key` through and returns 0, or returns the
+        seconds until it could be let through
+
+        :param rate: requests per second allowed on average
+        :param burst: requests that may be made at once
+        """
+        interval = 1.0 / rate
+        tolerance = interval * (max(1, burst) - 1)
+        now = time.monotonic()
+        with self._locks[hash(key) % len(self._locks)]:
+            due = max(self._due.get(key, now), now)
+            if due - now > tolerance:
+                return due - tolerance - now
+            self._due[key] = due + interval
+        return 0.0
+
+
+class RedisKeyLimiter:  # pylint: disable=too-few-public-methods
+    """
+    Holds each key to its own rate across every worker that uses the same Redis
+
+    Falls back to a limit for this process alone while Redis can't be reached.
+
+    :param url: the url of the Redis server
+    """
+
+    def __init__(self, url: str):
+        self._script = redis.Redis.from_url(url).register_script(GCRA_SCRIPT)
+        self.fallback = KeyLimiter()
+
+    def take(self, key: str, rate: float, burst: int) -> float:
+        """Lets a request of `key` through and returns 0, or returns the seconds until it could be"""
+        interval = 1.0 / rate
+        tolerance = interval * (max(1, burst) - 1)
+        try:
+            return float(self._script(keys=[f"rate-limit:{key}"], args=[interval, tolerance]))
+        except redis.RedisError as error:
+            logger.warning("Rate limit store unavailable, limiting this process only: %s", error)
+            return self.fallback.take(key, rate, burst)
+
+
+def key_limiter(url: str = None):
+    """Returns a limiter shared through Redis when there is a url for it, or one for this process"""
+    if url and redis is None:
+        logger.warning("The redis package is not installed, API keys are limited in each process")
+    if url and redis is not None:
+        return RedisKeyLimiter(url)
+    return KeyLimiter()
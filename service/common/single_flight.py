@@ -0,0 +1,92 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Single Flight
+
+Lets concurrent callers asking for the same thing share one call
+instead of each making their own
+"""
+import threading
+from service.common import deadline
+
+
+class _Call:  # pylint: disable=too-few-public-methods
+    """A call that is in flight"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that have the same key"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, func):
+        """
+        Calls func() unless a call with the same key is already in flight,
+        in which case it waits for that call and returns its result
+
+        Callers that wait never wait past their own deadline, and a leader
+        that ran out of its own time doesn't pass that on: the callers that
+        were waiting make the call again.
+
+        :param key: a hashable key identifying the call
+        :param func: the function to call with no arguments
+        """
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+
+        if not leader:
+            if not call.done.wait(deadline.remaining()):
+                raise deadline.DeadlineExceeded("The request took longer than its deadline waiting for a shared call")
+            if isinstance(call.error, deadline.DeadlineExceeded):
+                return self.do(key, func)
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as error:  # pylint: disable=broad-except
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self) -> dict:
+        """Returns how many calls were made and how many of them were shared"""
+        return {
+            "calls": self.calls,
+            "shared": self.shared,
+            "coalescing_rate": self.shared / self.calls if self.calls else 0.0,
+        }
@@ -0,0 +1,308 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Snapshot
+
+Keeps a read-only copy of every document in a file that all of the
+worker processes memory-map, so they share one copy of the data instead
+of each caching their own.
+
+The file holds a directory, a table of documents sorted by id, lists of
+document numbers for each indexed value, and the documents themselves
+as JSON. One process at a time holds a lock and keeps the file up to
+date from the changes feed. It writes a new file next to the old one
+and renames it into place, so readers always see a complete snapshot.
+"""
+import os
+import mmap
+import json
+import fcntl
+import struct
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"SNAPSHT1"
+# magic, then the offset and length of the directory at the end of the file
+HEADER = struct.Struct("<8sQI")
+# offset and length of the id, then offset and length of the document
+ENTRY = struct.Struct("<QIQI")
+# the number of a document in the table
+ORDINAL = struct.Struct("<I")
+
+
+def write_snapshot(path: str, docs: dict, seq: str, index_fields: tuple):
+    """
+    Writes documents to a snapshot file and renames it into place
+
+    :param path: the snapshot file
+    :param docs: the documents by id
+    :param seq: the update sequence the documents were read at
+    :param index_fields: the fields that documents can be looked up by
+    """
+    ids = sorted(docs)
+    indexes, ordinals = _build_indexes(docs, ids, index_fields)
+    entries = HEADER.size
+    table, blobs, offset = _build_table(docs, ids, entries + ENTRY.size * len(ids) + len(ordinals))
+    directory = json.dumps(
+        {
+            "seq": seq,
+            "count": len(ids),
+            "entries": entries,
+            "ordinals": entries + len(table),
+            "indexes": indexes,
+        }
+    ).encode()
+
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, offset, len(directory)))
+        file.write(table)
+        file.write(ordinals)
+        file.writelines(blobs)
+        file.write(directory)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+    logger.debug("Wrote a snapshot of %d documents", len(ids))
+
+
+def _build_table(docs: dict, ids: list, offset: int) -> tuple:
+    """
+    Returns the table of documents, the documents to write after it
+    starting at the given offset, and where they end
+    """
+    table = bytearray()
+    blobs = []
+    for doc_id in ids:
+        key, blob = doc_id.encode(), json.dumps(docs[doc_id]).encode()
+        table += ENTRY.pack(offset, len(key), offset + len(key), len(blob))
+        offset += len(key) + len(blob)
+        blobs.append(key + blob)
+    return bytes(table), blobs, offset
+
+
+def _build_indexes(docs: dict, ids: list, index_fields: tuple) -> tuple:
+    """
+    Returns where the documents with each value of each field are listed,
+    along with the lists of their numbers
+    """
+    indexes = {field: {} for field in index_fields}
+    for ordinal, doc_id in enumerate(ids):
+        for field in index_fields:
+            indexes[field].setdefault(json.dumps(docs[doc_id].get(field)), []).append(ordinal)
+    ordinals = bytearray()
+    for values in indexes.values():
+        for value, members in values.items():
+            values[value] = [len(ordinals) // ORDINAL.size, len(members)]
+            ordinals += struct.pack(f"<{len(members)}I", *members)
+    return indexes, bytes(ordinals)
+
+
+class _View:
+    """One version of the snapshot file, mapped into memory"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns)
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, offset, length = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a snapshot")
+        self.directory = json.loads(self.read(offset, length))
+
+    def read(self, offset: int, length: int) -> bytes:
+        """Returns the bytes at an offset in the file"""
+        end = offset + length
+        return self.map[offset:end]
+
+    def key(self, ordinal: int) -> bytes:
+        """Returns the id of a document by its number"""
+        key_offset, key_length, _, _ = ENTRY.unpack_from(self.map, self.directory["entries"] + ordinal * ENTRY.size)
+        return self.read(key_offset, key_length)
+
+    def doc(self, ordinal: int) -> dict:
+        """Returns a document by its number"""
+        _, _, doc_offset, doc_length = ENTRY.unpack_from(self.map, self.directory["entries"] + ordinal * ENTRY.size)
+        return json.loads(self.read(doc_offset, doc_length))
+
+
+class Snapshot:
+    """Reads documents from a snapshot file, following it when it is replaced"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._view = None
+        self._lock = threading.Lock()
+
+    def ready(self) -> bool:
+        """Returns True once there is a snapshot to read"""
+        return self._current() is not None
+
+    @property
+    def seq(self) -> str:
+        """The update sequence the snapshot was read at"""
+        view = self._current()
+        return view.directory["seq"] if view else None
+
+    def get(self, doc_id: str) -> dict:
+        """Returns the document with the given id, or None"""
+        view = self._current()
+        if view is None:
+            return None
+        key = doc_id.encode()
+        low, high = 0, view.directory["count"]
+        while low < high:
+            middle = (low + high) // 2
+            if view.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < view.directory["count"] and view.key(low) == key:
+            return view.doc(low)
+        return None
+
+    def find(self, field: str, value) -> list:
+        """Returns the documents whose indexed field has the given value"""
+        view = self._current()
+        if view is None:
+            return []
+        start, count = view.directory["indexes"][field].get(json.dumps(value), (0, 0))
+        first = view.directory["ordinals"] + start * ORDINAL.size
+        ordinals = struct.unpack_from(f"<{count}I", view.map, first)
+        return [view.doc(ordinal) for ordinal in ordinals]
+
+    def _current(self):
+        """Returns the newest version of the file, mapping it if it was replaced"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            if self._view is None or self._view.identity != (stat.st_ino, stat.st_mtime_ns):
+                # the old map is unmapped once nobody is reading from it
+                self._view = _View(self.path)
+            return self._view
+
+
+class SnapshotBuilder:  # pylint: disable=too-many-instance-attributes
+    """
+    Keeps the snapshot file up to date in whichever process holds its lock
+
+    :param path: the snapshot file
+    :param read_changes: called with a sequence, returns the changes feed rows
+        since then and the last sequence
+    :param generation: returns a token that changes when the database is
+        recreated, after which the old sequence means nothing
+    :param index_fields: the fields that documents can be looked up by
+    :param interval: seconds between checks for changes
+    """
+
+    # pylint: disable=too-many-arguments too-many-positional-arguments
+    def __init__(self, path: str, read_changes, generation, index_fields: tuple, interval: float = 1.0):
+        self.path = path
+        self.read_changes = read_changes
+        self.generation = generation
+        self.index_fields = index_fields
+        self.interval = interval
+        self.leader = False
+        self.refreshes = 0
+        self._docs = {}
+        self._seq = "0"
+        self._generation = None
+        self._lock_file = None
+        self._thread = None
+        self._pid = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Starts the background thread the first time it is called in a process"""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        # a forked child doesn't hold its parent's lock, and closing its copy
+        # of the file leaves the parent holding it
+        self.leader = False
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="snapshot", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stops the background thread and gives up the lock"""
+        if self._pid == os.getpid() and self._thread:
+            self._stopped.set()
+            self._thread.join(10)
+            self._thread = None
+            self._pid = None
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+        self.leader = False
+
+    def acquire(self) -> bool:
+        """Takes the lock if no other process holds it and returns True if this one does"""
+        if self._lock_file is None:
+            # pylint: disable=consider-using-with
+            self._lock_file = open(f"{self.path}.lock", "a", encoding="utf-8")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        if not self.leader:
+            logger.info("Process %d is now writing the snapshot", os.getpid())
+            # whatever the last writer saw may have changed since
+            self._generation = None
+        self.leader = True
+        return True
+
+    def refresh(self) -> bool:
+        """Applies the changes since the last refresh and writes the file if there were any"""
+        generation = self.generation()
+        changed = generation != self._generation
+        if changed:
+            self._docs, self._seq, self._generation = {}, "0", generation
+        changed = self._apply(self.read_changes(self._seq)) or changed
+        if changed or not os.path.exists(self.path):
+            write_snapshot(self.path, self._docs, self._seq, self.index_fields)
+            self.refreshes += 1
+            return True
+        return False
+
+    def _apply(self, changes: tuple) -> bool:
+        rows, self._seq = changes
+        for row in rows:
+            if row.get("deleted"):
+                self._docs.pop(row["id"], None)
+            elif not row["id"].startswith("_design/"):
+                self._docs[row["id"]] = row["doc"]
+        return bool(rows)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                if self.acquire():
+                    self.refresh()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.warning("Snapshot refresh failed: %s", error)
+            self._stopped.wait(self.interval)
@@ -0,0 +1,336 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Write Behind
+
+Acknowledges changes before they reach the database. Changes are kept per
+key, so several changes to the same Pet become one write, and a background
+thread writes them in batches. Every change is appended to a journal file
+first, and changes that a process never wrote are replayed from its journal
+by the next process that starts.
+
+The status of a change is only known to the process that accepted it, and
+only for the last MAX_STATUSES changes it finished. Once it is forgotten,
+or when the process restarts, status() returns None.
+"""
+import os
+import glob
+import json
+import time
+import atexit
+import logging
+import threading
+from itertools import islice
+from collections import OrderedDict
+from service.common.ids import ulid
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+# how many finished tickets are remembered for status lookups
+MAX_STATUSES = 10000
+
+
+class WriteBehind:  # pylint: disable=too-many-instance-attributes
+    """
+    Queues changes per key and writes them in batches on a background thread
+
+    :param flush: called with {key: fields} for each batch, returns {key: error}
+        for the keys that could not be written. If it raises, the batch is
+        queued again and retried.
+    :param journal_path: where to journal changes, or None to keep them in memory only
+    :param max_pending: the most keys that can wait to be written
+    :param batch_size: the most keys that are written together
+    :param interval: seconds to wait for more changes before writing a batch
+    """
+
+    # pylint: disable=too-many-arguments too-many-positional-arguments
+    def __init__(
+        self,
+        flush,
+        journal_path: str = None,
+        max_pending: int = 10000,
+        batch_size: int = 500,
+        interval: float = 0.05,
+    ):
+        self.flush = flush
+        self.journal_path = journal_path
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry_delay = 1.0
+        self._cond = threading.Condition(threading.RLock())
+        self._pending = OrderedDict()
+        self._writing = {}
+        self._statuses = OrderedDict()
+        self._in_flight = 0
+        self._journal = None
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._stopped = threading.Event()
+        self.written = 0
+        self.batches = 0
+        self.rejected = 0
+
+    def start(self):
+        """Starts the background thread and replays old journals, once in each process"""
+        with self._cond:
+            self._start()
+
+    def submit(self, key: str, fields: dict) -> str:
+        """
+        Queues a change and returns a ticket for looking up its status
+
+        Returns None when the queue is full so that the caller can write
+        the change itself, which slows it down to the speed of the database
+        """
+        with self._cond:
+            self._start()
+            if key not in self._pending and len(self._pending) >= self.max_pending:
+                self.rejected += 1
+                return None
+            return self._enqueue(key, fields)
+
+    def pending(self, key: str) -> dict:
+        """Returns the changes to a key that are waiting to be written or being written"""
+        with self._cond:
+            fields = {}
+            # changes being written still count until the database has them
+            for waiting in (self._writing, self._pending):
+                entry = waiting.get(key)
+                if entry:
+                    fields.update(entry["fields"])
+            return fields or None
+
+    def status(self, ticket: str) -> dict:
+        """Returns the status of a change, or None if the ticket is unknown"""
+        with self._cond:
+            return self._statuses.get(ticket)
+
+    def drain(self, timeout: float = None) -> bool:
+        """Waits until every queued change has been written"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self, timeout: float = 10.0):
+        """Writes what is left and stops the background thread"""
+        with self._cond:
+            if self._pid != os.getpid() or not self._thread:
+                return
+            self._stopping = True
+            self._stopped.set()
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        with self._cond:
+            self._thread = None
+            if self._journal:
+                self._journal.close()
+                self._journal = None
+
+    def stats(self) -> dict:
+        """Returns counters that describe the queue"""
+        with self._cond:
+            return {
+                "pending": len(self._pending),
+                "written": self.written,
+                "batches": self.batches,
+                "rejected": self.rejected,
+            }
+
+    ######################################################################
+    # Internals
+    ######################################################################
+    def _start(self):
+        """Starts the thread and replays old journals unless this process already did"""
+        if self._pid == os.getpid():
+            return
+        # a forked child must not write what its parent queued
+        self._pid = os.getpid()
+        self._pending.clear()
+        self._writing = {}
+        self._statuses.clear()
+        self._in_flight = 0
+        self._stopping = False
+        self._stopped.clear()
+        changes = []
+        if self.journal_path:
+            changes = self._claim_journals()
+            # pylint: disable=consider-using-with
+            self._journal = open(f"{self.journal_path}.{self._pid}", "a", encoding="utf-8")
+        for key, fields in changes:
+            self._enqueue(key, fields)
+        if changes:
+            logger.info("Replayed %d unwritten changes from the journal", len(changes))
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _enqueue(self, key: str, fields: dict) -> str:
+        ticket = ulid()
+        self._append({"ticket": ticket, "key": key, "fields": fields})
+        entry = self._pending.setdefault(key, {"fields": {}, "tickets": []})
+        entry["fields"].update(fields)
+        entry["tickets"].append(ticket)
+        self._set_status(ticket, PENDING)
+        self._cond.notify_all()
+        return ticket
+
+    def _set_status(self, ticket: str, state: str, error: str = None):
+        self._statuses[ticket] = {"status": state, "error": error} if error else {"status": state}
+        self._statuses.move_to_end(ticket)
+        while len(self._statuses) > MAX_STATUSES:
+            self._statuses.popitem(last=False)
+
+    def _append(self, record: dict):
+        """Appends a record to the journal and makes sure it is on disk"""
+        if self._journal:
+            self._journal.write(json.dumps(record) + "\n")
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                stopping = self._stopping
+            if not stopping:
+                # give more changes to the same keys a moment to arrive
+                self._stopped.wait(self.interval)
+            if not self._write_batch():
+                if stopping:
+                    return  # the journal keeps the changes for the next process
+                self._stopped.wait(self.retry_delay)
+
+    def _write_batch(self) -> bool:
+        """Writes one batch and returns False if it has to be tried again"""
+        with self._cond:
+            keys = list(islice(self._pending, self.batch_size))
+            batch = {key: self._pending.pop(key) for key in keys}
+            self._writing = batch
+            self._in_flight += 1
+        try:
+            errors = self.flush({key: entry["fields"] for key, entry in batch.items()})
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Write behind batch failed, will try again: %s", error)
+            with self._cond:
+                self._requeue(batch)
+                self._writing = {}
+                self._in_flight -= 1
+                self._cond.notify_all()
+            return False
+        with self._cond:
+            for key, entry in batch.items():
+                for ticket in entry["tickets"]:
+                    self._set_status(ticket, FAILED if key in errors else DONE, errors.get(key))
+            self._compact()
+            self.written += len(batch)
+            self.batches += 1
+            self._writing = {}
+            self._in_flight -= 1
+            self._cond.notify_all()
+        return True
+
+    def _compact(self):
+        """Rewrites the journal with only the changes that are still waiting"""
+        if not self._journal:
+            return
+        if not self._pending:
+            # everything journaled so far has been written
+            self._journal.truncate(0)
+            return
+        path = self._journal.name
+        with open(f"{path}.compact", "w", encoding="utf-8") as compact:
+            for key, entry in self._pending.items():
+                # one record per key is enough, its fields hold every change
+                compact.write(json.dumps({"ticket": entry["tickets"][0], "key": key, "fields": entry["fields"]}) + "\n")
+            compact.flush()
+            os.fsync(compact.fileno())
+        os.replace(f"{path}.compact", path)
+        self._journal.close()
+        # pylint: disable=consider-using-with
+        self._journal = open(path, "a", encoding="utf-8")
+
+    def _requeue(self, batch: dict):
+        """Puts a batch back at the front, under any newer changes to the same keys"""
+        for key in reversed(list(batch)):
+            entry = batch[key]
+            newer = self._pending.pop(key, None)
+            if newer:
+                entry["fields"].update(newer["fields"])
+                entry["tickets"].extend(newer["tickets"])
+            self._pending[key] = entry
+            self._pending.move_to_end(key, last=False)
+
+    def _claim_journals(self) -> list:
+        """Takes over the journals of processes that are gone and returns their unwritten changes"""
+        changes = []
+        for path in sorted(glob.glob(f"{glob.escape(self.journal_path)}.*")):
+            suffix = path.rsplit(".", 1)[1]
+            if not suffix.isdigit():
+                continue
+            pid = int(suffix)
+            if pid != self._pid and _alive(pid):
+                continue
+            claimed = f"{path}.replay-{self._pid}"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue  # another process claimed it first
+            changes.extend(_read_journal(claimed))
+            os.remove(claimed)
+        return changes
+
+
+def _alive(pid: int) -> bool:
+    """Returns True if a process with this pid is running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _read_journal(path: str) -> list:
+    """Returns the (key, fields) changes in a journal that were never marked done"""
+    unwritten = OrderedDict()
+    with open(path, encoding="utf-8") as journal:
+        for line in journal:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # the process died halfway through this line
+            if "done" in record:
+                for ticket in record["done"]:
+                    unwritten.pop(ticket, None)
+            else:
+                unwritten[record["ticket"]] = (record["key"], record["fields"])
+    return list(unwritten.values())
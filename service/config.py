@@ -4,17 +4,89 @@ Global Configuration for Application
 
 import os
 import logging
+import tempfile
 
 LOGGING_LEVEL = logging.INFO
 
+# Records waiting for the log writer thread before new ones are dropped
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Keep only one in every N info and debug records of each message (1 keeps all)
+LOG_SAMPLE_RATE = int(os.getenv("LOG_SAMPLE_RATE", "1"))
+
 # Get the database name to use
 CLOUDANT_DBNAME = os.getenv("CLOUDANT_DBNAME", "petshop")
 
+# Open the database session on the first request instead of at startup.
+# Required when gunicorn runs with --preload so workers don't share a socket
+DB_LAZY_CONNECT = os.getenv("DB_LAZY_CONNECT", "False").lower() == "true"
+
+# Seconds that responses are kept for replay under their Idempotency-Key
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+# Seconds between sweeps that delete the records whose time is up
+IDEMPOTENCY_SWEEP_INTERVAL = int(os.getenv("IDEMPOTENCY_SWEEP_INTERVAL", "3600"))
+
+# Let PUT /api/pets/<id> create a Pet with that id when it doesn't exist
+PUT_CREATES_PETS = os.getenv("PUT_CREATES_PETS", "False").lower() == "true"
+
+# Acknowledge updates and purchases with 202 and write them in the background
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "False").lower() == "true"
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv("WRITE_BEHIND_QUEUE_SIZE", "10000"))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "500"))
+# each process appends to <journal>.<pid> until its changes are written
+WRITE_BEHIND_JOURNAL = os.getenv(
+    "WRITE_BEHIND_JOURNAL", os.path.join(tempfile.gettempdir(), "petshop-write-behind")
+)
+
+# Seconds a request may take, including its database calls, before it fails
+# with 504. Clients can ask for less with an X-Request-Timeout header
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "10"))
+
+# Requests of each class that each worker handles at once before it turns
+# the rest away with 503, 0 for no limit. Scans are unfiltered listings
+CONCURRENCY_LOOKUPS = int(os.getenv("CONCURRENCY_LOOKUPS", "32"))
+CONCURRENCY_QUERIES = int(os.getenv("CONCURRENCY_QUERIES", "8"))
+CONCURRENCY_SCANS = int(os.getenv("CONCURRENCY_SCANS", "2"))
+CONCURRENCY_WRITES = int(os.getenv("CONCURRENCY_WRITES", "16"))
+# Seconds a request of each class should take. Slower ones shrink its limit
+# and faster ones let it grow back, 0 keeps the limit fixed
+LATENCY_TARGET_LOOKUPS = float(os.getenv("LATENCY_TARGET_LOOKUPS", "0.25"))
+LATENCY_TARGET_QUERIES = float(os.getenv("LATENCY_TARGET_QUERIES", "1"))
+LATENCY_TARGET_SCANS = float(os.getenv("LATENCY_TARGET_SCANS", "5"))
+LATENCY_TARGET_WRITES = float(os.getenv("LATENCY_TARGET_WRITES", "0.5"))
+# Seconds that turned away clients are asked to wait before trying again
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+
+# Number of serialized list results kept in memory, 0 turns the cache off
+LIST_CACHE_SIZE = int(os.getenv("LIST_CACHE_SIZE", "256"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t-for-dev")
 
 # See if an API Key has been set for security
 API_KEY = os.getenv("API_KEY")
 
+# More API keys, separated by commas, each as key[:rate[:burst]] to give it
+# its own quota instead of API_KEY_RATE and API_KEY_BURST
+API_KEYS = os.getenv("API_KEYS", "")
+
+# Requests per second and at once that each API key may make, 0 for no limit.
+# Requests over the quota are turned away with 429 before they reach the database
+API_KEY_RATE = float(os.getenv("API_KEY_RATE", "0"))
+API_KEY_BURST = int(os.getenv("API_KEY_BURST", "10"))
+
+# Redis url for the workers to share the API key quotas, each worker keeps its own when not set
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+
+# Responses smaller than this many bytes are not worth compressing
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+
+# How long browsers may cache static files in seconds
+SEND_FILE_MAX_AGE_DEFAULT = int(os.getenv("STATIC_MAX_AGE", "3600"))
+
+# How long clients may cache the OpenAPI spec in seconds
+SPEC_MAX_AGE = int(os.getenv("SPEC_MAX_AGE", "86400"))
+
 # Turn off helpful error messages that interfere with REST API messages
 RESTX_ERROR_404_HELP = False
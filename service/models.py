@@ -15,6 +15,7 @@
 ######################################################################
 
 # spell: ignore Rofrano VCAP dbname SQLDB Kubernetes
+# pylint: disable=too-many-lines
 """
 Pet Model that uses Cloudant
 
@@ -34,16 +35,29 @@ Docker Note:
 """
 
 import os
+import re
 import json
+import time
+import uuid
 import logging
+import threading
 from enum import Enum
 from datetime import date
-from retry import retry
+from urllib.parse import quote
 from cloudant.client import Cloudant
 from cloudant.query import Query
-from cloudant.adapters import Replay429Adapter
 from cloudant.database import CloudantDatabase
+from cloudant.document import Document
+from cloudant.design_document import DesignDocument
 from requests import HTTPError, ConnectionError  # pylint: disable=redefined-builtin
+from service.common.balancer import BalancingAdapter
+from service.common.deadline import retry
+from service.common.prefetch import prefetch
+from service.common.rate_limit import Governor
+from service.common.single_flight import SingleFlight
+from service.common.snapshot import Snapshot, SnapshotBuilder
+from service.common.ids import ulid
+from service.common.fuzzy import match_rank
 
 # get configuration from environment (12-factor)
 ADMIN_PARTY = os.getenv("ADMIN_PARTY", "False").lower() == "true"
@@ -51,11 +65,77 @@ CLOUDANT_HOST = os.getenv("CLOUDANT_HOST", "localhost")
 CLOUDANT_USERNAME = os.getenv("CLOUDANT_USERNAME", "admin")
 CLOUDANT_PASSWORD = os.getenv("CLOUDANT_PASSWORD", "pass")
 
+# comma separated urls of the nodes of a CouchDB cluster to spread requests over,
+# and seconds to wait on a read before sending it to a second node as well
+CLOUDANT_URLS = [url.strip() for url in os.getenv("CLOUDANT_URLS", "").split(",") if url.strip()]
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY", "0.1"))
+
 # global variables for retry (must be int)
 RETRY_COUNT = int(os.getenv("RETRY_COUNT", "10"))
 RETRY_DELAY = int(os.getenv("RETRY_DELAY", "1"))
 RETRY_BACKOFF = int(os.getenv("RETRY_BACKOFF", "2"))
 
+# how new documents get their ids: "uuid" lets CouchDB choose a random one,
+# "ulid" makes a time ordered one here so inserts stay close together
+ID_STRATEGY = os.getenv("ID_STRATEGY", "uuid").lower()
+
+# create the database partitioned by category so that category queries only
+# read one partition. Pet ids are then prefixed with "<category>:"
+PARTITIONED = os.getenv("PARTITIONED", "False").lower() == "true"
+
+# number of documents read from each page of a query
+QUERY_PAGE_SIZE = int(os.getenv("QUERY_PAGE_SIZE", "200"))
+
+# number of rows read from each page of a full scan, and how many
+# pages are read ahead on a background thread
+SCAN_PAGE_SIZE = int(os.getenv("SCAN_PAGE_SIZE", "500"))
+SCAN_PREFETCH = int(os.getenv("SCAN_PREFETCH", "2"))
+
+# most names a search reads looking for typos when no name starts with the term
+SEARCH_SCAN_LIMIT = int(os.getenv("SEARCH_SCAN_LIMIT", "1000"))
+
+# number of documents sent in each _bulk_docs request
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+
+# file that one worker keeps a copy of every Pet in for all of the workers
+# to memory-map and read from, and how often it is brought up to date.
+# Reads from it can be up to SNAPSHOT_INTERVAL seconds behind the database
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "1"))
+
+# connections kept open to the database, at least one per worker thread
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "32"))
+
+# requests per second sent to the database for each class of request that
+# Cloudant limits separately, 0 for no limit. The limits apply to each
+# process, so divide the plan's capacity by the number of workers
+RATE_LIMIT_LOOKUPS = float(os.getenv("RATE_LIMIT_LOOKUPS", "0"))
+RATE_LIMIT_WRITES = float(os.getenv("RATE_LIMIT_WRITES", "0"))
+RATE_LIMIT_QUERIES = float(os.getenv("RATE_LIMIT_QUERIES", "0"))
+
+# seconds that the result of a database health probe is reused for
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "5"))
+
+
+def birthday_condition(born_after: date = None, born_before: date = None) -> dict:
+    """Returns the Mango condition on birthday for the days given"""
+    condition = {}
+    if born_after:
+        condition["$gt"] = born_after.isoformat()
+    if born_before:
+        condition["$lt"] = born_before.isoformat()
+    return condition
+
+
+def is_client_error(error: HTTPError) -> bool:
+    """Returns True if the database turned a request down as malformed or not allowed"""
+    return error.response is not None and error.response.status_code in (400, 401, 403)
+
+
+# ids that clients may choose: CouchDB keeps ids that start with an
+# underscore for itself, and the rest are kept to what fits in a URL path
+VALID_ID = re.compile(r"[A-Za-z0-9%~.:-][A-Za-z0-9%~.:_-]{0,199}")
+
 
 class DatabaseConnectionError(Exception):
     """Custom Exception when database connection fails"""
@@ -65,6 +145,10 @@ class DataValidationError(Exception):
     """Custom Exception with data validation fails"""
 
 
+class DuplicateIdError(DataValidationError):
+    """Custom Exception when a Pet with the same id already exists"""
+
+
 class Gender(Enum):
     """Enumeration of valid Pet Genders"""
 
@@ -73,7 +157,21 @@ class Gender(Enum):
     UNKNOWN = 3
 
 
-class Pet:
+class PetPage(list):
+    """
+    A page of Pets along with the bookmark that the next page starts from
+
+    from_snapshot is True when the Pets were read from the snapshot, which
+    can lag behind the database
+    """
+
+    def __init__(self, pets=(), bookmark: str = None, from_snapshot: bool = False):
+        super().__init__(pets)
+        self.bookmark = bookmark
+        self.from_snapshot = from_snapshot
+
+
+class Pet:  # pylint: disable=too-many-public-methods
     """
     Class that represents a Pet
 
@@ -83,6 +181,48 @@ class Pet:
     logger = logging.getLogger(__name__)
     client: Cloudant = None
     database: CloudantDatabase = None
+    dbname: str = None
+    partitioned = False
+
+    # only one thread opens a lazy connection
+    connect_lock = threading.Lock()
+
+    # the last health probe and when it was made
+    reachable = False
+    probed_at: float = None
+    probe_lock = threading.Lock()
+
+    # fields that get a query index when the database is provisioned
+    indexed_fields = ("name", "category", "available", "gender", "birthday")
+
+    # fields Pets can be sorted by, and the equality filters that get a
+    # compound index with each of them so CouchDB can sort filtered lists
+    sort_fields = ("name", "category", "birthday")
+    sorted_filters = ("category", "available")
+
+    # views in the _design/pets design document
+    design_id = "_design/pets"
+    views = {
+        "by_name": "function (doc) {"
+        " if (typeof doc.name === 'string') { emit(doc.name.toLowerCase(), null); } }",
+    }
+
+    # concurrent identical lookups share one database call
+    flight = SingleFlight()
+
+    # spreads requests over the nodes of the cluster
+    balancer = None
+
+    # paces lookups by id, writes, and queries to what the plan allows
+    governor = Governor({"lookup": RATE_LIMIT_LOOKUPS, "write": RATE_LIMIT_WRITES, "query": RATE_LIMIT_QUERIES})
+
+    # a shared read-only copy of the Pets when SNAPSHOT_PATH is set
+    snapshot = None
+    snapshot_builder = None
+
+    # how many query pages were read and how many documents CouchDB scanned for them
+    query_stats = {"pages": 0, "docs_examined": 0}
+    stats_lock = threading.Lock()
 
     # pylint: disable=too-many-positional-arguments too-many-arguments
     def __init__(
@@ -109,39 +249,83 @@ class Pet:
         delay=RETRY_DELAY,
         backoff=RETRY_BACKOFF,
         tries=RETRY_COUNT,
+        giveup=is_client_error,
         logger=logger,
     )
-    def create(self):
+    def create(self) -> bool:
         """
         Creates a new Pet in the database
+
+        Returns False if the database refused it, in which case nothing was saved
         """
         if self.name is None:  # name is the only required field
             raise DataValidationError("name attribute is not set")
 
+        supplied_id = self.id
+        if supplied_id:
+            Pet.check_id(supplied_id)
+        if not self.id and (ID_STRATEGY == "ulid" or Pet.partitioned):
+            # partitioned databases can't choose ids for us
+            self.id = ulid() if ID_STRATEGY == "ulid" else uuid.uuid4().hex
+        if Pet.partitioned:
+            self.place_in_partition()
+
+        document = Document(self.database)
+        document.update(self.serialize())
+        Pet.governor.acquire("write")
         try:
-            document = self.database.create_document(self.serialize())
+            document.create()
         except HTTPError as err:
-            Pet.logger.warning("Create failed: %s", err)
-            return
+            if err.response is not None and err.response.status_code == 400:
+                self.id = supplied_id
+                raise DataValidationError(f"The database turned down Pet [{self.id}]: {err}") from err
+            if err.response is None or err.response.status_code != 409:
+                Pet.logger.warning("Create failed: %s", err)
+                self.id = supplied_id
+                return False
+            # a retry of a create whose response was lost finds its own document
+            if self._already_created():
+                Pet.logger.info("Pet with id [%s] was already created", self.id)
+                return True
+            raise DuplicateIdError(f"Pet with id [{self.id}] already exists") from err
+
+        self.id = document["_id"]
+        return True
 
-        if document.exists():
-            self.id = document["_id"]
+    def place_in_partition(self):
+        """Prefixes the id with the partition of the Pet's category"""
+        partition = Pet.partition_key(self.category)
+        if ":" not in self.id:
+            self.id = f"{partition}:{self.id}"
+        elif not self.id.startswith(f"{partition}:"):
+            raise DataValidationError(
+                f"Pet id [{self.id}] does not belong to partition [{partition}]. "
+                "The category of a Pet can't change in a partitioned database."
+            )
+
+    def _already_created(self) -> bool:
+        """Returns True if the document with our id holds exactly this Pet"""
+        stored = Pet._fetch(self.id)
+        return stored is not None and all(
+            stored.get(key) == value for key, value in self.serialize().items()
+        )
 
     @retry(
         HTTPError,
         delay=RETRY_DELAY,
         backoff=RETRY_BACKOFF,
         tries=RETRY_COUNT,
+        giveup=is_client_error,
         logger=logger,
     )
     def update(self):
         """Updates a Pet in the database"""
-        try:
-            document = self.database[self.id]  # pylint: disable=unsubscriptable-object)
-        except KeyError:
-            document = None
+        if Pet.partitioned:
+            self.place_in_partition()
+        document = Pet._document(self.id)
         if document:
             document.update(self.serialize())
+            Pet.governor.acquire("write")
             document.save()
 
     @retry(
@@ -149,15 +333,14 @@ class Pet:
         delay=RETRY_DELAY,
         backoff=RETRY_BACKOFF,
         tries=RETRY_COUNT,
+        giveup=is_client_error,
         logger=logger,
     )
     def delete(self):
         """Deletes a Pet from the database"""
-        try:
-            document = self.database[self.id]  # pylint: disable=unsubscriptable-object)
-        except KeyError:
-            document = None
+        document = Pet._document(self.id)
         if document:
+            Pet.governor.acquire("write")
             document.delete()
 
     def serialize(self) -> dict:
@@ -178,7 +361,7 @@ class Pet:
 
         :param data: a Python dictionary representing a Pet.
         """
-        Pet.logger.info("deserialize(%s)", data)
+        Pet.logger.debug("deserialize(%s)", data)
         try:
             self.name = data["name"]
             self.category = data["category"]
@@ -210,10 +393,54 @@ class Pet:
     #  S T A T I C   D A T A B S E   M E T H O D S
     ######################################################################
 
+    @staticmethod
+    def check_id(pet_id: str):
+        """Raises DataValidationError if a client can't give a Pet this id"""
+        if not isinstance(pet_id, str) or not VALID_ID.fullmatch(pet_id):
+            raise DataValidationError(
+                f"Invalid Pet id [{pet_id}]: ids are 1 to 200 letters, digits or "
+                "'%~.:_-' characters and can't start with an underscore"
+            )
+
+    @staticmethod
+    def partition_key(category: str) -> str:
+        """Returns the partition that Pets of a category are kept in"""
+        key = quote(category or "none", safe="")
+        # partition names can't start with an underscore
+        return f"-{key}" if key.startswith("_") else key
+
     @classmethod
     def connect(cls):
-        """Connect to the server"""
-        cls.client.connect()
+        """Connect to the server and open the database"""
+        try:
+            cls.client.connect()
+        except ConnectionError as exc:
+            raise DatabaseConnectionError("Cloudant service could not be reached") from exc
+        cls.share_session()
+        cls.open_database(cls.dbname)
+
+    @classmethod
+    def share_session(cls):
+        """
+        Makes the client's session safe for many threads to use at once
+
+        When the session expires, every thread using it gets a 401 at
+        about the same time. They share one login instead of each logging
+        in over the top of the others.
+        """
+        session = cls.client.r_session
+        login = session.login
+        logins = SingleFlight()
+        session.login = lambda: logins.do("login", login)
+
+    @classmethod
+    def ensure_connected(cls):
+        """Connects on first use when the database was initialized lazily"""
+        if cls.database is not None:
+            return
+        with cls.connect_lock:
+            if cls.database is None:
+                cls.connect()
 
     @classmethod
     def disconnect(cls):
@@ -226,13 +453,73 @@ class Pet:
         delay=RETRY_DELAY,
         backoff=RETRY_BACKOFF,
         tries=RETRY_COUNT,
+        giveup=is_client_error,
         logger=logger,
     )
-    def create_query_index(cls, field_name: str, order: str = "asc"):
-        """Creates a new query index for searching"""
-        cls.database.create_query_index(
-            index_name=field_name, fields=[{field_name: order}]
-        )
+    def create_query_index(
+        cls, field_name: str, order: str = "asc", then_by: str = None, partitioned: bool = False
+    ):
+        """
+        Creates a new query index for searching, optionally on a second field
+
+        In a partitioned database queries across partitions can only use
+        global indexes and queries of one partition only partitioned ones,
+        so `partitioned` says which kind to create
+        """
+        fields = [{field_name: order}]
+        if then_by:
+            fields.append({then_by: order})
+        index_name = f"{field_name}-{then_by}" if then_by else field_name
+        if not cls.partitioned:
+            cls.database.create_query_index(index_name=index_name, fields=fields)
+        elif partitioned:
+            # a design document holds either partitioned or global indexes
+            cls.database.create_query_index(
+                design_document_id=f"_design/partitioned-{index_name}",
+                index_name=f"partitioned-{index_name}",
+                fields=fields,
+                partitioned=True,
+            )
+        else:
+            cls.database.create_query_index(index_name=index_name, fields=fields, partitioned=False)
+
+    @classmethod
+    def provision(cls):
+        """Creates the query indexes and design documents the model relies on"""
+        for field_name in cls.indexed_fields:
+            cls.create_query_index(field_name)
+        for field_name in cls.sorted_filters:
+            for sort_field in cls.sort_fields:
+                if sort_field != field_name:
+                    cls.create_query_index(field_name, then_by=sort_field)
+        if cls.partitioned:
+            # find_by_category sorts within the category's partition
+            for sort_field in cls.sort_fields:
+                if sort_field != "category":
+                    cls.create_query_index("category", then_by=sort_field, partitioned=True)
+        cls.create_views()
+
+    @classmethod
+    def create_views(cls):
+        """Creates the design document views, or updates them if they changed"""
+        ddoc = DesignDocument(cls.database, cls.design_id)
+        if ddoc.exists():
+            ddoc.fetch()
+        changed = False
+        if cls.partitioned and ddoc.get("options", {}).get("partitioned") is not False:
+            # the views read every partition, which a partitioned design document can't
+            ddoc["options"] = {"partitioned": False}
+            changed = True
+        for view_name, map_func in cls.views.items():
+            view = ddoc.get_view(view_name)
+            if view is None:
+                ddoc.add_view(view_name, map_func)
+                changed = True
+            elif view.get("map") != map_func:
+                ddoc.update_view(view_name, map_func)
+                changed = True
+        if changed:
+            ddoc.save()
 
     @classmethod
     @retry(
@@ -240,12 +527,104 @@ class Pet:
         delay=RETRY_DELAY,
         backoff=RETRY_BACKOFF,
         tries=RETRY_COUNT,
+        giveup=is_client_error,
         logger=logger,
     )
     def remove_all(cls):
-        """Removes all documents from the database (use for testing)"""
-        for document in cls.database:  # pylint: disable=(not-an-iterable
-            document.delete()
+        """Removes all documents from the database (use for testing)
+
+        Dropping and recreating the database costs the same few requests no
+        matter how many documents it holds. Users that are not allowed to drop
+        databases fall back to deleting in _bulk_docs batches instead.
+        """
+        try:
+            cls.truncate()
+        except HTTPError as err:
+            if err.response is None or err.response.status_code not in (401, 403):
+                raise
+            Pet.logger.info("Cannot drop database, deleting in batches: %s", err)
+            cls.bulk_delete_all()
+
+    @classmethod
+    def truncate(cls):
+        """Drops and recreates the database, then provisions it again"""
+        dbname = cls.database.database_name
+        cls.database.delete()
+        cls.database = cls.client.create_database(dbname, partitioned=cls.partitioned)
+        cls.provision()
+
+    @classmethod
+    def bulk_delete_all(cls) -> int:
+        """Deletes every Pet document in _bulk_docs batches
+
+        Design documents are left alone so the query indexes survive.
+        """
+        count = 0
+        for rows in cls.scan(page_size=BULK_BATCH_SIZE):
+            docs = [{"_id": row["id"], "_rev": row["value"]["rev"], "_deleted": True} for row in rows]
+            cls.governor.acquire("write")
+            cls.database.bulk_docs(docs)
+            count += len(docs)
+        return count
+
+    @classmethod
+    def scan(cls, page_size: int = None, include_docs: bool = False):
+        """
+        Yields the _all_docs rows of every Pet one page at a time
+
+        The next page is fetched on a background thread while the caller
+        works through the current one. Design documents are left out.
+
+        :param page_size: rows per page, SCAN_PAGE_SIZE by default
+        :param include_docs: whether each row carries its document
+        """
+
+        def pages():
+            limit = page_size or SCAN_PAGE_SIZE
+            startkey = "\u0000"
+            while startkey is not None:
+                cls.governor.acquire("query")
+                result = cls.database.all_docs(limit=limit, startkey=startkey, include_docs=include_docs)
+                rows = result.get("rows", [])
+                startkey = rows[-1]["id"] + "\u0000" if len(rows) >= limit else None
+                rows = [row for row in rows if not row["id"].startswith("_design/")]
+                if rows:
+                    yield rows
+
+        return prefetch(pages(), SCAN_PREFETCH)
+
+    @classmethod
+    def apply_changes(cls, changes: dict) -> dict:
+        """
+        Writes changes to many Pets with one _bulk_docs request
+
+        :param changes: the fields to change for each Pet id
+        :returns: the error for each Pet id that could not be changed
+        """
+        errors = {}
+        for _ in range(RETRY_COUNT):
+            cls.governor.acquire("query")
+            result = cls.database.all_docs(keys=list(changes), include_docs=True)
+            docs = []
+            for row in result["rows"]:
+                if not row.get("doc"):
+                    errors[row["key"]] = "not_found"
+                    continue
+                docs.append(dict(row["doc"], **changes[row["key"]]))
+            conflicts = {}
+            if docs:
+                cls.governor.acquire("write")
+            for outcome in cls.database.bulk_docs(docs) if docs else []:
+                if outcome.get("error") == "conflict":
+                    conflicts[outcome["id"]] = changes[outcome["id"]]
+                elif "error" in outcome:
+                    errors[outcome["id"]] = outcome["error"]
+            if not conflicts:
+                return errors
+            # someone else changed these Pets since they were read
+            changes = conflicts
+        errors.update(dict.fromkeys(changes, "conflict"))
+        return errors
 
     @classmethod
     @retry(
@@ -253,15 +632,25 @@ class Pet:
         delay=RETRY_DELAY,
         backoff=RETRY_BACKOFF,
         tries=RETRY_COUNT,
+        giveup=is_client_error,
         logger=logger,
     )
-    def all(cls):
-        """Query that returns all Pets"""
+    def all(cls, **options):
+        """
+        Query that returns all Pets
+
+        Takes the sort, descending, limit and skip options of find_by().
+        A sorted list leaves out Pets that don't have the sort field.
+        """
+        if any(options.values()):
+            field = options.get("sort") or "_id"
+            return cls._query({field: {"$gte": None}}, **options)
         results = []
-        for doc in cls.database:  # pylint: disable=not-an-iterable
-            pet = Pet().deserialize(doc)
-            pet.id = doc["_id"]
-            results.append(pet)
+        for rows in cls.scan(include_docs=True):
+            for row in rows:
+                pet = Pet().deserialize(row["doc"])
+                pet.id = row["id"]
+                results.append(pet)
         return results
 
     ######################################################################
@@ -274,17 +663,120 @@ class Pet:
         delay=RETRY_DELAY,
         backoff=RETRY_BACKOFF,
         tries=RETRY_COUNT,
+        giveup=is_client_error,
         logger=logger,
     )
-    def find_by(cls, **kwargs):
-        """Find records using selector"""
-        query = Query(cls.database, selector=kwargs)
-        results = []
-        for doc in query.result:
-            pet = Pet()
-            pet.deserialize(doc)
-            results.append(pet)
-        return results
+    def find_by(
+        cls, sort: str = None, descending: bool = False, limit: int = None, skip: int = 0, bookmark: str = None, **kwargs
+    ):
+        """
+        Find records using selector
+
+        :param sort: a field to sort the Pets by
+        :param descending: sort from highest to lowest
+        :param limit: the most Pets to return
+        :param skip: how many Pets to skip over first
+        :param bookmark: where the page before this one ended, instead of skip
+        :param kwargs: the fields to match
+        """
+        return cls._query(kwargs, sort=sort, descending=descending, limit=limit, skip=skip, bookmark=bookmark)
+
+    @classmethod
+    def _find_all(cls, selector: dict, partition: str = None, sort: list = None) -> list:
+        """
+        Returns every match of a query, reading QUERY_PAGE_SIZE at a time
+
+        Each page starts from the bookmark of the page before it, so CouchDB
+        never scans earlier rows again the way a growing skip makes it.
+        The cloudant Query API doesn't allow execution_stats, so the
+        request is made directly.
+        """
+        url = Query(cls.database, partition_key=partition).url
+        body = {"selector": selector, "limit": QUERY_PAGE_SIZE, "execution_stats": True}
+        if sort:
+            body["sort"] = sort
+        docs = []
+        while True:
+            cls.governor.acquire("query")
+            resp = cls.database.r_session.post(url, json=body)
+            resp.raise_for_status()
+            page = resp.json()
+            docs.extend(page["docs"])
+            with cls.stats_lock:
+                cls.query_stats["pages"] += 1
+                cls.query_stats["docs_examined"] += page.get("execution_stats", {}).get(
+                    "total_docs_examined", 0
+                )
+            if len(page["docs"]) < QUERY_PAGE_SIZE or not page.get("bookmark"):
+                return docs
+            body["bookmark"] = page["bookmark"]
+
+    @classmethod
+    def _sort_spec(cls, selector: dict, sort: str, descending: bool) -> list:
+        """Returns a Mango sort that one of the indexes can serve, or None"""
+        direction = "desc" if descending else "asc"
+        filters = [field for field in selector if field != sort]
+        if not filters:
+            return [{sort: direction}]
+        if (
+            len(filters) == 1
+            and filters[0] in cls.sorted_filters
+            and not isinstance(selector[filters[0]], dict)
+        ):
+            # the filter is an equality so sorting on it first changes nothing
+            return [{filters[0]: direction}, {sort: direction}]
+        return None
+
+    @classmethod
+    def _query(
+        cls,
+        selector: dict,
+        partition: str = None,
+        sort: str = None,
+        descending: bool = False,
+        limit: int = None,
+        skip: int = 0,
+        bookmark: str = None,
+    ) -> PetPage:
+        """
+        Runs a query, only reading one partition when one is given
+
+        Sorting and paging are done by CouchDB when an index can serve the
+        sort, and in memory after reading every match when none can. Only
+        pages that CouchDB reads come with a bookmark, and only they can be
+        continued from one.
+        """
+        options = {}
+        if sort:
+            spec = cls._sort_spec(selector, sort, descending)
+            if spec:
+                options["sort"] = spec
+            else:
+                cls.logger.debug("No index sorts %s by %s", list(selector), sort)
+        in_memory = sort and "sort" not in options
+        if bookmark and (limit is None or in_memory):
+            raise DataValidationError("Only a page of Pets that an index sorts can be continued from a cursor")
+
+        def run():
+            if limit is not None and not in_memory:
+                query = Query(cls.database, selector=selector, partition_key=partition, **options)
+                cls.governor.acquire("query")
+                try:
+                    result = query(limit=limit, skip=skip, **({"bookmark": bookmark} if bookmark else {}))
+                except HTTPError as error:
+                    if bookmark and is_client_error(error):
+                        raise DataValidationError("The cursor doesn't belong to this list of Pets") from error
+                    raise
+                return result["docs"], result.get("bookmark")
+            docs = cls._find_all(selector, partition, options.get("sort"))
+            if in_memory:
+                docs.sort(key=lambda doc: doc.get(sort) or "", reverse=descending)
+            return (docs[skip:][:limit] if limit is not None else docs[skip:]), None
+
+        key = ("find_by", partition, json.dumps([selector, sort, descending, limit, skip, bookmark], sort_keys=True))
+        docs, next_bookmark = cls.flight.do(key, run)
+        # every caller gets Pets of its own even when the documents were shared
+        return PetPage([Pet().deserialize(doc) for doc in docs], next_bookmark)
 
     @classmethod
     @retry(
@@ -292,19 +784,219 @@ class Pet:
         delay=RETRY_DELAY,
         backoff=RETRY_BACKOFF,
         tries=RETRY_COUNT,
+        giveup=is_client_error,
         logger=logger,
     )
-    def find(cls, pet_id: str):
-        """Query that finds Pets by their id"""
+    def find(cls, pet_id: str, fresh: bool = False):
+        """
+        Query that finds Pets by their id
+
+        :param fresh: read the database rather than the snapshot, which can be
+            SNAPSHOT_INTERVAL behind, for a Pet that is about to be changed
+        """
+        if fresh:
+            document = cls._fetch(pet_id)
+            return Pet().deserialize(document) if document else None
+        snapshot = cls.shared_snapshot()
+        document = snapshot.get(pet_id) if snapshot else None
+        if document is None:
+            # the snapshot may not have caught up with a new Pet yet
+            document = cls.flight.do(("find", pet_id), lambda: cls._fetch(pet_id))
+        if document is None:
+            return None
+        return Pet().deserialize(document)
+
+    @classmethod
+    def _fetch(cls, pet_id: str):
+        """Returns a copy of the document with the given id or None"""
+        document = cls._document(pet_id)
+        return dict(document) if document else None
+
+    @classmethod
+    def _document(cls, pet_id: str):
+        """
+        Reads a document from the database, or returns None if there isn't one
+
+        Every call gets its own Document. The database object's cache would
+        share one between threads, and keep it after other workers change it.
+        """
+        document = Document(cls.database, pet_id)
         try:
-            document = cls.database[pet_id]  # pylint: disable=unsubscriptable-object
-            # Cloudant doesn't delete documents. :( It leaves the _id with no data
-            # so we must validate that _id that came back has a valid _rev
-            # if this next line throws a KeyError the document was deleted
-            _ = document["_rev"]
-            return Pet().deserialize(document)
-        except KeyError:
+            cls.governor.acquire("lookup")
+            document.fetch()
+        except HTTPError as err:
+            if err.response is not None and err.response.status_code == 404:
+                return None
+            raise
+        return document
+
+    @classmethod
+    def use_snapshot(cls, path: str):
+        """Reads Pets from a snapshot file that one of the processes keeps up to date"""
+        cls.snapshot = Snapshot(path)
+        cls.snapshot_builder = SnapshotBuilder(
+            path, cls.read_changes, cls.generation, ("category", "available"), SNAPSHOT_INTERVAL
+        )
+
+    @classmethod
+    def shared_snapshot(cls):
+        """Returns the snapshot if there is one to read from, or None"""
+        if cls.snapshot is None:
+            return None
+        cls.snapshot_builder.start()
+        return cls.snapshot if cls.snapshot.ready() else None
+
+    @classmethod
+    def read_changes(cls, since: str) -> tuple:
+        """Returns the changes since a sequence with their documents, and the last sequence"""
+        cls.ensure_connected()
+        resp = cls.database.r_session.get(
+            f"{cls.database.database_url}/_changes", params={"since": since, "include_docs": "true"}
+        )
+        resp.raise_for_status()
+        changes = resp.json()
+        return changes["results"], changes["last_seq"]
+
+    @classmethod
+    def generation(cls) -> str:
+        """Returns a token that changes whenever the database is recreated"""
+        cls.ensure_connected()
+        # _local documents go away with the database they are in
+        doc = cls.load_local("generation")
+        if doc is None:
+            cls.save_local("generation", {"token": uuid.uuid4().hex})
+            doc = cls.load_local("generation")
+        return doc["token"]
+
+    @classmethod
+    def update_seq(cls) -> str:
+        """
+        Returns the update sequence of the database
+
+        It changes whenever any document does, so results read at one
+        sequence are still good for as long as it stays the same.
+        """
+        return cls.database.metadata()["update_seq"]
+
+    @classmethod
+    def data_version(cls) -> tuple:
+        """
+        Returns the generation and update sequence of the database
+
+        A database that is dropped and created again can repeat the update
+        sequences of the one it replaced, so the sequence alone doesn't say
+        that nothing changed.
+        """
+        return cls.generation(), cls.update_seq()
+
+    @classmethod
+    def ping(cls) -> bool:
+        """
+        Returns True if the database can be reached
+
+        The database is probed at most once every HEALTH_CHECK_INTERVAL
+        seconds and the answer is reused in between. No documents are read.
+        It is not reachable while every node of the cluster is marked down.
+        """
+        if not cls.probe_is_fresh():
+            with cls.probe_lock:
+                # another thread may have probed while this one waited
+                if not cls.probe_is_fresh():
+                    try:
+                        cls.ensure_connected()
+                        cls.reachable = cls.database.exists()
+                    except (HTTPError, ConnectionError, DatabaseConnectionError) as error:
+                        cls.logger.warning("Database health probe failed: %s", error)
+                        cls.reachable = False
+                    cls.probed_at = time.monotonic()
+        # a cluster whose nodes are all left out can't serve requests
+        return cls.reachable and (cls.balancer is None or cls.balancer.healthy())
+
+    @classmethod
+    def probe_is_fresh(cls) -> bool:
+        """Returns True if the last health probe can still be used"""
+        return cls.probed_at is not None and time.monotonic() - cls.probed_at < HEALTH_CHECK_INTERVAL
+
+    @classmethod
+    def metrics(cls) -> dict:
+        """Returns counters that describe how the model is being used"""
+        with cls.stats_lock:
+            queries = dict(cls.query_stats)
+        stats = {"single_flight": cls.flight.stats(), "queries": queries, "rate_limit": cls.governor.stats()}
+        if cls.balancer is not None:
+            stats["cluster"] = cls.balancer.stats()
+        if cls.snapshot is not None:
+            stats["snapshot"] = {
+                "seq": cls.snapshot.seq,
+                "writer": cls.snapshot_builder.leader,
+                "refreshes": cls.snapshot_builder.refreshes,
+            }
+        return stats
+
+    ##################################################
+    # _local documents are never replicated or listed
+    ##################################################
+
+    @classmethod
+    def _local_url(cls, name: str) -> str:
+        return f"{cls.database.database_url}/_local/{quote(name, safe='')}"
+
+    @classmethod
+    def load_local(cls, name: str) -> dict:
+        """Returns a _local document or None if there isn't one"""
+        cls.governor.acquire("lookup")
+        resp = cls.client.r_session.get(cls._local_url(name))
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return resp.json()
+
+    @classmethod
+    def save_local(cls, name: str, doc: dict) -> str:
+        """
+        Writes a _local document and returns its new revision
+
+        Returns None if the document was changed since doc["_rev"] was read
+        """
+        cls.governor.acquire("write")
+        resp = cls.client.r_session.put(cls._local_url(name), json=doc)
+        if resp.status_code == 409:
             return None
+        resp.raise_for_status()
+        return resp.json()["rev"]
+
+    @classmethod
+    def expire_local(cls, prefix: str) -> int:
+        """
+        Deletes the _local documents whose names start with `prefix` and
+        whose "expires" time has passed, and returns how many there were
+
+        _local documents are never replicated or compacted away, so records
+        that are only good for a while have to be removed by whoever wrote them.
+        """
+        cls.governor.acquire("query")
+        resp = cls.client.r_session.get(
+            f"{cls.database.database_url}/_local_docs",
+            params={
+                "startkey": json.dumps(f"_local/{prefix}"),
+                "endkey": json.dumps(f"_local/{prefix}\ufff0"),
+                "include_docs": "true",
+            },
+        )
+        resp.raise_for_status()
+        now = time.time()
+        expired = [row["doc"] for row in resp.json()["rows"] if row.get("doc", {}).get("expires", now) < now]
+        for doc in expired:
+            cls.delete_local(doc["_id"][len("_local/"):], doc["_rev"])
+        return len(expired)
+
+    @classmethod
+    def delete_local(cls, name: str, rev: str):
+        """Deletes a _local document"""
+        cls.governor.acquire("write")
+        resp = cls.client.r_session.delete(cls._local_url(name), params={"rev": rev})
+        if resp.status_code != 404:
+            resp.raise_for_status()
 
     @classmethod
     @retry(
@@ -312,11 +1004,12 @@ class Pet:
         delay=RETRY_DELAY,
         backoff=RETRY_BACKOFF,
         tries=RETRY_COUNT,
+        giveup=is_client_error,
         logger=logger,
     )
-    def find_by_name(cls, name: str):
+    def find_by_name(cls, name: str, **options):
         """Query that finds Pets by their name"""
-        return cls.find_by(name=name)
+        return cls.find_by(name=name, **options)
 
     @classmethod
     @retry(
@@ -324,11 +1017,66 @@ class Pet:
         delay=RETRY_DELAY,
         backoff=RETRY_BACKOFF,
         tries=RETRY_COUNT,
+        giveup=is_client_error,
         logger=logger,
     )
-    def find_by_category(cls, category: str):
+    def search(cls, text: str, page: int = 1, page_size: int = 20) -> list:
+        """
+        Finds Pets whose name starts with or is close to the text
+
+        Exact matches come first, then names that start with the text. Only
+        when no name starts with it are names that are a typo or two away
+        looked for, among at most SEARCH_SCAN_LIMIT keys of the by_name view
+        that share the first letter. Documents are fetched for the requested
+        page alone.
+        """
+        term = text.strip().lower()
+        if not term:
+            return []
+        rows = cls._names_between(term, term + "\ufff0")
+        if not rows:
+            rows = cls._names_between(term[0], term[0] + "\ufff0", SEARCH_SCAN_LIMIT)
+        ranked = []
+        for row in rows:
+            rank = match_rank(term, row["key"])
+            if rank is not None:
+                ranked.append((rank, row["key"], row["id"]))
+        ranked.sort()
+
+        start = (page - 1) * page_size
+        pet_ids = [pet_id for _, _, pet_id in ranked[start:][:page_size]]
+        if not pet_ids:
+            return []
+        cls.governor.acquire("query")
+        result = cls.database.all_docs(keys=pet_ids, include_docs=True)
+        return [Pet().deserialize(row["doc"]) for row in result["rows"] if row.get("doc")]
+
+    @classmethod
+    def _names_between(cls, startkey: str, endkey: str, limit: int = None) -> list:
+        """Returns the rows of the by_name view with keys in a range"""
+        options = {"limit": limit} if limit else {}
+        cls.governor.acquire("query")
+        return cls.database.get_view_result(
+            cls.design_id, "by_name", raw_result=True, startkey=startkey, endkey=endkey, **options
+        )["rows"]
+
+    @classmethod
+    @retry(
+        HTTPError,
+        delay=RETRY_DELAY,
+        backoff=RETRY_BACKOFF,
+        tries=RETRY_COUNT,
+        giveup=is_client_error,
+        logger=logger,
+    )
+    def find_by_category(cls, category: str, **options):
         """Query that finds Pets by their category"""
-        return cls.find_by(category=category)
+        snapshot = cls.shared_snapshot()
+        if snapshot and not any(options.values()):
+            return PetPage((Pet().deserialize(doc) for doc in snapshot.find("category", category)), from_snapshot=True)
+        if cls.partitioned:
+            return cls._query({"category": category}, cls.partition_key(category), **options)
+        return cls.find_by(category=category, **options)
 
     @classmethod
     @retry(
@@ -336,11 +1084,15 @@ class Pet:
         delay=RETRY_DELAY,
         backoff=RETRY_BACKOFF,
         tries=RETRY_COUNT,
+        giveup=is_client_error,
         logger=logger,
     )
-    def find_by_availability(cls, available: bool = True):
+    def find_by_availability(cls, available: bool = True, **options):
         """Query that finds Pets by their availability"""
-        return cls.find_by(available=available)
+        snapshot = cls.shared_snapshot()
+        if snapshot and not any(options.values()):
+            return PetPage((Pet().deserialize(doc) for doc in snapshot.find("available", available)), from_snapshot=True)
+        return cls.find_by(available=available, **options)
 
     @classmethod
     @retry(
@@ -348,11 +1100,59 @@ class Pet:
         delay=RETRY_DELAY,
         backoff=RETRY_BACKOFF,
         tries=RETRY_COUNT,
+        giveup=is_client_error,
         logger=logger,
     )
-    def find_by_gender(cls, gender: str = Gender.UNKNOWN.name):
+    def find_by_gender(cls, gender: str = Gender.UNKNOWN.name, **options):
         """Query that finds Pets by their gender as a string"""
-        return cls.find_by(gender=gender)
+        return cls.find_by(gender=gender, **options)
+
+    @classmethod
+    @retry(
+        HTTPError,
+        delay=RETRY_DELAY,
+        backoff=RETRY_BACKOFF,
+        tries=RETRY_COUNT,
+        giveup=is_client_error,
+        logger=logger,
+    )
+    def find_by_birthday_range(cls, born_after: date = None, born_before: date = None, **options):
+        """
+        Query that finds Pets born after and/or before the given days
+
+        Birthdays are stored as ISO dates, which sort as strings in date
+        order, so the range is read from the birthday index
+        """
+        condition = birthday_condition(born_after, born_before)
+        if not condition:
+            return cls.all(**options)
+        return cls.find_by(birthday=condition, **options)
+
+    @classmethod
+    @retry(
+        HTTPError,
+        delay=RETRY_DELAY,
+        backoff=RETRY_BACKOFF,
+        tries=RETRY_COUNT,
+        giveup=is_client_error,
+        logger=logger,
+    )
+    def find_matching(cls, criteria: dict, born_after: date = None, born_before: date = None, **options):
+        """
+        Query that finds Pets that match every one of several filters
+
+        :param criteria: the fields to match, such as category and available
+        :param born_after: only Pets born after this day
+        :param born_before: only Pets born before this day
+        :param options: the sort, descending, limit and skip options of find_by()
+        """
+        selector = dict(criteria)
+        condition = birthday_condition(born_after, born_before)
+        if condition:
+            selector["birthday"] = condition
+        if cls.partitioned and criteria.get("category"):
+            return cls._query(selector, cls.partition_key(criteria["category"]), **options)
+        return cls._query(selector, **options)
 
     ############################################################
     #  C L O U D A N T   D A T A B A S E   C O N N E C T I O N
@@ -394,9 +1194,13 @@ class Pet:
         return opts
 
     @staticmethod
-    def init_db(dbname: str = "pets"):
+    def init_db(dbname: str = "pets", connect: bool = True):
         """
         Initialized Cloudant database connection
+
+        :param dbname: the name of the database to use
+        :param connect: when False no session is opened until ensure_connected()
+            is called, so the client can be created before a worker is forked
         """
         # See if we are running Cloud Foundry
         opts = Pet.__check_for_cloud_foundry_binding()
@@ -416,7 +1220,15 @@ class Pet:
                 "Check that app is bound to a Cloudant service."
             )
 
+        if CLOUDANT_URLS:
+            opts["url"] = CLOUDANT_URLS[0]
         Pet.logger.info("Cloudant Endpoint: %s", opts["url"])
+        Pet.dbname = dbname
+        Pet.database = None
+        adapter = BalancingAdapter(CLOUDANT_URLS or [opts["url"]], HEDGE_DELAY, retries=10, initialBackoff=0.01)
+        # one connection per thread instead of the default of 10
+        adapter.init_poolmanager(DB_POOL_SIZE, DB_POOL_SIZE)
+        Pet.balancer = adapter
         try:
             if ADMIN_PARTY:
                 Pet.logger.info("Running in Admin Party Mode...")
@@ -424,10 +1236,10 @@ class Pet:
                 opts["username"],
                 opts["password"],
                 url=opts["url"],
-                connect=True,
+                connect=connect,
                 auto_renew=True,
                 admin_party=ADMIN_PARTY,
-                adapter=Replay429Adapter(retries=10, initialBackoff=0.01),
+                adapter=adapter,
             )
 
         except ConnectionError as exc:
@@ -435,12 +1247,35 @@ class Pet:
                 "Cloudant service could not be reached"
             ) from exc
 
+        if SNAPSHOT_PATH:
+            Pet.use_snapshot(SNAPSHOT_PATH)
+        if connect:
+            Pet.share_session()
+            Pet.open_database(dbname)
+
+    @staticmethod
+    def open_database(dbname: str):
+        """
+        Opens the database, creating and provisioning it if needed
+
+        An existing database is not provisioned again, which would cost a
+        dozen requests on every worker boot. Call Pet.provision() once after
+        an upgrade that adds indexes or views.
+        """
+        created = False
         # Create database if it doesn't exist
         try:
-            Pet.database = Pet.client[dbname]  # pylint: disable=unsubscriptable-object
+            database = Pet.client[dbname]  # pylint: disable=unsubscriptable-object
         except KeyError:
             # Create a database using an initialized client
-            Pet.database = Pet.client.create_database(dbname)
+            database = Pet.client.create_database(dbname, partitioned=PARTITIONED)
+            created = True
         # check for success
-        if not Pet.database.exists():
+        if not database.exists():
             raise DatabaseConnectionError(f"Database [{dbname}] could not be obtained")
+        Pet.partitioned = PARTITIONED and database.metadata().get("props", {}).get("partitioned", False)
+        if PARTITIONED and not Pet.partitioned:
+            Pet.logger.warning("Database [%s] was not created partitioned", dbname)
+        Pet.database = database
+        if created:
+            Pet.provision()
@@ -21,20 +21,40 @@ Pet Store Service with Swagger
 Paths:
 ------
 GET / - Displays a UI for Selenium testing
+GET /health/live - Returns OK while the process is running
+GET /health/ready - Returns OK when the database can be reached
+GET /metrics - Returns the service metrics
 GET /pets - Returns a list all of the Pets
+GET /pets?q={text} - Returns Pets whose names start with or are close to the text
+GET /pets?born_after={date}&born_before={date} - Returns Pets born between two days
+GET /pets?category={category}&available={bool}&... - Returns Pets that match every filter given
+GET /pets?sort={field}&order={asc|desc}&page={n}&page_size={n} - Returns a sorted page of Pets
+GET /pets?sort={field}&page_size={n}&cursor={X-Next-Cursor} - Returns the page after the one with that cursor
 GET /pets/{id} - Returns the Pet with a given id number
 POST /pets - creates a new Pet record in the database
 PUT /pets/{id} - updates a Pet record in the database
 DELETE /pets/{id} - deletes a Pet record in the database
+GET /writes/{ticket} - Returns the status of a change that was accepted with 202
+
+Every request must be answered within REQUEST_TIMEOUT seconds, or fewer
+when the client sends an X-Request-Timeout header, or it fails with 504
 """
 
+import json
+import math
+import time
+import hashlib
 import secrets
+import threading
 from functools import wraps
-from flask import request
+from flask import g, request, jsonify
 from flask import current_app as app  # Import Flask application
+from requests import HTTPError, ConnectionError  # pylint: disable=redefined-builtin
 from flask_restx import Api, Resource, fields, reqparse, inputs
-from service.models import Pet, Gender
+from service.models import Pet, Gender, DuplicateIdError
 from service.common import status  # HTTP Status Codes
+from service.common import compression
+from service.common import deadline
 
 # Document the type of authorization required
 authorizations = {"apikey": {"type": "apiKey", "in": "header", "name": "X-Api-Key"}}
@@ -61,7 +81,105 @@ api = Api(
 @app.route("/")
 def index():
     """Index page"""
-    return app.send_static_file("index.html")
+    return compression.send_static_asset("index.html")
+
+
+######################################################################
+# Health probes for the orchestrator
+######################################################################
+@app.route("/health/live")
+def health_live():
+    """Liveness probe that never touches the database"""
+    return jsonify(status="OK"), status.HTTP_200_OK
+
+
+@app.route("/health/ready")
+def health_ready():
+    """Readiness probe backed by a cached database check"""
+    if Pet.ping():
+        return jsonify(status="OK", database="reachable"), status.HTTP_200_OK
+    return (
+        jsonify(status="Service Unavailable", database="unreachable"),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+
+
+######################################################################
+# Request deadlines
+######################################################################
+def time_limit(seconds: float):
+    """Decorator that gives an endpoint a different default time limit"""
+
+    def decorator(func):
+        func.time_limit = seconds
+        return func
+
+    return decorator
+
+
+@app.before_request
+def start_deadline():
+    """Gives the request until its time limit to finish, database calls included"""
+    view = app.view_functions.get(request.endpoint)
+    # Resources keep their limits on the method that handles the request
+    handler = getattr(getattr(view, "view_class", None), request.method.lower(), view)
+    seconds = getattr(handler, "time_limit", app.config["REQUEST_TIMEOUT"])
+    asked = request.headers.get("X-Request-Timeout", type=float)
+    if asked and asked > 0:
+        seconds = min(seconds, asked)
+    deadline.start(seconds)
+
+
+@app.teardown_request
+def clear_deadline(_error):
+    """Removes the deadline so it doesn't follow the thread to its next request"""
+    deadline.clear()
+
+
+######################################################################
+# Admission control
+######################################################################
+# the query arguments that narrow a listing down from a full scan
+FILTER_ARGS = ("q", "category", "name", "available", "born_after", "born_before")
+
+
+def admission_class() -> str:
+    """Returns the class of the current request for admission control"""
+    if request.endpoint not in ("pet_resource", "pet_collection", "purchase_resource", "write_status_resource"):
+        return None
+    if request.method in ("POST", "PUT", "DELETE"):
+        # token_required turns these away without any work, so they take no
+        # slot and their quick answers don't move the limit
+        if requires_api_key() and api_key_refusal():
+            return None
+        return "write"
+    if request.method not in ("GET", "HEAD"):
+        return None
+    if request.endpoint != "pet_collection":
+        return "lookup"
+    return "query" if any(request.args.get(arg) for arg in FILTER_ARGS) else "scan"
+
+
+def connect_database():
+    """Opens the database session on the first request that needs it"""
+    if request.endpoint not in ("health_live", "health_ready"):
+        Pet.ensure_connected()
+
+
+######################################################################
+# Expose the service metrics
+######################################################################
+@app.route("/metrics")
+def metrics():
+    """Returns the service metrics as JSON"""
+    stats = {"startup": app.config.get("STARTUP_TIMINGS", {}), **Pet.metrics()}
+    if "list_cache" in app.extensions:
+        stats["list_cache"] = app.extensions["list_cache"].stats()
+    if "admission" in app.extensions:
+        stats["admission"] = app.extensions["admission"].stats()
+    if "write_behind" in app.extensions:
+        stats["write_behind"] = app.extensions["write_behind"].stats()
+    return jsonify(stats)
 
 
 # Define the model so that the docs reflect what can be sent
@@ -99,28 +217,257 @@ pet_args.add_argument(
     required=False,
     help="List Pets by availability",
 )
+pet_args.add_argument(
+    "born_after",
+    type=inputs.date_from_iso8601,
+    location="args",
+    required=False,
+    help="List Pets born after this day (YYYY-MM-DD)",
+)
+pet_args.add_argument(
+    "born_before",
+    type=inputs.date_from_iso8601,
+    location="args",
+    required=False,
+    help="List Pets born before this day (YYYY-MM-DD)",
+)
+pet_args.add_argument("q", type=str, location="args", required=False, help="Search Pets by name")
+pet_args.add_argument(
+    "sort",
+    type=str,
+    location="args",
+    choices=Pet.sort_fields,
+    required=False,
+    help="Sort Pets by this field",
+)
+pet_args.add_argument(
+    "order",
+    type=str,
+    location="args",
+    choices=("asc", "desc"),
+    default="asc",
+    help="The direction to sort in",
+)
+pet_args.add_argument("page", type=inputs.positive, location="args", default=1, help="The page to return")
+pet_args.add_argument(
+    "cursor",
+    type=str,
+    location="args",
+    required=False,
+    help="Continue from the X-Next-Cursor of the page before, instead of page",
+)
+pet_args.add_argument(
+    "page_size",
+    type=inputs.int_range(1, 100),
+    location="args",
+    required=False,
+    help="The number of Pets on each page (all of them when not given)",
+)
 
 
 ######################################################################
 # Authorization Decorator
 ######################################################################
 def token_required(func):
-    """Decorator to require a token for this endpoint"""
+    """Decorator to require a token for this endpoint, within the quota of that token"""
 
     @wraps(func)
     def decorated(*args, **kwargs):
-        token = None
-        if "X-Api-Key" in request.headers:
-            token = request.headers["X-Api-Key"]
+        refusal = api_key_refusal()
+        if refusal:
+            return refusal
+        return func(*args, **kwargs)
 
-        if app.config.get("API_KEY") and app.config["API_KEY"] == token:
-            return func(*args, **kwargs)
+    decorated.api_key_required = True
+    return decorated
 
-        return {"message": "Invalid or missing token"}, 401
+
+def requires_api_key() -> bool:
+    """Returns True if the current request goes to a method that needs an API key"""
+    view = app.view_functions.get(request.endpoint)
+    method = getattr(getattr(view, "view_class", None), request.method.lower(), None)
+    return getattr(method, "api_key_required", False)
+
+
+def api_key_refusal():
+    """
+    Checks the API key of the current request and takes from its quota,
+    once per request, and returns the 401 or 429 answer or None if it may go on
+    """
+    if "api_key_refusal" not in g:
+        g.api_key_refusal = None
+        token = request.headers.get("X-Api-Key")
+        quota = api_key_quota(token)
+        if quota is None:
+            g.api_key_refusal = {"message": "Invalid or missing token"}, 401
+        elif quota[0] > 0:
+            wait = app.extensions["key_limiter"].take(api_key_id(token), *quota)
+            if wait:
+                g.api_key_refusal = (
+                    {"message": "Too many requests for this API key"},
+                    status.HTTP_429_TOO_MANY_REQUESTS,
+                    {"Retry-After": str(math.ceil(wait))},
+                )
+    return g.api_key_refusal
+
+
+def api_key_id(token: str) -> str:
+    """Returns a short hash of an API key, so the key itself is never stored"""
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+def api_key_quota(token: str) -> tuple:
+    """Returns the (rate, burst) quota of an API key, or None if it is not valid"""
+    if not token:
+        return None
+    keys = app.extensions.get("api_keys", {})
+    if token in keys:
+        return keys[token]
+    if app.config.get("API_KEY") == token:
+        return app.config["API_KEY_RATE"], app.config["API_KEY_BURST"]
+    return None
+
+
+def parse_api_keys(text: str, rate: float, burst: int) -> dict:
+    """
+    Returns the (rate, burst) quota of each key in a list of key[:rate[:burst]]
+
+    :param rate: the rate of keys that don't give their own
+    :param burst: the burst of keys that don't give their own
+    :raises ValueError: naming the first entry that can't be read, by its
+        position and quota so that the key itself isn't logged
+    """
+    keys = {}
+    entries = (entry.strip() for entry in text.split(","))
+    for number, entry in enumerate(filter(None, entries), 1):
+        key, *quota = entry.split(":")
+        try:
+            if not key or len(quota) > 2:
+                raise ValueError("expected key[:rate[:burst]]")
+            keys[key] = (float(quota[0]) if quota else rate, int(quota[1]) if len(quota) > 1 else burst)
+            if keys[key][0] < 0 or keys[key][1] < 0:
+                raise ValueError("the rate and burst can't be negative")
+        except ValueError as error:
+            shown = ":".join(["<key>" if key else "", *quota])
+            raise ValueError(f"API_KEYS entry {number} ({shown}) is malformed: {error}") from error
+    return keys
+
+
+######################################################################
+# Idempotency Decorator
+######################################################################
+# when the expired idempotency records are next swept away
+idempotency_sweep = {"due": 0.0, "lock": threading.Lock()}
+
+
+def idempotent(func):
+    """
+    Decorator that runs a request only once for each Idempotency-Key
+
+    The first response is kept for IDEMPOTENCY_TTL seconds and retries
+    with the same key get it back without running the request again.
+    Keys are kept apart for each API key, so clients can't collide.
+    """
+
+    @wraps(func)
+    def decorated(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if not key:
+            return func(*args, **kwargs)
+        if len(key) > 255:
+            abort(status.HTTP_400_BAD_REQUEST, "Idempotency-Key must be 255 characters or less.")
+
+        name = idempotency_record_name(key)
+        fingerprint = hashlib.sha256(
+            f"{request.method} {request.path}\n".encode() + request.get_data()
+        ).hexdigest()
+        record = Pet.load_local(name)
+        if record and record["expires"] > time.time():
+            return replay_response(record, key, fingerprint)
+
+        claim = claim_idempotency_key(name, key, fingerprint, record)
+        try:
+            body, code, *extra = func(*args, **kwargs)
+        except Exception:
+            # let a retry run the request again
+            Pet.delete_local(name, claim["_rev"])
+            raise
+        headers = dict(extra[0]) if extra else {}
+        store_response(name, key, claim, (body, code, headers))
+        return body, code, headers
 
     return decorated
 
 
+def idempotency_record_name(key: str) -> str:
+    """Returns the name of the _local document kept for an Idempotency-Key of the caller's API key"""
+    token = request.headers.get("X-Api-Key")
+    return f"idempotency-{api_key_id(token) if token else 'public'}-{key}"
+
+
+def replay_response(record: dict, key: str, fingerprint: str) -> tuple:
+    """Returns the response kept for an Idempotency-Key, if it was for the same request and has finished"""
+    if record["fingerprint"] != fingerprint:
+        abort(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            f"Idempotency-Key [{key}] was already used for a different request.",
+        )
+    if "status" not in record:
+        abort(status.HTTP_409_CONFLICT, f"A request with Idempotency-Key [{key}] is in progress.")
+    app.logger.info("Replaying the response for Idempotency-Key [%s]", key)
+    headers = dict(record["headers"], **{"Idempotent-Replayed": "true"})
+    return record["body"], record["status"], headers
+
+
+def claim_idempotency_key(name: str, key: str, fingerprint: str, record: dict) -> dict:
+    """
+    Claims an Idempotency-Key so that concurrent retries don't run the request too
+
+    The claim only lasts as long as the request may take, so a worker
+    that dies while holding it doesn't lock the key out for IDEMPOTENCY_TTL.
+    """
+    lease = deadline.remaining() or app.config["REQUEST_TIMEOUT"]
+    claim = {"fingerprint": fingerprint, "expires": time.time() + max(lease, 1.0)}
+    if record:
+        claim["_rev"] = record["_rev"]
+    claim["_rev"] = Pet.save_local(name, claim)
+    if not claim["_rev"]:
+        abort(status.HTTP_409_CONFLICT, f"A request with Idempotency-Key [{key}] is in progress.")
+    return claim
+
+
+def store_response(name: str, key: str, claim: dict, response: tuple):
+    """Keeps a response for IDEMPOTENCY_TTL seconds, or gives up the claim if it can't be kept"""
+    body, code, headers = response
+    record = dict(claim, expires=time.time() + app.config["IDEMPOTENCY_TTL"], status=code, body=body, headers=headers)
+    try:
+        Pet.save_local(name, record)
+    except HTTPError as error:
+        app.logger.warning("Response for Idempotency-Key [%s] was not saved: %s", key, error)
+        try:
+            # a retry runs the request again rather than wait for the claim to run out
+            Pet.delete_local(name, claim["_rev"])
+        except HTTPError:
+            app.logger.warning("Claim on Idempotency-Key [%s] is left to expire", key)
+    sweep_idempotency_records()
+
+
+def sweep_idempotency_records():
+    """Deletes the expired idempotency records in the background every IDEMPOTENCY_SWEEP_INTERVAL seconds"""
+    with idempotency_sweep["lock"]:
+        if time.monotonic() < idempotency_sweep["due"]:
+            return
+        idempotency_sweep["due"] = time.monotonic() + app.config["IDEMPOTENCY_SWEEP_INTERVAL"]
+
+    def sweep():
+        try:
+            Pet.logger.info("Swept away %d expired idempotency records", Pet.expire_local("idempotency-"))
+        except (HTTPError, ConnectionError) as error:
+            Pet.logger.warning("Sweeping idempotency records failed: %s", error)
+
+    threading.Thread(target=sweep, name="idempotency-sweep", daemon=True).start()
+
+
 ######################################################################
 # Function to generate a random API key (good for testing)
 ######################################################################
@@ -166,6 +513,8 @@ class PetResource(Resource):
     # UPDATE AN EXISTING PET
     # ------------------------------------------------------------------
     @api.doc("update_pets", security="apikey")
+    @api.response(201, "Pet created with the given id")
+    @api.response(202, "Update accepted and will be written in the background")
     @api.response(404, "Pet not found")
     @api.response(400, "The posted Pet data was not valid")
     @api.expect(pet_model)
@@ -175,19 +524,50 @@ class PetResource(Resource):
         """
         Update a Pet
 
-        This endpoint will update a Pet based the body that is posted
+        This endpoint will update a Pet based the body that is posted.
+        When PUT_CREATES_PETS is set a Pet that doesn't exist is created
+        with the given id.
         """
         app.logger.info("Request to Update a pet with id [%s]", pet_id)
-        pet = Pet.find(pet_id)
-        if not pet:
+        Pet.check_id(pet_id)
+        pet = Pet.find(pet_id, fresh=True)
+        if not pet and not app.config["PUT_CREATES_PETS"]:
             abort(status.HTTP_404_NOT_FOUND, f"Pet with id '{pet_id}' was not found.")
         app.logger.debug("Payload = %s", api.payload)
         data = api.payload
+        if not pet:
+            created = self.create_with_id(pet_id, data)
+            if created:
+                app.logger.info("Pet with id [%s] created!", created.id)
+                location_url = api.url_for(PetResource, pet_id=created.id, _external=True)
+                return created.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
+            # another request created it first, so this one updates it
+            pet = Pet.find(pet_id, fresh=True)
+            if not pet:
+                abort(status.HTTP_409_CONFLICT, f"Pet with id '{pet_id}' was changed by another request.")
         pet.deserialize(data)
         pet.id = pet_id
+        if Pet.partitioned:
+            pet.place_in_partition()
+        accepted = write_behind(pet_id, pet.serialize())
+        if accepted:
+            return pet.serialize(), status.HTTP_202_ACCEPTED, accepted
         pet.update()
         return pet.serialize(), status.HTTP_200_OK
 
+    @staticmethod
+    def create_with_id(pet_id: str, data: dict) -> Pet:
+        """Creates a Pet with the given id, or returns None if another request created one first"""
+        pet = Pet().deserialize(data)
+        pet.id = pet_id
+        try:
+            saved = pet.create()
+        except DuplicateIdError:
+            return None
+        if not saved:
+            abort(status.HTTP_503_SERVICE_UNAVAILABLE, "The Pet could not be saved, please try again.")
+        return pet
+
     # ------------------------------------------------------------------
     # DELETE A PET
     # ------------------------------------------------------------------
@@ -201,7 +581,7 @@ class PetResource(Resource):
         This endpoint will delete a Pet based the id specified in the path
         """
         app.logger.info("Request to Delete a pet with id [%s]", pet_id)
-        pet = Pet.find(pet_id)
+        pet = Pet.find(pet_id, fresh=True)
         if pet:
             pet.delete()
             app.logger.info("Pet with id [%s] was deleted", pet_id)
@@ -221,37 +601,94 @@ class PetCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc("list_pets")
     @api.expect(pet_args, validate=True)
-    @api.marshal_list_with(pet_model)
+    @api.response(200, "Success", [pet_model])
+    @time_limit(30)
     def get(self):
         """Returns all of the Pets"""
         app.logger.info("Request to list Pets...")
-        pets = []
         args = pet_args.parse_args()
+        # the same lists are asked for over and over while the data rarely changes
+        cache = app.extensions.get("list_cache")
+        key = json.dumps(args, sort_keys=True, default=str)
+        version = Pet.data_version() if cache else None
+        cached = cache.get(key, version) if cache else None
+        if cached is None:
+            pets = self.find_pets(args)
+            app.logger.info("[%s] Pets returned", len(pets))
+            body = json.dumps(api.marshal([pet.serialize() for pet in pets], pet_model)).encode()
+            # a short page is the last one, so there is nothing to continue from
+            cursor = getattr(pets, "bookmark", None) if len(pets) == args["page_size"] else None
+            cached = (body, cursor)
+            # the snapshot can be behind the version the cache entry would be filed under
+            if cache and not getattr(pets, "from_snapshot", False):
+                cache.put(key, version, cached)
+        body, cursor = cached
+        headers = {"X-Next-Cursor": cursor} if cursor else {}
+        return app.response_class(body, status.HTTP_200_OK, headers, mimetype="application/json")
+
+    @staticmethod
+    def page_options(args) -> dict:
+        """Returns the sort and paging options of find_by() for the query arguments"""
+        if request.args.get("order") and not args["sort"]:
+            abort(status.HTTP_400_BAD_REQUEST, "order needs a sort field to sort by.")
+        options = {"sort": args["sort"], "descending": args["order"] == "desc"}
+        if args["cursor"]:
+            if not args["page_size"] or request.args.get("page"):
+                abort(status.HTTP_400_BAD_REQUEST, "cursor takes a page_size and replaces page.")
+            options["bookmark"] = args["cursor"]
+        if args["page_size"]:
+            options["limit"] = args["page_size"]
+            options["skip"] = 0 if args["cursor"] else (args["page"] - 1) * args["page_size"]
+        return options
+
+    @staticmethod
+    def find_pets(args) -> list:
+        """Returns the Pets that match the query arguments"""
+        options = PetCollection.page_options(args)
+        criteria = {field: args[field] for field in ("category", "name", "available") if args[field] not in (None, "")}
+        born = args["born_after"] or args["born_before"]
+        if args["q"]:
+            if criteria or born:
+                abort(status.HTTP_400_BAD_REQUEST, "q searches by name and can't be combined with other filters.")
+            if args["cursor"]:
+                abort(status.HTTP_400_BAD_REQUEST, "Search results are paged with page, not cursor.")
+            app.logger.info("Searching for: %s", args["q"])
+            return Pet.search(args["q"], args["page"], args["page_size"] or 20)
+        if len(criteria) + bool(born) > 1:
+            app.logger.info("Filtering by %s born %s to %s", criteria, args["born_after"], args["born_before"])
+            return Pet.find_matching(criteria, args["born_after"], args["born_before"], **options)
+        return PetCollection.filter_pets(args, options)
+
+    @staticmethod
+    def filter_pets(args, options: dict) -> list:
+        """Returns the Pets that match the one filter in the query arguments"""
         if args["category"]:
             app.logger.info("Filtering by category: %s", args["category"])
-            pets = Pet.find_by_category(args["category"])
+            pets = Pet.find_by_category(args["category"], **options)
         elif args["name"]:
             app.logger.info("Filtering by name: %s", args["name"])
-            pets = Pet.find_by_name(args["name"])
+            pets = Pet.find_by_name(args["name"], **options)
         elif args["available"] is not None:
             app.logger.info("Filtering by availability: %s", args["available"])
-            pets = Pet.find_by_availability(args["available"])
+            pets = Pet.find_by_availability(args["available"], **options)
+        elif args["born_after"] or args["born_before"]:
+            app.logger.info("Filtering by birthday: %s to %s", args["born_after"], args["born_before"])
+            pets = Pet.find_by_birthday_range(args["born_after"], args["born_before"], **options)
         else:
             app.logger.info("Returning unfiltered list.")
-            pets = Pet.all()
-
-        app.logger.info("[%s] Pets returned", len(pets))
-        results = [pet.serialize() for pet in pets]
-        return results, status.HTTP_200_OK
+            pets = Pet.all(**options)
+        return pets
 
     # ------------------------------------------------------------------
     # ADD A NEW PET
     # ------------------------------------------------------------------
     @api.doc("create_pets", security="apikey")
     @api.response(400, "The posted data was not valid")
+    @api.param("Idempotency-Key", "Replays the first response for retries", _in="header")
     @api.expect(create_model)
     @api.marshal_with(pet_model, code=201)
     @token_required
+    @idempotent
     def post(self):
         """
         Creates a Pet
@@ -261,7 +698,8 @@ class PetCollection(Resource):
         pet = Pet()
         app.logger.debug("Payload = %s", api.payload)
         pet.deserialize(api.payload)
-        pet.create()
+        if not pet.create():
+            abort(status.HTTP_503_SERVICE_UNAVAILABLE, "The Pet could not be saved, please try again.")
         app.logger.info("Pet with new id [%s] created!", pet.id)
         location_url = api.url_for(PetResource, pet_id=pet.id, _external=True)
         return pet.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
@@ -271,6 +709,7 @@ class PetCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc("delete_all_pets", security="apikey")
     @api.response(204, "All Pets deleted")
+    @time_limit(60)
     @token_required
     def delete(self):
         """
@@ -288,6 +727,10 @@ class PetCollection(Resource):
         return "", status.HTTP_204_NO_CONTENT
 
 
+# held while a purchase checks that its Pet is available and queues the change
+purchase_lock = threading.Lock()
+
+
 ######################################################################
 #  PATH: /pets/{id}/purchase
 ######################################################################
@@ -298,7 +741,10 @@ class PurchaseResource(Resource):
 
     @api.doc("purchase_pets")
     @api.response(404, "Pet not found")
+    @api.response(202, "Purchase accepted and will be written in the background")
     @api.response(409, "The Pet is not available for purchase")
+    @api.param("Idempotency-Key", "Replays the first response for retries", _in="header")
+    @idempotent
     def put(self, pet_id):
         """
         Purchase a Pet
@@ -306,17 +752,52 @@ class PurchaseResource(Resource):
         This endpoint will purchase a Pet and make it unavailable
         """
         app.logger.info("Request to Purchase a Pet")
-        pet = Pet.find(pet_id)
+        pet = Pet.find(pet_id, fresh=True)
         if not pet:
             abort(status.HTTP_404_NOT_FOUND, f"Pet with id [{pet_id}] was not found.")
-        if not pet.available:
-            abort(status.HTTP_409_CONFLICT, f"Pet with id [{pet_id}] is not available.")
-        pet.available = False
+        writer = app.extensions.get("write_behind")
+        # checking and queuing together, so two purchases can't both find the Pet available
+        with purchase_lock:
+            pending = writer.pending(pet_id) if writer else None
+            if pending:
+                # a purchase that hasn't been written yet still counts
+                pet.available = pending.get("available", pet.available)
+            if not pet.available:
+                abort(status.HTTP_409_CONFLICT, f"Pet with id [{pet_id}] is not available.")
+            pet.available = False
+            accepted = write_behind(pet_id, {"available": False})
+        if accepted:
+            return pet.serialize(), status.HTTP_202_ACCEPTED, accepted
         pet.update()
         app.logger.info("Pet with id [%s] has been purchased!", pet.id)
         return pet.serialize(), status.HTTP_200_OK
 
 
+######################################################################
+#  PATH: /writes/{ticket}
+######################################################################
+@api.route("/writes/<ticket>")
+@api.param("ticket", "The ticket returned with a 202 Accepted response")
+class WriteStatusResource(Resource):
+    """The status of changes that are written in the background"""
+
+    @api.doc("get_write_status")
+    @api.response(404, "Write not found, or no longer remembered by this worker")
+    def get(self, ticket):
+        """
+        Retrieve the status of a write
+
+        The status is pending until the change is written, then done or failed.
+        Only the worker that accepted the change knows its status, and only
+        until it has finished the next 10000 changes or restarts.
+        """
+        writer = app.extensions.get("write_behind")
+        state = writer.status(ticket) if writer else None
+        if not state:
+            abort(status.HTTP_404_NOT_FOUND, f"Write with ticket [{ticket}] was not found.")
+        return dict(state, ticket=ticket), status.HTTP_200_OK
+
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
@@ -328,6 +809,32 @@ def abort(error_code: int, message: str):
     api.abort(error_code, message)
 
 
+def write_behind(pet_id: str, changes: dict) -> dict:
+    """
+    Queues a change to be written in the background when write behind is on
+
+    Returns the headers for a 202 response, or None if the caller must
+    write the change itself
+    """
+    writer = app.extensions.get("write_behind")
+    ticket = writer.submit(pet_id, changes) if writer else None
+    if not ticket:
+        return None
+    app.logger.info("Change to Pet with id [%s] queued as [%s]", pet_id, ticket)
+    return {"Location": api.url_for(WriteStatusResource, ticket=ticket, _external=True)}
+
+
 def data_reset():
     """Removes all Pets from the database"""
     Pet.remove_all()
+
+
+def cache_spec():
+    """Builds the OpenAPI spec once and serves it from memory from then on"""
+    with app.test_request_context():
+        spec = json.dumps(api.__schema__, sort_keys=True).encode()
+    encoders = compression.get_encoders(app.config.get("COMPRESS_LEVEL", 6))
+    asset = compression.StaticAsset(spec, "application/json", encoders)
+    max_age = app.config.get("SPEC_MAX_AGE", 86400)
+    app.view_functions["specs"] = lambda: compression.send_asset(asset, max_age)
+    return asset
@@ -0,0 +1,45 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+# spell: ignore xdist dbname
+"""
+Test Fixtures
+
+Each pytest-xdist worker gets a database of its own so the test suites
+can run in parallel with:
+pytest -n auto
+"""
+
+import os
+import pytest
+
+# This must be set before the service configuration is imported
+WORKER_ID = os.getenv("PYTEST_XDIST_WORKER", "main")
+TEST_DBNAME = f"test_{WORKER_ID}"
+os.environ["CLOUDANT_DBNAME"] = TEST_DBNAME
+
+
+@pytest.fixture(scope="session", autouse=True)
+def test_database():
+    """Creates the database for this worker and drops it when the session ends"""
+    # pylint: disable=import-outside-toplevel
+    from service.models import Pet
+
+    Pet.init_db(TEST_DBNAME)
+    yield TEST_DBNAME
+    # a test may have disconnected the client so connect again before dropping
+    Pet.init_db(TEST_DBNAME)
+    Pet.client.delete_database(TEST_DBNAME)
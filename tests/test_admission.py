@@ -0,0 +1,119 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Admission Test Suite
+
+Test cases can be run with the following:
+pytest tests/test_admission.py
+"""
+
+import threading
+from unittest import TestCase
+from flask import Flask, request
+from service import config
+from service.common.admission import AdaptiveLimit, init_admission
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestAdaptiveLimit(TestCase):
+    """Adaptive Limit tests"""
+
+    def test_limit(self):
+        """It should turn requests away once the limit is reached"""
+        limit = AdaptiveLimit(2)
+        self.assertTrue(limit.try_acquire())
+        self.assertTrue(limit.try_acquire())
+        self.assertFalse(limit.try_acquire())
+        limit.release(10)
+        self.assertTrue(limit.try_acquire())
+        stats = limit.stats()
+        self.assertEqual((stats["in_flight"], stats["admitted"], stats["shed"]), (2, 3, 1))
+        self.assertEqual(stats["limit"], 2)
+
+    def test_shrink_when_slow(self):
+        """It should shrink the limit once for requests that were slow together"""
+        limit = AdaptiveLimit(20, target=0.5)
+        for _ in range(3):
+            limit.try_acquire()
+        for _ in range(3):
+            limit.release(1.0)
+        self.assertEqual(limit.stats()["limit"], 18)
+
+    def test_grow_back(self):
+        """It should let the limit grow back while requests are on time"""
+        limit = AdaptiveLimit(4, target=0.5)
+        limit.limit = 2.0
+        for _ in range(10):
+            limit.try_acquire()
+            limit.release(0.1)
+        self.assertEqual(limit.stats()["limit"], 4)
+
+    def test_min_limit(self):
+        """It should never shrink below the minimum"""
+        limit = AdaptiveLimit(2, target=0.01, min_limit=1)
+        for _ in range(20):
+            limit.try_acquire()
+            limit._decreased = 0.0  # pylint: disable=protected-access
+            limit.release(1.0)
+        self.assertEqual(limit.stats()["limit"], 1)
+
+
+class TestAdmissionControl(TestCase):
+    """Admission Control tests"""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.from_object(config)
+        self.app.config.update(CONCURRENCY_LOOKUPS=1, CONCURRENCY_SCANS=0)
+        self.inside = threading.Event()
+        self.finish = threading.Event()
+
+        @self.app.route("/<kind>")
+        def work(kind):
+            if kind == "lookup":
+                self.inside.set()
+                self.finish.wait(5)
+            return kind
+
+        self.control = init_admission(self.app, lambda: request.view_args["kind"])
+        self.client = self.app.test_client()
+
+    def test_shed(self):
+        """It should answer 503 with Retry-After when a class is full"""
+        thread = threading.Thread(target=self.client.get, args=("/lookup",))
+        thread.start()
+        self.assertTrue(self.inside.wait(5))
+        resp = self.client.get("/lookup")
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers["Retry-After"], str(config.ADMISSION_RETRY_AFTER))
+        self.assertEqual(resp.get_json()["error"], "Service Unavailable")
+        # other classes are not held up
+        self.assertEqual(self.client.get("/query").status_code, 200)
+        self.finish.set()
+        thread.join()
+        self.assertEqual(self.client.get("/lookup").status_code, 200)
+        stats = self.control.stats()
+        self.assertEqual((stats["lookup"]["admitted"], stats["lookup"]["shed"]), (2, 1))
+        self.assertEqual(stats["lookup"]["in_flight"], 0)
+
+    def test_unlimited(self):
+        """It should let in classes without a limit"""
+        self.assertNotIn("scan", self.control.stats())
+        self.assertEqual(self.client.get("/scan").status_code, 200)
+        self.assertEqual(self.client.get("/other").status_code, 200)
@@ -0,0 +1,207 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Balancer Test Suite
+
+Test cases can be run with the following:
+pytest tests/test_balancer.py
+"""
+
+import time
+import socket
+import threading
+from unittest import TestCase
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import requests
+from service.common import deadline
+from service.common.balancer import BalancingAdapter, is_idempotent
+
+
+class NodeHandler(BaseHTTPRequestHandler):
+    """Answers with the name of the node after its delay"""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Answers a read"""
+        self.answer()
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Answers a write"""
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.answer()
+
+    def answer(self):
+        """Sends the node's status and name"""
+        time.sleep(self.server.delay)
+        body = self.server.name.encode()
+        self.send_response(self.server.status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Keeps the test output quiet"""
+
+
+def start_node(name: str, delay: float = 0.0, status: int = 200) -> ThreadingHTTPServer:
+    """Starts a node on a free port"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), NodeHandler)
+    server.daemon_threads = True
+    server.name, server.delay, server.status = name, delay, status
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def dead_url() -> str:
+    """Returns the url of a port that nobody listens on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestBalancer(TestCase):
+    """Balancer tests"""
+
+    def setUp(self):
+        self.servers = []
+        self.session = requests.Session()
+
+    def tearDown(self):
+        deadline.clear()
+        self.session.close()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def _node(self, name: str, delay: float = 0.0, status: int = 200) -> str:
+        server = start_node(name, delay, status)
+        self.servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    def _balance(self, urls: list, **kwargs) -> BalancingAdapter:
+        adapter = BalancingAdapter(urls, retries=0, **kwargs)
+        self.session.mount("http://", adapter)
+        self.primary = urls[0]  # pylint: disable=attribute-defined-outside-init
+        return adapter
+
+    def _get(self, path: str = "/petshop/1") -> requests.Response:
+        return self.session.get(self.primary + path)
+
+    def test_spread_requests(self):
+        """It should spread requests over the nodes"""
+        adapter = self._balance([self._node("a"), self._node("b")])
+        names = {self._get().text for _ in range(4)}
+        self.assertEqual(names, {"a", "b"})
+        self.assertEqual([node["requests"] for node in adapter.stats()["nodes"].values()], [2, 2])
+
+    def test_dead_node(self):
+        """It should fail over from a node that can't be reached and leave it out"""
+        adapter = self._balance([dead_url(), self._node("b")])
+        self.assertEqual([self._get().text for _ in range(3)], ["b", "b", "b"])
+        dead = list(adapter.stats()["nodes"].values())[0]
+        self.assertEqual(dead["failures"], 1)
+        self.assertFalse(dead["healthy"])
+
+    def test_write_fails_over_when_not_sent(self):
+        """It should send a write to another node when the first refused the connection"""
+        self._balance([dead_url(), self._node("b")])
+        self.assertEqual(self.session.post(self.primary + "/petshop", json={}).text, "b")
+
+    def test_every_node_dead(self):
+        """It should raise the error when no node can be reached"""
+        self._balance([dead_url(), dead_url()])
+        self.assertRaises(requests.ConnectionError, self._get)
+
+    def test_unhealthy_status(self):
+        """It should read from another node when one answers 503"""
+        adapter = self._balance([self._node("a", status=503), self._node("b")])
+        self.assertEqual(self._get().text, "b")
+        self.assertEqual(self._get().text, "b")
+        self.assertEqual(list(adapter.stats()["nodes"].values())[0]["failures"], 1)
+
+    def test_recovery(self):
+        """It should try a node again once it has cooled down"""
+        adapter = self._balance([dead_url(), self._node("b")], cooldown=0.0)
+        self._get()
+        adapter.nodes[0].scheme, adapter.nodes[0].netloc = adapter.nodes[1].scheme, adapter.nodes[1].netloc
+        self._get()
+        self._get()
+        self.assertTrue(list(adapter.stats()["nodes"].values())[0]["healthy"])
+
+    def test_hedge_slow_read(self):
+        """It should answer a slow read from the second node"""
+        adapter = self._balance([self._node("slow", delay=1.0), self._node("fast")], hedge_delay=0.05)
+        adapter.nodes[1].in_flight = 1  # make the slow node the first choice
+        started = time.monotonic()
+        self.assertEqual(self._get().text, "fast")
+        self.assertLess(time.monotonic() - started, 0.5)
+        stats = adapter.stats()
+        self.assertEqual((stats["hedges"], stats["hedge_wins"]), (1, 1))
+
+    def test_no_hedge_for_fast_read(self):
+        """It should not hedge reads that answer in time"""
+        adapter = self._balance([self._node("a"), self._node("b")], hedge_delay=0.5)
+        self._get()
+        self.assertEqual(adapter.stats()["hedges"], 0)
+
+    def test_hedge_after_failure(self):
+        """It should read from the other node when the hedged one fails"""
+        self._balance([dead_url(), self._node("b")], hedge_delay=0.05)
+        self.assertEqual(self._get().text, "b")
+
+    def test_writes_are_not_hedged(self):
+        """It should send a write to one node only"""
+        adapter = self._balance([self._node("slow", delay=0.2), self._node("fast")], hedge_delay=0.01)
+        adapter.nodes[1].in_flight = 1
+        self.assertEqual(self.session.put(self.primary + "/petshop/1", json={}).status_code, 501)
+        self.assertEqual(adapter.stats()["hedges"], 0)
+
+    def test_deadline(self):
+        """It should give up on a slow node at the deadline without blaming it"""
+        adapter = self._balance([self._node("slow", delay=1.0)])
+        deadline.start(0.2)
+        started = time.monotonic()
+        self.assertRaises(deadline.DeadlineExceeded, self._get)
+        self.assertLess(time.monotonic() - started, 0.8)
+        node = list(adapter.stats()["nodes"].values())[0]
+        self.assertEqual((node["in_flight"], node["failures"]), (0, 0))
+        self.assertRaises(deadline.DeadlineExceeded, self._get)
+        self.assertEqual(node["requests"], 1)
+
+    def test_deadline_for_hedges(self):
+        """It should hold hedged reads to the caller's deadline"""
+        self._balance([self._node("a", delay=1.0), self._node("b", delay=1.0)], hedge_delay=0.05)
+        deadline.start(0.2)
+        started = time.monotonic()
+        self.assertRaises(deadline.DeadlineExceeded, self._get)
+        self.assertLess(time.monotonic() - started, 0.8)
+
+    def test_idempotent(self):
+        """It should only treat reads as safe to send twice"""
+        self.assertTrue(is_idempotent(requests.Request("GET", "http://a/db/1").prepare()))
+        self.assertTrue(is_idempotent(requests.Request("POST", "http://a/db/_find").prepare()))
+        self.assertFalse(is_idempotent(requests.Request("POST", "http://a/db").prepare()))
+        self.assertFalse(is_idempotent(requests.Request("PUT", "http://a/db/1").prepare()))
+
+    def test_close(self):
+        """It should stop the hedging threads when closed"""
+        adapter = self._balance([self._node("a"), self._node("b")], hedge_delay=0.5)
+        self._get()
+        adapter.close()
+        self.assertIsNone(adapter._executor)
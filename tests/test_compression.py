@@ -0,0 +1,108 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+# spell: ignore brotli
+"""
+Compression Test Suite
+
+Test cases can be run with the following:
+pytest tests/test_compression.py
+"""
+
+import gzip
+from unittest import TestCase
+from unittest.mock import patch
+from flask import Flask, jsonify
+from service.common import status, compression
+
+BIG_LIST = [{"name": f"pet{i}", "category": "dog"} for i in range(100)]
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestCompression(TestCase):
+    """Compression tests"""
+
+    def setUp(self):
+        app = Flask("service")
+        app.config["COMPRESS_MIN_SIZE"] = 1024
+        app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 3600
+        app.add_url_rule("/big", "big", lambda: jsonify(BIG_LIST))
+        app.add_url_rule("/small", "small", lambda: jsonify({"name": "fido"}))
+        app.add_url_rule("/missing", "missing", lambda: (jsonify(BIG_LIST), 404))
+        app.add_url_rule("/", "index", lambda: compression.send_static_asset("index.html"))
+        app.add_url_rule("/image", "image", lambda: compression.send_static_asset("images/pet-shop.png"))
+        compression.init_compression(app)
+        self.client = app.test_client()
+
+    def test_compress_large_response(self):
+        """It should gzip responses above the size threshold"""
+        resp = self.client.get("/big", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        self.assertIn(b"pet99", gzip.decompress(resp.data))
+
+    def test_small_response_not_compressed(self):
+        """It should not compress responses below the size threshold"""
+        resp = self.client.get("/small", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(resp.get_json()["name"], "fido")
+
+    def test_no_accept_encoding(self):
+        """It should not compress for clients that don't accept it"""
+        resp = self.client.get("/big")
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(len(resp.get_json()), 100)
+
+    def test_errors_not_compressed(self):
+        """It should not compress error responses"""
+        resp = self.client.get("/missing", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", resp.headers)
+
+    @patch("service.common.compression.brotli")
+    def test_prefer_brotli(self, brotli_mock):
+        """It should prefer brotli when it is installed"""
+        brotli_mock.compress.return_value = b"brotli"
+        resp = self.client.get("/big", headers={"Accept-Encoding": "gzip, br"})
+        self.assertEqual(resp.headers["Content-Encoding"], "br")
+        self.assertEqual(resp.data, b"brotli")
+
+    def test_static_asset(self):
+        """It should serve precompressed static files with cache headers"""
+        resp = self.client.get("/", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn(b"Pet Shop", gzip.decompress(resp.data))
+        self.assertIn("max-age", resp.headers["Cache-Control"])
+        etag = resp.headers["ETag"]
+        resp = self.client.get("/", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_static_asset_identity(self):
+        """It should serve static files uncompressed when asked to"""
+        resp = self.client.get("/")
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertIn(b"Pet Shop", resp.data)
+
+    def test_static_asset_not_compressible(self):
+        """It should let Flask serve files that are not worth compressing"""
+        resp = self.client.get("/image", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "image/png")
+        self.assertNotIn("Content-Encoding", resp.headers)
+        resp.close()
@@ -0,0 +1,141 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Deadline Test Suite
+
+Test cases can be run with the following:
+pytest tests/test_deadline.py
+"""
+
+import time
+import threading
+import contextvars
+from unittest import TestCase
+from service.common import deadline
+from service.common.deadline import DeadlineExceeded, retry
+from service.common.rate_limit import Governor
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestDeadline(TestCase):
+    """Deadline tests"""
+
+    def tearDown(self):
+        deadline.clear()
+
+    def test_no_deadline(self):
+        """It should leave calls alone when there is no deadline"""
+        self.assertIsNone(deadline.remaining())
+        self.assertFalse(deadline.expired())
+        deadline.check()
+        self.assertEqual(deadline.bounded(5), 5)
+        self.assertIsNone(deadline.bounded(None))
+
+    def test_remaining(self):
+        """It should count down to the deadline"""
+        deadline.start(10)
+        self.assertAlmostEqual(deadline.remaining(), 10, delta=0.5)
+        self.assertLessEqual(deadline.bounded(None), 10)
+        self.assertEqual(deadline.bounded(2), 2)
+        self.assertEqual(deadline.bounded((1, None))[0], 1)
+        self.assertLessEqual(deadline.bounded((1, None))[1], 10)
+
+    def test_expired(self):
+        """It should raise DeadlineExceeded once the deadline has passed"""
+        deadline.start(0)
+        self.assertTrue(deadline.expired())
+        self.assertRaises(DeadlineExceeded, deadline.check)
+        deadline.clear()
+        deadline.check()
+
+    def test_other_threads(self):
+        """It should only apply to threads that were given the context"""
+        deadline.start(0)
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(deadline.expired()))
+        thread.start()
+        thread.join()
+        thread = threading.Thread(target=contextvars.copy_context().run, args=(lambda: seen.append(deadline.expired()),))
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [False, True])
+
+    def test_retry(self):
+        """It should retry until the function works"""
+        calls = []
+
+        @retry(KeyError, tries=3, delay=0.01, backoff=2)
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise KeyError("flaky")
+            return "done"
+
+        self.assertEqual(flaky(), "done")
+        self.assertEqual(len(calls), 3)
+
+    def test_retry_runs_out_of_tries(self):
+        """It should raise the error after the last try"""
+        calls = []
+
+        @retry(KeyError, tries=2)
+        def broken():
+            calls.append(1)
+            raise KeyError("broken")
+
+        self.assertRaises(KeyError, broken)
+        self.assertEqual(len(calls), 2)
+
+    def test_retry_gives_up(self):
+        """It should not retry errors that another try would only repeat"""
+        calls = []
+
+        @retry(KeyError, tries=10, delay=1, giveup=lambda error: str(error) == "'bad'")
+        def broken():
+            calls.append(1)
+            raise KeyError("bad")
+
+        self.assertRaises(KeyError, broken)
+        self.assertEqual(len(calls), 1)
+
+    def test_retry_stops_at_deadline(self):
+        """It should not wait past the deadline to try again"""
+        calls = []
+
+        @retry(KeyError, tries=10, delay=1, backoff=2)
+        def broken():
+            calls.append(1)
+            raise KeyError("broken")
+
+        deadline.start(0.5)
+        started = time.monotonic()
+        self.assertRaises(DeadlineExceeded, broken)
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(len(calls), 1)
+
+    def test_rate_limit(self):
+        """It should not wait for a token that comes after the deadline"""
+        governor = Governor({"query": 1})
+        deadline.start(0.5)
+        governor.acquire("query")
+        started = time.monotonic()
+        self.assertRaises(DeadlineExceeded, governor.acquire, "query")
+        self.assertLess(time.monotonic() - started, 0.1)
+        deadline.start(0)
+        self.assertRaises(DeadlineExceeded, governor.acquire, "write")
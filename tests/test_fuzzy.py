@@ -0,0 +1,52 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+# spell: ignore Levenshtein
+"""
+Fuzzy Matching Test Suite
+
+Test cases can be run with the following:
+pytest tests/test_fuzzy.py
+"""
+
+from unittest import TestCase
+from service.common.fuzzy import edit_distance, match_rank
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestFuzzy(TestCase):
+    """Fuzzy Matching tests"""
+
+    def test_edit_distance(self):
+        """It should count the edits between two strings"""
+        self.assertEqual(edit_distance("fido", "fido"), 0)
+        self.assertEqual(edit_distance("fido", "fdo"), 1)
+        self.assertEqual(edit_distance("kitten", "sitting"), 3)
+        self.assertEqual(edit_distance("", "rex"), 3)
+
+    def test_match_rank(self):
+        """It should rank exact matches before prefixes before typos"""
+        self.assertEqual(match_rank("fido", "fido"), 0)
+        self.assertEqual(match_rank("fid", "fido"), 1)
+        self.assertEqual(match_rank("fdo", "fido"), 2)
+        self.assertIsNone(match_rank("rex", "fido"))
+
+    def test_short_terms_are_exact(self):
+        """It should not forgive typos in very short terms"""
+        self.assertIsNone(match_rank("fx", "fido"))
+        self.assertEqual(match_rank("fi", "fido"), 1)
@@ -0,0 +1,54 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+# spell: ignore ULID
+"""
+Document Ids Test Suite
+
+Test cases can be run with the following:
+pytest tests/test_ids.py
+"""
+
+from unittest import TestCase
+from unittest.mock import patch
+from service.common.ids import ulid, ALPHABET
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestIds(TestCase):
+    """Document Ids tests"""
+
+    def test_ulid_format(self):
+        """It should make 26 character ids from the Crockford alphabet"""
+        value = ulid()
+        self.assertEqual(len(value), 26)
+        self.assertTrue(set(value) <= set(ALPHABET))
+
+    def test_ulid_sorts_by_time(self):
+        """It should make ids that sort in the order they were made"""
+        ids = [ulid() for _ in range(1000)]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), 1000)
+
+    @patch("service.common.ids.time.time_ns")
+    def test_ulid_clock_goes_back(self, time_mock):
+        """It should keep ids in order when the clock goes back"""
+        time_mock.return_value = 2_000_000_000_000_000_000
+        first = ulid()
+        time_mock.return_value = 1_000_000_000_000_000_000
+        self.assertGreater(ulid(), first)
@@ -0,0 +1,141 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Log Handlers Test Suite
+
+Test cases can be run with the following:
+pytest tests/test_log_handlers.py
+"""
+
+import queue
+import logging
+from unittest import TestCase
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask
+from service.common import log_handlers
+from service.common.log_handlers import LazyQueueHandler, SamplingFilter
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLogHandlers(TestCase):
+    """Log Handlers tests"""
+
+    def setUp(self):
+        # other suites disable logging while they run
+        self.disabled = logging.root.manager.disable
+        logging.disable(logging.NOTSET)
+        self.app = Flask(__name__)
+        self.stream = ListHandler()
+        self.gunicorn_logger = logging.getLogger("test.gunicorn")
+        self.gunicorn_logger.handlers = [self.stream]
+        self.gunicorn_logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        log_handlers._stop_listener()
+        log_handlers._listener = None
+        self.gunicorn_logger.handlers = []
+        logging.disable(self.disabled)
+
+    def test_init_logging_queues_records(self):
+        """It should write log records through the queue listener"""
+        log_handlers.init_logging(self.app, "test.gunicorn")
+        self.assertIsInstance(self.app.logger.handlers[0], LazyQueueHandler)
+        self.app.logger.info("Hello %s", "world")
+        log_handlers._stop_listener()
+        self.assertIn("Hello world", self.stream.messages[-1])
+        self.assertIn("[INFO]", self.stream.messages[-1])
+
+    def test_init_logging_without_handlers(self):
+        """It should not queue records when there is nowhere to write them"""
+        self.gunicorn_logger.handlers = []
+        log_handlers.init_logging(self.app, "test.gunicorn")
+        self.assertEqual(self.app.logger.handlers, [])
+        self.assertIsNone(log_handlers._listener)
+
+    def test_restart_listener(self):
+        """It should start the listener again after a fork"""
+        log_handlers.init_logging(self.app, "test.gunicorn")
+        log_handlers._stop_listener()
+        log_handlers._restart_listener()
+        self.app.logger.info("After fork")
+        log_handlers._stop_listener()
+        self.assertIn("After fork", self.stream.messages[-1])
+        log_handlers._listener = None
+
+    def test_restart_listener_on_new_queue(self):
+        """It should not use a queue that was locked when the worker was forked"""
+        log_handlers.init_logging(self.app, "test.gunicorn")
+        log_handlers._stop_listener()
+        inherited = self.app.logger.handlers[0].queue
+        with inherited.mutex:
+            log_handlers._restart_listener()
+            self.app.logger.info("After fork")
+            log_handlers._stop_listener()
+        self.assertIsNot(self.app.logger.handlers[0].queue, inherited)
+        self.assertIn("After fork", self.stream.messages[-1])
+        log_handlers._listener = None
+
+    def test_full_queue_drops_records(self):
+        """It should drop records instead of blocking when the queue is full"""
+        handler = LazyQueueHandler(queue.Queue(1))
+        logger = logging.getLogger("test.full")
+        logger.propagate = False
+        logger.handlers = [handler]
+        logger.warning("one")
+        logger.warning("two")
+        self.assertEqual(handler.dropped, 1)
+        record = handler.queue.get_nowait()
+        self.assertEqual(record.getMessage(), "one")
+
+    def test_sampling_filter(self):
+        """It should keep one in every N info records of a message"""
+        sampler = SamplingFilter(10)
+        info = [logging.makeLogRecord({"msg": "row %s", "levelno": logging.INFO}) for _ in range(100)]
+        self.assertEqual(sum(sampler.filter(record) for record in info), 10)
+        warning = logging.makeLogRecord({"msg": "row %s", "levelno": logging.WARNING})
+        self.assertTrue(sampler.filter(warning))
+
+    def test_sampling_is_bounded(self):
+        """It should forget the counts after the window or when too many messages are counted"""
+        sampler = SamplingFilter(10, window=60, max_messages=3)
+        for number in range(10):
+            sampler.filter(logging.makeLogRecord({"msg": f"message {number}", "levelno": logging.INFO}))
+        self.assertLessEqual(len(sampler.counts), 3)
+        sampler.window = 0
+        sampler.filter(logging.makeLogRecord({"msg": "again", "levelno": logging.INFO}))
+        self.assertEqual(sampler.counts, {"again": 1})
+
+    def test_sampling_from_threads(self):
+        """It should count records from many threads exactly"""
+        sampler = SamplingFilter(10)
+        record = logging.makeLogRecord({"msg": "row %s", "levelno": logging.INFO})
+        with ThreadPoolExecutor(8) as executor:
+            passed = sum(executor.map(lambda _: sampler.filter(record), range(1000)))
+        self.assertEqual(passed, 100)
+
+
+class ListHandler(logging.Handler):
+    """Collects formatted records in a list"""
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
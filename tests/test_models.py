@@ -22,12 +22,20 @@ nosetests -v --with-spec --spec-color
 nosetests --stop tests/test_pets.py:TestPets
 """
 
+import os
+import time
+import shutil
 import logging
+import tempfile
+import threading
 from datetime import date
+from concurrent.futures import ThreadPoolExecutor
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 from requests import HTTPError, ConnectionError  # pylint: disable=redefined-builtin
+from service import config
 from service.models import Pet, Gender, DataValidationError, DatabaseConnectionError
+from service.common.rate_limit import Governor
 from tests.factories import PetFactory
 
 # cspell:ignore VCAP SQLDB
@@ -64,7 +72,7 @@ class BaseTestCase(TestCase):
 
     def setUp(self):
         """Initialize the Cloudant database"""
-        Pet.init_db("test")
+        Pet.init_db(config.CLOUDANT_DBNAME)
         Pet.remove_all()
 
     def _create_pets(self, count: int) -> list:
@@ -196,13 +204,46 @@ class TestPetModelFalures(BaseTestCase):
         pet = Pet(None, "cat")
         self.assertRaises(DataValidationError, pet.create)
 
+    def test_create_with_bad_id(self):
+        """It should not create a Pet with an id CouchDB keeps for itself"""
+        pet = PetFactory()
+        pet.id = "_design"
+        self.assertRaises(DataValidationError, pet.create)
+        self.assertEqual(pet.id, "_design")
+
+    @patch("service.models.ID_STRATEGY", "ulid")
+    def test_create_with_time_ordered_ids(self):
+        """It should create Pets with ids that sort in the order they were made"""
+        pets = self._create_pets(5)
+        ids = [pet.id for pet in pets]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual([pet.id for pet in Pet.all()], ids)
+
+    def test_create_is_idempotent(self):
+        """It should treat creating the same Pet with the same id again as done"""
+        pet = PetFactory()
+        pet.id = "fido-1"
+        pet.create()
+        pet.create()
+        self.assertEqual(pet.id, "fido-1")
+        self.assertEqual(len(Pet.all()), 1)
+
+    def test_create_duplicate_id(self):
+        """It should not create a Pet with the id of a different Pet"""
+        pet = PetFactory()
+        pet.id = "fido-1"
+        pet.create()
+        other = PetFactory(name=pet.name + "-other")
+        other.id = "fido-1"
+        self.assertRaises(DataValidationError, other.create)
+
     def test_create_a_pet_with_no_name(self):
         """It should not create a Pet with no name"""
         pet = Pet(None, "cat")
         self.assertRaises(DataValidationError, pet.create)
 
 
-class TestPetModelQueries(BaseTestCase):
+class TestPetModelQueries(BaseTestCase):  # pylint: disable=too-many-public-methods
     """Query Test Cases for Pet Model"""
 
     def test_find_pet(self):
@@ -280,56 +321,547 @@ class TestPetModelQueries(BaseTestCase):
         for pet in found_pets:
             self.assertEqual(pet.gender, gender)
 
+    def test_find_coalesces_concurrent_lookups(self):
+        """It should share one database call between concurrent finds"""
+        pet = self._create_pets(1)[0]
+        fetch = Pet._fetch
+
+        def slow_fetch(pet_id):
+            time.sleep(0.2)
+            return fetch(pet_id)
+
+        shared = Pet.flight.shared
+        with patch.object(Pet, "_fetch", side_effect=slow_fetch) as fetch_mock:
+            with ThreadPoolExecutor(5) as executor:
+                found = list(executor.map(Pet.find, [pet.id] * 5))
+        self.assertEqual(fetch_mock.call_count, 1)
+        self.assertEqual(Pet.flight.shared - shared, 4)
+        self.assertEqual({found_pet.name for found_pet in found}, {pet.name})
+        # every caller must get its own Pet
+        self.assertEqual(len({id(found_pet) for found_pet in found}), 5)
+        self.assertIn("coalescing_rate", Pet.metrics()["single_flight"])
+
     def test_create_query_index(self):
         """It should create a query index"""
         self._create_pets(5)
         Pet.create_query_index("category")
 
+    def test_find_by_birthday_range(self):
+        """It should find Pets born between two days"""
+        for day in (1, 10, 20):
+            PetFactory(birthday=date(2020, 1, day)).create()
+        pets = Pet.find_by_birthday_range(date(2020, 1, 1), date(2020, 1, 20))
+        self.assertEqual([pet.birthday for pet in pets], [date(2020, 1, 10)])
+        self.assertEqual(len(Pet.find_by_birthday_range(born_after=date(2020, 1, 5))), 2)
+        self.assertEqual(len(Pet.find_by_birthday_range()), 3)
+
+    def test_find_matching(self):
+        """It should find Pets that match several filters at once"""
+        for name, category, day in (("Rex", "dog", 1), ("Ace", "dog", 10), ("Max", "cat", 10)):
+            PetFactory(name=name, category=category, birthday=date(2020, 1, day)).create()
+        pets = Pet.find_matching({"category": "dog"}, born_after=date(2020, 1, 5))
+        self.assertEqual([pet.name for pet in pets], ["Ace"])
+        pets = Pet.find_matching({"category": "dog", "name": "Rex"}, sort="name")
+        self.assertEqual([pet.name for pet in pets], ["Rex"])
+        self.assertEqual(len(Pet.find_matching({}, born_before=date(2020, 1, 20))), 3)
+
+    def test_sorted_pages(self):
+        """It should sort and page Pets in the database"""
+        for name, category in (("Rex", "dog"), ("Ace", "dog"), ("Max", "cat"), ("Bo", "dog")):
+            PetFactory(name=name, category=category).create()
+        self.assertEqual([pet.name for pet in Pet.all(sort="name")], ["Ace", "Bo", "Max", "Rex"])
+        self.assertEqual([pet.name for pet in Pet.all(limit=2, skip=3)], [Pet.all()[3].name])
+        pets = Pet.find_by_category("dog", sort="name", descending=True, limit=2)
+        self.assertEqual([pet.name for pet in pets], ["Rex", "Bo"])
+
+    def test_pages_from_bookmark(self):
+        """It should read the next page from where the one before ended"""
+        for name in ("Rex", "Ace", "Max", "Bo"):
+            PetFactory(name=name).create()
+        first = Pet.all(sort="name", limit=3)
+        self.assertEqual([pet.name for pet in first], ["Ace", "Bo", "Max"])
+        rest = Pet.all(sort="name", limit=3, bookmark=first.bookmark)
+        self.assertEqual([pet.name for pet in rest], ["Rex"])
+        self.assertRaises(DataValidationError, Pet.all, sort="name", bookmark=first.bookmark)
+
+    def test_sorted_in_memory(self):
+        """It should sort in memory when no index can"""
+        for name in ("Rex", "Ace", "Max"):
+            PetFactory(name=name, available=True, gender=Gender.MALE).create()
+        pets = Pet.find_by(available=True, gender="MALE", sort="name", limit=2, skip=1)
+        self.assertEqual([pet.name for pet in pets], ["Max", "Rex"])
+        born = Pet.find_by_birthday_range(born_before=date.today(), sort="name", skip=2)
+        self.assertEqual([pet.name for pet in born], ["Rex"])
+
+    def test_apply_changes(self):
+        """It should change many Pets with one bulk request"""
+        pets = self._create_pets(2)
+        errors = Pet.apply_changes(
+            {pets[0].id: {"name": "Fido"}, pets[1].id: {"available": False}, "missing": {"name": "X"}}
+        )
+        self.assertEqual(errors, {"missing": "not_found"})
+        self.assertEqual(Pet.find(pets[0].id).name, "Fido")
+        self.assertFalse(Pet.find(pets[1].id).available)
+
+    def test_apply_changes_conflict(self):
+        """It should read a Pet again when someone else changed it first"""
+        pet = self._create_pets(1)[0]
+        bulk_docs = Pet.database.bulk_docs
+        outcomes = [[{"id": pet.id, "error": "conflict"}]]
+        with patch.object(
+            Pet.database, "bulk_docs", side_effect=lambda docs: outcomes.pop() if outcomes else bulk_docs(docs)
+        ):
+            self.assertEqual(Pet.apply_changes({pet.id: {"name": "Fido"}}), {})
+        self.assertEqual(Pet.find(pet.id).name, "Fido")
+
+    @patch("service.models.RETRY_COUNT", 1)
+    def test_apply_changes_keeps_conflicting(self):
+        """It should give up on a Pet that keeps changing"""
+        pet = self._create_pets(1)[0]
+        with patch.object(Pet.database, "bulk_docs", return_value=[{"id": pet.id, "error": "conflict"}]):
+            self.assertEqual(Pet.apply_changes({pet.id: {"name": "Fido"}}), {pet.id: "conflict"})
+        with patch.object(Pet.database, "bulk_docs", return_value=[{"id": pet.id, "error": "forbidden"}]):
+            self.assertEqual(Pet.apply_changes({pet.id: {"name": "Fido"}}), {pet.id: "forbidden"})
+
+    @patch("service.models.QUERY_PAGE_SIZE", 5)
+    def test_find_by_follows_bookmarks(self):
+        """It should read each matching document only once when paging through a query"""
+        for _ in range(30):
+            PetFactory(category="dog").create()
+        Pet.query_stats.update(pages=0, docs_examined=0)
+        pets = Pet.find_by(category="dog")
+        self.assertEqual(len(pets), 30)
+        self.assertEqual(len({pet.id for pet in pets}), 30)
+        stats = Pet.metrics()["queries"]
+        self.assertEqual(stats["pages"], 7)
+        # paging with skip would scan 5 + 10 + ... + 30 = 105 documents
+        self.assertLessEqual(stats["docs_examined"], 30)
+
+    def test_search(self):
+        """It should rank exact, prefix and fuzzy name matches"""
+        for name in ("Fido", "Fidget", "Fiddo", "Rex"):
+            PetFactory(name=name).create()
+        self.assertEqual([pet.name for pet in Pet.search("fido")], ["Fido"])
+        self.assertEqual([pet.name for pet in Pet.search("fidp")], ["Fiddo", "Fidget", "Fido"])
+        self.assertEqual([pet.name for pet in Pet.search("FID", page=2, page_size=2)], ["Fido"])
+        self.assertEqual(Pet.search("fido", page=3), [])
+        self.assertEqual(Pet.search("  "), [])
+
+    @patch("cloudant.design_document.DesignDocument.save")
+    def test_views_not_rewritten(self, save_mock):
+        """It should not save the design document when the views are current"""
+        Pet.create_views()
+        save_mock.assert_not_called()
+
+    def test_remove_all(self):
+        """It should remove all Pets and keep the query indexes"""
+        self._create_pets(5)
+        Pet.remove_all()
+        self.assertEqual(Pet.all(), [])
+        index_names = [index.name for index in Pet.database.get_query_indexes()]
+        self.assertIn("category", index_names)
+
+    @patch("service.models.Pet.provision")
+    def test_open_existing_database(self, provision_mock):
+        """It should not provision a database that already exists"""
+        Pet.open_database(config.CLOUDANT_DBNAME)
+        provision_mock.assert_not_called()
+        Pet.open_database(f"{config.CLOUDANT_DBNAME}_new")
+        provision_mock.assert_called_once()
+        Pet.client.delete_database(f"{config.CLOUDANT_DBNAME}_new")
+        Pet.open_database(config.CLOUDANT_DBNAME)
+
+    def test_bulk_delete_all(self):
+        """It should delete all Pets in bulk batches"""
+        self._create_pets(5)
+        self.assertEqual(Pet.bulk_delete_all(), 5)
+        self.assertEqual(Pet.all(), [])
+
+    @patch("service.models.SCAN_PAGE_SIZE", 2)
+    def test_scan_in_pages(self):
+        """It should list every Pet when scanning a page at a time"""
+        pets = self._create_pets(5)
+        pages = list(Pet.scan())
+        self.assertGreaterEqual(len(pages), 3)
+        self.assertTrue(all(len(rows) <= 2 for rows in pages))
+        self.assertEqual(sorted(row["id"] for rows in pages for row in rows), sorted(pet.id for pet in pets))
+        self.assertEqual(len(Pet.all()), 5)
+
+    def test_cluster(self):
+        """It should keep working when one of the nodes is down"""
+        url = Pet.client.server_url
+        with patch("service.models.CLOUDANT_URLS", ["http://127.0.0.1:9", url]):
+            Pet.init_db(config.CLOUDANT_DBNAME)
+        pets = self._create_pets(3)
+        self.assertEqual(Pet.find(pets[0].id).name, pets[0].name)
+        self.assertEqual(len(Pet.all()), 3)
+        dead, alive = Pet.metrics()["cluster"]["nodes"].values()
+        self.assertFalse(dead["healthy"])
+        self.assertGreater(alive["requests"], 3)
+
+    def test_rate_limit(self):
+        """It should pace each class of request through its own bucket"""
+        governor = Governor({"lookup": 1000, "write": 1000, "query": 1000})
+        with patch.object(Pet, "governor", governor):
+            pet = PetFactory(category="dog")
+            pet.create()
+            Pet.find(pet.id)
+            Pet.find_by_category("dog")
+            stats = Pet.metrics()["rate_limit"]
+        self.assertEqual(stats["write"]["requests"], 1)
+        self.assertEqual(stats["lookup"]["requests"], 1)
+        self.assertEqual(stats["query"]["requests"], 1)
+
+    def test_lazy_connect(self):
+        """It should not open the database until it is first needed"""
+        Pet.init_db(config.CLOUDANT_DBNAME, connect=False)
+        self.assertIsNone(Pet.database)
+        Pet.ensure_connected()
+        self.assertIsNotNone(Pet.database)
+        pet = PetFactory()
+        pet.create()
+        self.assertIsNotNone(Pet.find(pet.id))
+
+    @patch("cloudant.database.CloudantDatabase.exists")
+    def test_ping_is_cached(self, exists_mock):
+        """It should probe the database at most once per interval"""
+        exists_mock.return_value = True
+        Pet.probed_at = None
+        self.assertTrue(Pet.ping())
+        self.assertTrue(Pet.ping())
+        self.assertEqual(exists_mock.call_count, 1)
+        Pet.probed_at = None
+
+    @patch("cloudant.database.CloudantDatabase.exists")
+    def test_ping_while_probing(self, exists_mock):
+        """It should not report an old answer while another thread is probing"""
+        exists_mock.side_effect = lambda: time.sleep(0.2) or True
+        Pet.probed_at, Pet.reachable = None, False
+        with ThreadPoolExecutor(4) as executor:
+            answers = list(executor.map(lambda _: Pet.ping(), range(4)))
+        self.assertEqual(answers, [True] * 4)
+        self.assertEqual(exists_mock.call_count, 1)
+        Pet.probed_at = None
+
+    @patch("cloudant.database.CloudantDatabase.exists")
+    def test_ping_every_node_down(self, exists_mock):
+        """It should not be ready while every node of the cluster is marked down"""
+        exists_mock.return_value = True
+        Pet.probed_at = None
+        for node in Pet.balancer.nodes:
+            node.down_until = time.monotonic() + 60
+        try:
+            self.assertFalse(Pet.ping())
+        finally:
+            for node in Pet.balancer.nodes:
+                node.down_until = 0.0
+        self.assertTrue(Pet.ping())
+        Pet.probed_at = None
+
     def test_disconnect(self):
         """It should disconnet from database"""
+        # the suites that run next in this worker need a connection
+        self.addCleanup(Pet.init_db, config.CLOUDANT_DBNAME)
         Pet.disconnect()
         pet = PetFactory()
         self.assertRaises(AttributeError, pet.create)
 
 
+class TestPartitionedPets(TestCase):
+    """Test Cases for Pets in a partitioned database"""
+
+    def setUp(self):
+        with patch("service.models.PARTITIONED", True):
+            Pet.init_db(f"{config.CLOUDANT_DBNAME}_partitioned")
+
+    def tearDown(self):
+        Pet.client.delete_database(Pet.dbname)
+        Pet.partitioned = False
+        Pet.init_db(config.CLOUDANT_DBNAME)
+
+    def test_ids_are_prefixed(self):
+        """It should keep each Pet in the partition of its category"""
+        self.assertTrue(Pet.partitioned)
+        pet = PetFactory(category="dog")
+        pet.create()
+        self.assertTrue(pet.id.startswith("dog:"))
+        self.assertEqual(Pet.find(pet.id).name, pet.name)
+
+    def test_find_by_category(self):
+        """It should find Pets by category in their partition"""
+        for category in ("dog", "dog", "cat"):
+            PetFactory(category=category).create()
+        dogs = Pet.find_by_category("dog")
+        self.assertEqual(len(dogs), 2)
+        self.assertTrue(all(pet.id.startswith("dog:") for pet in dogs))
+        self.assertEqual(len(Pet.find_by_name(dogs[0].name)), 1)
+
+    def test_find_by_category_sorted(self):
+        """It should sort Pets in a partition by an index of that partition"""
+        for name in ("rex", "ace", "max"):
+            PetFactory(category="dog", name=name).create()
+        PetFactory(category="cat", name="bob").create()
+        dogs = Pet.find_by_category("dog", sort="name")
+        self.assertEqual([pet.name for pet in dogs], ["ace", "max", "rex"])
+        dogs = Pet.find_by_category("dog", sort="name", descending=True, limit=2)
+        self.assertEqual([pet.name for pet in dogs], ["rex", "max"])
+
+    def test_find_matching(self):
+        """It should find Pets that match several filters in their partition"""
+        for category, available in (("dog", True), ("dog", False), ("cat", True)):
+            PetFactory(category=category, available=available).create()
+        pets = Pet.find_matching({"category": "dog", "available": True})
+        self.assertEqual(len(pets), 1)
+        self.assertTrue(pets[0].id.startswith("dog:"))
+
+    def test_search(self):
+        """It should search names with a global view"""
+        self.assertFalse(Pet.database.get_design_document(Pet.design_id)["options"]["partitioned"])
+        for category in ("dog", "cat"):
+            PetFactory(category=category, name="Fido").create()
+        self.assertEqual(len(Pet.search("fido")), 2)
+
+    def test_supplied_id(self):
+        """It should add the partition to ids that are supplied without one"""
+        pet = PetFactory(category="cat")
+        pet.id = "tom"
+        pet.create()
+        self.assertEqual(pet.id, "cat:tom")
+
+    def test_category_cannot_change(self):
+        """It should not move a Pet to another category"""
+        pet = PetFactory(category="cat")
+        pet.create()
+        pet.category = "dog"
+        self.assertRaises(DataValidationError, pet.update)
+
+    def test_remove_all(self):
+        """It should keep the database partitioned when it is emptied"""
+        PetFactory(category="dog").create()
+        Pet.remove_all()
+        self.assertEqual(Pet.all(), [])
+        self.assertTrue(Pet.database.metadata()["props"]["partitioned"])
+
+    def test_partition_key(self):
+        """It should make partition names that CouchDB accepts"""
+        self.assertEqual(Pet.partition_key("dog"), "dog")
+        self.assertEqual(Pet.partition_key("a:b"), "a%3Ab")
+        self.assertEqual(Pet.partition_key("_x"), "-_x")
+
+
+class TestSnapshotPets(BaseTestCase):
+    """Test Cases for reading Pets from a shared snapshot"""
+
+    def setUp(self):
+        super().setUp()
+        self.folder = tempfile.mkdtemp()
+        Pet.use_snapshot(os.path.join(self.folder, "pets.snapshot"))
+        # refresh by hand instead of on a background thread
+        patcher = patch.object(Pet.snapshot_builder, "start")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        Pet.snapshot = Pet.snapshot_builder = None
+        shutil.rmtree(self.folder)
+
+    def test_not_ready(self):
+        """It should read from the database until there is a snapshot"""
+        pet = PetFactory(category="dog")
+        pet.create()
+        self.assertIsNone(Pet.shared_snapshot())
+        self.assertEqual(len(Pet.find_by_category("dog")), 1)
+
+    def test_find_by_category(self):
+        """It should find Pets in the snapshot as of its last refresh"""
+        for category in ("dog", "dog", "cat"):
+            PetFactory(category=category).create()
+        self.assertTrue(Pet.snapshot_builder.refresh())
+        PetFactory(category="dog").create()
+        self.assertEqual(len(Pet.find_by_category("dog")), 2)
+        self.assertTrue(Pet.snapshot_builder.refresh())
+        self.assertEqual(len(Pet.find_by_category("dog")), 3)
+        self.assertEqual(len(Pet.find_by_category("dog", limit=1)), 1)
+        self.assertFalse(Pet.snapshot_builder.refresh())
+
+    def test_find_by_availability(self):
+        """It should find available Pets in the snapshot"""
+        PetFactory(available=True).create()
+        PetFactory(available=False).create()
+        Pet.snapshot_builder.refresh()
+        pets = Pet.find_by_availability(True)
+        self.assertEqual(len(pets), 1)
+        self.assertTrue(pets[0].available)
+
+    def test_find(self):
+        """It should find a Pet in the snapshot and fall back for new ones"""
+        pet = PetFactory()
+        pet.create()
+        Pet.snapshot_builder.refresh()
+        self.assertEqual(Pet.find(pet.id).name, pet.name)
+        pet.delete()
+        Pet.snapshot_builder.refresh()
+        self.assertIsNone(Pet.find(pet.id))
+        late = PetFactory()
+        late.create()
+        self.assertEqual(Pet.find(late.id).name, late.name)
+
+    def test_find_fresh(self):
+        """It should read a Pet that is about to change from the database"""
+        pet = PetFactory(available=True)
+        pet.create()
+        Pet.snapshot_builder.refresh()
+        pet.available = False
+        pet.update()
+        self.assertTrue(Pet.find(pet.id).available)
+        self.assertFalse(Pet.find(pet.id, fresh=True).available)
+        self.assertIsNone(Pet.find("unknown", fresh=True))
+
+    def test_database_recreated(self):
+        """It should start over when the database is emptied"""
+        self._create_pets(3)
+        Pet.snapshot_builder.refresh()
+        Pet.remove_all()
+        pet = PetFactory(category="dog")
+        pet.create()
+        Pet.snapshot_builder.refresh()
+        self.assertEqual([dog.id for dog in Pet.find_by_category("dog")], [pet.id])
+
+    def test_metrics(self):
+        """It should report the snapshot in the metrics"""
+        Pet.snapshot_builder.refresh()
+        stats = Pet.metrics()["snapshot"]
+        self.assertEqual(stats["refreshes"], 1)
+        self.assertFalse(stats["writer"])
+
+
+class TestConcurrentPets(BaseTestCase):
+    """Test Cases for using Pets from many threads at once"""
+
+    def _exercise(self, number: int) -> str:
+        """Creates a Pet, reads it every way there is, changes it, and maybe deletes it"""
+        pet = PetFactory(name=f"Pet{number}", category="dog", available=True)
+        pet.create()
+        self.assertEqual(Pet.find(pet.id).name, pet.name)
+        pet.available = False
+        pet.update()
+        self.assertFalse(Pet.find(pet.id).available)
+        self.assertIn(pet.id, [dog.id for dog in Pet.find_by_category("dog")])
+        self.assertIn(pet.id, [match.id for match in Pet.find_by_name(pet.name)])
+        self.assertIn(pet.id, [match.id for match in Pet.search(pet.name)])
+        Pet.find_by_availability(False, sort="name", limit=5)
+        Pet.all()
+        Pet.ping()
+        if number % 2:
+            pet.delete()
+            self.assertIsNone(Pet.find(pet.id))
+        return pet.id
+
+    def test_stress(self):
+        """It should keep every Pet method working when called from many threads"""
+        with ThreadPoolExecutor(16) as executor:
+            ids = list(executor.map(self._exercise, range(48)))
+        kept = sorted(pet.id for pet in Pet.all())
+        self.assertEqual(kept, sorted(ids[::2]))
+        self.assertFalse(any(pet.available for pet in Pet.all()))
+
+    def test_shared_login(self):
+        """It should log in once when many threads find the session expired"""
+        release = threading.Event()
+        logins = []
+
+        def slow_login():
+            logins.append(threading.get_ident())
+            release.wait(5)
+
+        Pet.client.r_session.login = slow_login
+        Pet.share_session()
+        with ThreadPoolExecutor(4) as executor:
+            futures = [executor.submit(Pet.client.r_session.login) for _ in range(4)]
+            time.sleep(0.2)
+            release.set()
+            for future in futures:
+                future.result()
+        self.assertEqual(len(logins), 1)
+
+
 class TestPetModelMocks(BaseTestCase):
     """Mock Test Cases for Pet Model"""
 
-    @patch("cloudant.database.CloudantDatabase.create_document")
+    @patch("cloudant.document.Document.create")
     def test_http_error(self, bad_mock):
         """It should not create with HTTP error"""
         bad_mock.side_effect = HTTPError()
         pet = PetFactory()
-        pet.create()
+        self.assertFalse(pet.create())
         self.assertIsNone(pet.id)
 
+    @patch("service.models.Pet._query")
+    def test_bad_request_not_retried(self, query_mock):
+        """It should not retry a query the database turned down as malformed"""
+        query_mock.side_effect = HTTPError(response=MagicMock(status_code=400))
+        with patch("service.models.Pet.partitioned", True):
+            self.assertRaises(HTTPError, Pet.find_by_category, "dog", sort="name")
+        query_mock.assert_called_once()
+
     @patch("cloudant.document.Document.exists")
-    def test_document_not_exist(self, bad_mock):
-        """It should handle a bad document"""
-        bad_mock.return_value = False
+    def test_create_in_one_round_trip(self, exists_mock):
+        """It should create a Pet without checking that it exists afterwards"""
+        pet = PetFactory()
+        pet.create()
+        self.assertIsNotNone(pet.id)
+        exists_mock.assert_not_called()
+
+    @patch("service.models.ID_STRATEGY", "ulid")
+    @patch("cloudant.document.Document.create")
+    def test_http_error_with_ulid(self, bad_mock):
+        """It should not keep a generated id when create fails"""
+        bad_mock.side_effect = HTTPError()
         pet = PetFactory()
         pet.create()
         self.assertIsNone(pet.id)
 
-    @patch("cloudant.database.CloudantDatabase.__getitem__")
-    def test_key_error_on_update(self, bad_mock):
+    def test_key_error_on_update(self):
         """It should  throw a KeyError on update"""
-        bad_mock.side_effect = KeyError()
         pet = PetFactory()
         pet.create()
         pet.name = "Rumpelstiltskin"
-        pet.update()
+        with patch("cloudant.document.Document.fetch") as bad_mock:
+            bad_mock.side_effect = HTTPError(response=MagicMock(status_code=404))
+            pet.update()
 
-    @patch("cloudant.database.CloudantDatabase.__getitem__")
-    def test_key_error_on_delete(self, bad_mock):
+    def test_key_error_on_delete(self):
         """It should throw a KeyError on delete"""
-        bad_mock.side_effect = KeyError()
         pet = PetFactory()
         pet.create()
-        pet.delete()
+        with patch("cloudant.document.Document.fetch") as bad_mock:
+            bad_mock.side_effect = HTTPError(response=MagicMock(status_code=404))
+            pet.delete()
+
+    @patch("cloudant.document.Document.fetch")
+    def test_fetch_error(self, bad_mock):
+        """It should raise errors other than not found when reading a Pet"""
+        bad_mock.side_effect = HTTPError(response=MagicMock(status_code=500))
+        self.assertRaises(HTTPError, Pet._fetch, "1234")
+
+    @patch("cloudant.database.CloudantDatabase.delete")
+    def test_remove_all_without_drop_rights(self, bad_mock):
+        """It should fall back to bulk deletes when the database can't be dropped"""
+        bad_mock.side_effect = HTTPError(response=MagicMock(status_code=403))
+        self._create_pets(3)
+        Pet.remove_all()
+        self.assertEqual(Pet.all(), [])
 
     @patch("cloudant.client.Cloudant.__init__")
     def test_connection_error(self, bad_mock):
         """It should handle Connection error"""
         bad_mock.side_effect = ConnectionError()
         self.assertRaises(DatabaseConnectionError, Pet.init_db, "test")
+
+    @patch("cloudant.client.Cloudant.connect")
+    def test_lazy_connection_error(self, bad_mock):
+        """It should handle a Connection error when connecting lazily"""
+        Pet.init_db(config.CLOUDANT_DBNAME, connect=False)
+        bad_mock.side_effect = ConnectionError()
+        self.assertRaises(DatabaseConnectionError, Pet.ensure_connected)
+        self.assertIsNone(Pet.database)
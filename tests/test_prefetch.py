@@ -0,0 +1,76 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Prefetch Test Suite
+
+Test cases can be run with the following:
+pytest tests/test_prefetch.py
+"""
+
+import threading
+from unittest import TestCase
+from service.common.prefetch import prefetch
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestPrefetch(TestCase):
+    """Prefetch tests"""
+
+    def setUp(self):
+        self.read = []
+
+    def _pages(self, count: int):
+        """Yields numbered pages and records how far it has read"""
+        for page in range(count):
+            self.read.append(page)
+            yield [page]
+
+    def test_yields_every_item(self):
+        """It should yield every item in order"""
+        self.assertEqual(list(prefetch(self._pages(5), 2)), [[0], [1], [2], [3], [4]])
+
+    def test_reads_ahead(self):
+        """It should read the next items while the caller holds the current one"""
+        pages = prefetch(self._pages(10), 2)
+        self.assertEqual(next(pages), [0])
+        # one page handed out, two buffered and one waiting to be buffered
+        while len(self.read) < 4:
+            threading.Event().wait(0.01)
+        threading.Event().wait(0.1)
+        self.assertEqual(len(self.read), 4)
+        pages.close()
+
+    def test_errors_are_raised(self):
+        """It should raise errors from the iterator in the caller"""
+
+        def failing():
+            yield [0]
+            raise KeyError("boom")
+
+        pages = prefetch(failing())
+        self.assertEqual(next(pages), [0])
+        self.assertRaises(KeyError, next, pages)
+
+    def test_stops_reading_when_closed(self):
+        """It should stop reading once the caller stops iterating"""
+        pages = prefetch(self._pages(100), 1)
+        next(pages)
+        pages.close()
+        threading.Event().wait(0.3)
+        self.assertLess(len(self.read), 5)
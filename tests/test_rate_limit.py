@@ -0,0 +1,139 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Rate Limit Test Suite
+
+Test cases can be run with the following:
+pytest tests/test_rate_limit.py
+"""
+
+import time
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+from concurrent.futures import ThreadPoolExecutor
+from service.common.rate_limit import TokenBucket, Governor, KeyLimiter, RedisKeyLimiter, key_limiter
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestTokenBucket(TestCase):
+    """Token Bucket tests"""
+
+    def test_burst(self):
+        """It should let a burst through without waiting"""
+        bucket = TokenBucket(10, burst=5)
+        self.assertEqual(sum(bucket.acquire() for _ in range(5)), 0.0)
+        self.assertEqual(bucket.stats()["waits"], 0)
+
+    def test_pace(self):
+        """It should space requests out once the burst is used up"""
+        bucket = TokenBucket(50, burst=1)
+        started = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+        stats = bucket.stats()
+        self.assertEqual(stats["requests"], 6)
+        self.assertEqual(stats["waits"], 5)
+        self.assertGreater(stats["wait_seconds"], 0)
+
+    def test_shared_between_threads(self):
+        """It should pace requests from many threads together"""
+        bucket = TokenBucket(100, burst=1)
+        started = time.monotonic()
+        with ThreadPoolExecutor(8) as executor:
+            waits = list(executor.map(lambda _: bucket.acquire(), range(16)))
+        self.assertGreaterEqual(time.monotonic() - started, 0.14)
+        self.assertLessEqual(max(waits), 0.151)
+
+
+class TestGovernor(TestCase):
+    """Governor tests"""
+
+    def test_unlimited(self):
+        """It should not keep a bucket for classes without a limit"""
+        governor = Governor({"lookup": 10, "write": 0})
+        self.assertEqual(governor.acquire("write"), 0.0)
+        self.assertEqual(governor.acquire("query"), 0.0)
+        self.assertEqual(list(governor.stats()), ["lookup"])
+
+    def test_classes_are_separate(self):
+        """It should pace each class of request on its own"""
+        governor = Governor({"lookup": 1, "write": 1})
+        self.assertEqual(governor.acquire("lookup"), 0.0)
+        self.assertEqual(governor.acquire("write"), 0.0)
+        self.assertEqual(governor.stats()["write"]["requests"], 1)
+
+
+class TestKeyLimiter(TestCase):
+    """Key Limiter tests"""
+
+    def test_burst(self):
+        """It should let a burst through and then say how long to wait"""
+        limiter = KeyLimiter()
+        self.assertEqual([limiter.take("a", 10, 3) for _ in range(3)], [0.0, 0.0, 0.0])
+        wait = limiter.take("a", 10, 3)
+        self.assertGreater(wait, 0.05)
+        self.assertLessEqual(wait, 0.1)
+
+    def test_keys_are_separate(self):
+        """It should hold each key to its own quota"""
+        limiter = KeyLimiter()
+        self.assertEqual(limiter.take("a", 1, 1), 0.0)
+        self.assertGreater(limiter.take("a", 1, 1), 0.0)
+        self.assertEqual(limiter.take("b", 1, 1), 0.0)
+
+    def test_shared_between_threads(self):
+        """It should let exactly the burst of a key through when threads race for it"""
+        limiter = KeyLimiter(stripes=4)
+        with ThreadPoolExecutor(8) as executor:
+            waits = list(executor.map(lambda key: limiter.take(key, 0.01, 5), ["a", "b"] * 40))
+        self.assertEqual(waits.count(0.0), 10)
+
+    def test_recover(self):
+        """It should let requests through again once the key has waited"""
+        limiter = KeyLimiter()
+        limiter.take("a", 50, 1)
+        time.sleep(limiter.take("a", 50, 1))
+        self.assertEqual(limiter.take("a", 50, 1), 0.0)
+
+    def test_local_without_redis(self):
+        """It should keep the quotas in the process without a Redis url or package"""
+        self.assertIsInstance(key_limiter(), KeyLimiter)
+        with patch("service.common.rate_limit.redis", None):
+            self.assertIsInstance(key_limiter("redis://localhost"), KeyLimiter)
+
+    @patch("service.common.rate_limit.redis")
+    def test_redis(self, redis_mock):
+        """It should keep the quotas in Redis when there is a url for it"""
+        script = redis_mock.Redis.from_url.return_value.register_script.return_value
+        script.return_value = b"0.25"
+        limiter = key_limiter("redis://localhost")
+        self.assertIsInstance(limiter, RedisKeyLimiter)
+        self.assertEqual(limiter.take("a", 2, 3), 0.25)
+        script.assert_called_with(keys=["rate-limit:a"], args=[0.5, 1.0])
+
+    @patch("service.common.rate_limit.redis")
+    def test_redis_unavailable(self, redis_mock):
+        """It should limit this process alone while Redis can't be reached"""
+        redis_mock.RedisError = ConnectionError
+        script = MagicMock(side_effect=ConnectionError("refused"))
+        redis_mock.Redis.from_url.return_value.register_script.return_value = script
+        limiter = RedisKeyLimiter("redis://localhost")
+        self.assertEqual(limiter.take("a", 1, 1), 0.0)
+        self.assertGreater(limiter.take("a", 1, 1), 0.0)
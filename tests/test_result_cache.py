@@ -0,0 +1,77 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Result Cache Test Suite
+
+Test cases can be run with the following:
+pytest tests/test_result_cache.py
+"""
+
+from unittest import TestCase
+from service.common.result_cache import ResultCache
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestResultCache(TestCase):
+    """Result Cache tests"""
+
+    def setUp(self):
+        self.cache = ResultCache(2)
+
+    def test_hit(self):
+        """It should return a value cached for the same version"""
+        self.cache.put("dogs", "1-a", b"[]")
+        self.assertEqual(self.cache.get("dogs", "1-a"), b"[]")
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def test_miss(self):
+        """It should return None for a key that was never cached"""
+        self.assertIsNone(self.cache.get("dogs", "1-a"))
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_stale(self):
+        """It should drop a value once the version changes"""
+        self.cache.put("dogs", "1-a", b"[]")
+        self.assertIsNone(self.cache.get("dogs", "2-a"))
+        self.assertEqual(self.cache.stats()["stale"], 1)
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_evict_least_recently_used(self):
+        """It should evict the least recently used value when full"""
+        self.cache.put("dogs", "1-a", b"dogs")
+        self.cache.put("cats", "1-a", b"cats")
+        self.cache.get("dogs", "1-a")
+        self.cache.put("fish", "1-a", b"fish")
+        self.assertIsNone(self.cache.get("cats", "1-a"))
+        self.assertEqual(self.cache.get("dogs", "1-a"), b"dogs")
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_clear(self):
+        """It should forget every value when cleared"""
+        self.cache.put("dogs", "1-a", b"[]")
+        self.cache.clear()
+        self.assertIsNone(self.cache.get("dogs", "1-a"))
+
+    def test_stats(self):
+        """It should report the hit rate"""
+        self.assertEqual(self.cache.stats()["hit_rate"], 0.0)
+        self.cache.put("dogs", "1-a", b"[]")
+        self.cache.get("dogs", "1-a")
+        self.cache.get("cats", "1-a")
+        self.assertEqual(self.cache.stats()["hit_rate"], 0.5)
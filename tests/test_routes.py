@@ -23,14 +23,22 @@ nosetests -v --with-spec --spec-color
 nosetests --stop tests/test_service.py:TestPetServer
 """
 
+import os
+import time
+import shutil
 import logging
+import tempfile
+import threading
+from datetime import date
 from unittest import TestCase
-# from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 from urllib.parse import quote_plus
+from requests import HTTPError, ConnectionError  # pylint: disable=redefined-builtin
 from wsgi import app
-from service import routes
+from service import routes, config
 from service.common import status
-# from service.models import DatabaseConnectionError
+from service.models import Pet, DatabaseConnectionError
+from service.common.write_behind import WriteBehind
 from tests.factories import PetFactory
 
 # Disable all but critical errors during normal test run
@@ -58,8 +66,8 @@ class BaseTestCase(TestCase):
     def setUp(self):
         self.app = app.test_client()
         self.headers = {"X-Api-Key": app.config["API_KEY"]}
-        # routes.init_db("test")
-        # routes.data_reset()
+        # the model tests that ran before in this worker leave their Pets behind
+        routes.data_reset()
 
     def tearDown(self):
         """Clear the database"""
@@ -101,7 +109,7 @@ class BaseTestCase(TestCase):
 ############################################################
 
 
-class TestPetRoutes(BaseTestCase):
+class TestPetRoutes(BaseTestCase):  # pylint: disable=too-many-public-methods
     """Pet Service Routes tests"""
 
     def test_index(self):
@@ -110,6 +118,71 @@ class TestPetRoutes(BaseTestCase):
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         self.assertIn(b"Pet Shop", resp.data)
 
+    def test_swagger_spec(self):
+        """It should serve the cached OpenAPI spec"""
+        resp = self.app.get("/api/swagger.json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn("/pets", resp.get_json()["paths"])
+        self.assertIn("max-age", resp.headers["Cache-Control"])
+        etag = resp.headers["ETag"]
+        resp = self.app.get("/api/swagger.json", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp = self.app.get("/apidocs")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_health_live(self):
+        """It should report that the service is alive"""
+        resp = self.app.get("/health/live")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["status"], "OK")
+
+    def test_health_ready(self):
+        """It should report that the service is ready"""
+        Pet.probed_at = None
+        resp = self.app.get("/health/ready")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["database"], "reachable")
+
+    @patch("cloudant.database.CloudantDatabase.exists")
+    def test_health_not_ready(self, exists_mock):
+        """It should report that the service is not ready without a database"""
+        exists_mock.side_effect = ConnectionError()
+        Pet.probed_at = None
+        resp = self.app.get("/health/ready")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp.get_json()["database"], "unreachable")
+        Pet.probed_at = None
+
+    def test_connect_database(self):
+        """It should open a lazy connection for requests other than health probes"""
+        Pet.init_db(config.CLOUDANT_DBNAME, connect=False)
+        with app.test_request_context("/health/live"):
+            routes.connect_database()
+        self.assertIsNone(Pet.database)
+        with app.test_request_context(BASE_URL):
+            routes.connect_database()
+        self.assertIsNotNone(Pet.database)
+
+    @patch("service.models.Pet.ensure_connected")
+    def test_connect_database_error(self, connect_mock):
+        """It should answer 503 JSON when the lazy connection can't be made"""
+        connect_mock.side_effect = DatabaseConnectionError("Cloudant service could not be reached")
+        app.before_request_funcs[None].append(routes.connect_database)
+        try:
+            resp = self.app.get(BASE_URL)
+        finally:
+            app.before_request_funcs[None].remove(routes.connect_database)
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp.get_json()["error"], "Service Unavailable")
+
+    def test_metrics(self):
+        """It should return the service metrics"""
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertIn("single_flight", data)
+        self.assertIn("database", data["startup"])
+
     def test_get_pet_list(self):
         """It should Get a list of Pets"""
         self._create_pets(5)
@@ -117,6 +190,41 @@ class TestPetRoutes(BaseTestCase):
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         self.assertTrue(len(resp.data) > 0)
 
+    def test_get_pet_list_cached(self):
+        """It should serve a repeated list from the cache until the data changes"""
+        self._create_pets(3)
+        before = self.app.get("/metrics").get_json()["list_cache"]
+        with patch.object(Pet, "find_by_category", wraps=Pet.find_by_category) as finder:
+            first = self.app.get(BASE_URL, query_string="category=dog")
+            second = self.app.get(BASE_URL, query_string="category=dog")
+            self.assertEqual(first.data, second.data)
+            self.assertEqual(finder.call_count, 1)
+            self._create_pets(1)
+            self.app.get(BASE_URL, query_string="category=dog")
+            self.assertEqual(finder.call_count, 2)
+        stats = self.app.get("/metrics").get_json()["list_cache"]
+        self.assertEqual(stats["hits"] - before["hits"], 1)
+        self.assertEqual(stats["stale"] - before["stale"], 1)
+
+    def test_get_pet_list_from_snapshot(self):
+        """It should not cache a list that was read from the snapshot"""
+        test_pet = PetFactory(category="dog")
+        test_pet.create()
+        snapshot = MagicMock()
+        snapshot.find.return_value = [dict(test_pet.serialize(), _id=test_pet.id)]
+        with patch.object(Pet, "shared_snapshot", return_value=snapshot):
+            self.assertEqual(len(self.app.get(BASE_URL, query_string="category=dog").get_json()), 1)
+            self.assertEqual(len(self.app.get(BASE_URL, query_string="category=dog").get_json()), 1)
+        self.assertEqual(snapshot.find.call_count, 2)
+
+    def test_get_pet_list_recreated(self):
+        """It should not serve a list cached from a database that was dropped since"""
+        self._create_pets(2)
+        with patch.object(Pet, "update_seq", return_value="2-same"):
+            self.assertEqual(len(self.app.get(BASE_URL).get_json()), 2)
+            Pet.remove_all()
+            self.assertEqual(self.app.get(BASE_URL).get_json(), [])
+
     def test_get_pet(self):
         """It should Get a single Pet"""
         test_pet = self._create_pets()[0]
@@ -217,6 +325,58 @@ class TestPetRoutes(BaseTestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_update_pet_creates(self):
+        """It should Create a Pet with the given id when PUT is allowed to"""
+        test_pet = PetFactory()
+        with patch.dict(app.config, {"PUT_CREATES_PETS": True}):
+            resp = self.app.put(
+                f"{BASE_URL}/fido-1",
+                json=test_pet.serialize(),
+                content_type=CONTENT_TYPE_JSON,
+                headers=self.headers,
+            )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(resp.headers["Location"].endswith(f"{BASE_URL}/fido-1"))
+        resp = self.app.get(f"{BASE_URL}/fido-1")
+        self.assertEqual(resp.get_json()["name"], test_pet.name)
+
+    @patch("cloudant.document.Document.create")
+    def test_update_pet_create_fails(self, create_mock):
+        """It should not answer 201 when a PUT could not create the Pet"""
+        create_mock.side_effect = HTTPError()
+        with patch.dict(app.config, {"PUT_CREATES_PETS": True}):
+            resp = self.app.put(f"{BASE_URL}/fido-2", json=PetFactory().serialize(), headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        resp = self.app.post(BASE_URL, json=PetFactory().serialize(), headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def test_update_pet_bad_id(self):
+        """It should not create a Pet with an id that CouchDB can't take"""
+        with patch.dict(app.config, {"PUT_CREATES_PETS": True}):
+            for pet_id in ("_bad", "x" * 201, "a b", quote_plus("ü")):
+                resp = self.app.put(f"{BASE_URL}/{pet_id}", json=PetFactory().serialize(), headers=self.headers)
+                self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, pet_id)
+            with patch("cloudant.document.Document.create") as create_mock:
+                create_mock.side_effect = HTTPError(response=MagicMock(status_code=400))
+                resp = self.app.put(f"{BASE_URL}/fido-4", json=PetFactory().serialize(), headers=self.headers)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_update_pet_created_meanwhile(self):
+        """It should update a Pet that another request created after it looked"""
+        first = PetFactory(name="first")
+        first.id = "fido-3"
+        first.create()
+        second = PetFactory(name="second")
+        with patch.dict(app.config, {"PUT_CREATES_PETS": True}):
+            with patch.object(Pet, "find", side_effect=[None, Pet.find("fido-3")]):
+                resp = self.app.put(f"{BASE_URL}/fido-3", json=second.serialize(), headers=self.headers)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(self.app.get(f"{BASE_URL}/fido-3").get_json()["name"], "second")
+            # deleted again before it could be read
+            with patch.object(Pet, "find", return_value=None):
+                resp = self.app.put(f"{BASE_URL}/fido-3", json=PetFactory().serialize(), headers=self.headers)
+            self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
     def test_update_pet_not_authorized(self):
         """It should not Update a Pet if Not Authorized"""
         pet = self._create_pets()[0]
@@ -275,6 +435,122 @@ class TestPetRoutes(BaseTestCase):
         resp = self.app.post(f"{BASE_URL}/foo", json={}, headers=self.headers)
         self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
 
+    def test_request_timeout(self):
+        """It should answer 504 when the request runs out of time"""
+        test_pet = self._create_pets(1)[0]
+        resp = self.app.get(f"{BASE_URL}/{test_pet.id}", headers={"X-Request-Timeout": "0.000001"})
+        self.assertEqual(resp.status_code, status.HTTP_504_GATEWAY_TIMEOUT)
+        self.assertEqual(resp.get_json()["error"], "Gateway Timeout")
+        resp = self.app.get(f"{BASE_URL}/{test_pet.id}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    @patch("service.common.deadline.start")
+    def test_time_limits(self, start_mock):
+        """It should give each request its route's time limit or less if asked"""
+        self.app.get(f"{BASE_URL}/0")
+        start_mock.assert_called_with(app.config["REQUEST_TIMEOUT"])
+        self.app.get(BASE_URL)
+        start_mock.assert_called_with(30)
+        self.app.get(BASE_URL, headers={"X-Request-Timeout": "2.5"})
+        start_mock.assert_called_with(2.5)
+        self.app.get(BASE_URL, headers={"X-Request-Timeout": "600"})
+        start_mock.assert_called_with(30)
+
+    def test_admission_classes(self):
+        """It should keep separate limits for lookups, queries, scans and writes"""
+        before = app.extensions["admission"].stats()
+        test_pet = self._create_pets(1)[0]
+        self.app.get(f"{BASE_URL}/{test_pet.id}")
+        self.app.get(BASE_URL, query_string=f"category={test_pet.category}")
+        self.app.get(BASE_URL)
+        after = self.app.get("/metrics").get_json()["admission"]
+        for kind in ("lookup", "query", "scan", "write"):
+            self.assertEqual(after[kind]["admitted"] - before[kind]["admitted"], 1, kind)
+
+    def test_shed_load(self):
+        """It should turn requests away with 503 when their class is full"""
+        scans = app.extensions["admission"].limits["scan"]
+        scans.in_flight += scans.max_limit
+        try:
+            resp = self.app.get(BASE_URL)
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertIn("Retry-After", resp.headers)
+            resp = self.app.get(f"{BASE_URL}/0")
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        finally:
+            scans.in_flight -= scans.max_limit
+
+    def test_shed_before_database(self):
+        """It should not send a request it turns away with 503 to the database"""
+        scans = app.extensions["admission"].limits["scan"]
+        scans.in_flight += scans.max_limit
+        try:
+            with patch.object(Pet.balancer, "send") as send_mock:
+                resp = self.app.get(BASE_URL)
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            send_mock.assert_not_called()
+        finally:
+            scans.in_flight -= scans.max_limit
+
+    def test_refused_keys_skip_admission(self):
+        """It should not give a write slot to a request with a bad or spent API key"""
+        writes = app.extensions["admission"].limits["write"]
+        before = writes.stats()
+        writes.in_flight += writes.max_limit
+        try:
+            resp = self.app.delete(f"{BASE_URL}/0", headers={"X-Api-Key": "bad"})
+            self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+            with patch.dict(app.extensions, {"api_keys": {"limited": (0.5, 1)}}):
+                app.extensions["key_limiter"].take(routes.api_key_id("limited"), 0.5, 1)
+                resp = self.app.delete(f"{BASE_URL}/0", headers={"X-Api-Key": "limited"})
+                self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            resp = self.app.delete(f"{BASE_URL}/0", headers=self.headers)
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        finally:
+            writes.in_flight -= writes.max_limit
+        self.assertEqual(writes.stats()["admitted"], before["admitted"])
+
+    def test_more_api_keys(self):
+        """It should accept each of the configured API keys"""
+        keys = routes.parse_api_keys("first, second:5:2", 0, 10)
+        self.assertEqual(keys, {"first": (0, 10), "second": (5.0, 2)})
+        with patch.dict(app.extensions, {"api_keys": keys}):
+            for key in ("first", "second", app.config["API_KEY"]):
+                resp = self.app.delete(f"{BASE_URL}/0", headers={"X-Api-Key": key})
+                self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+            resp = self.app.delete(f"{BASE_URL}/0", headers={"X-Api-Key": "third"})
+            self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_malformed_api_keys(self):
+        """It should name the API_KEYS entry that can't be read without showing its key"""
+        for text, message in (
+            ("first, second:fast", "entry 2 (<key>:fast)"),
+            ("first:1:2:3", "entry 1 (<key>:1:2:3)"),
+            (":5", "entry 1 (:5)"),
+            ("first:-1", "entry 1 (<key>:-1)"),
+            ("first:1:2.5", "entry 1 (<key>:1:2.5)"),
+        ):
+            with self.assertRaises(ValueError) as context:
+                routes.parse_api_keys(text, 0, 10)
+            self.assertIn(message, str(context.exception))
+            self.assertNotIn("first", str(context.exception))
+
+    def test_api_key_quota(self):
+        """It should turn an API key away with 429 once it goes over its quota"""
+        with patch.dict(app.extensions, {"api_keys": {"limited": (0.5, 2)}}):
+            headers = {"X-Api-Key": "limited"}
+            for _ in range(2):
+                resp = self.app.delete(f"{BASE_URL}/0", headers=headers)
+                self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+            with patch.object(Pet, "find") as find_mock:
+                resp = self.app.delete(f"{BASE_URL}/0", headers=headers)
+                find_mock.assert_not_called()
+            self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(resp.headers["Retry-After"], "2")
+            # other keys have their own quota
+            resp = self.app.delete(f"{BASE_URL}/0", headers=self.headers)
+            self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
 
 class TestPetQuery(BaseTestCase):
     """Pet Service Query tests"""
@@ -307,6 +583,101 @@ class TestPetQuery(BaseTestCase):
         for pet in data:
             self.assertEqual(pet["category"], test_category)
 
+    def test_search_by_name(self):
+        """It should Search Pets by name prefix and with typos"""
+        for name in ("Fido", "Fidget", "Fluffy", "Rex"):
+            PetFactory(name=name).create()
+        resp = self.app.get(BASE_URL, query_string="q=fid")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([pet["name"] for pet in resp.get_json()], ["Fidget", "Fido"])
+        resp = self.app.get(BASE_URL, query_string="q=fdo")
+        self.assertEqual([pet["name"] for pet in resp.get_json()], ["Fido"])
+        resp = self.app.get(BASE_URL, query_string="q=fi&page=2&page_size=1")
+        self.assertEqual([pet["name"] for pet in resp.get_json()], ["Fido"])
+
+    def test_query_by_birthday_range(self):
+        """It should Query Pets born between two days"""
+        for day in (1, 10, 20):
+            PetFactory(birthday=date(2020, 1, day)).create()
+        resp = self.app.get(BASE_URL, query_string="born_after=2020-01-05&born_before=2020-01-25")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        birthdays = sorted(pet["birthday"] for pet in resp.get_json())
+        self.assertEqual(birthdays, ["2020-01-10", "2020-01-20"])
+        resp = self.app.get(BASE_URL, query_string="born_before=2020-01-05")
+        self.assertEqual([pet["birthday"] for pet in resp.get_json()], ["2020-01-01"])
+
+    def test_query_by_several_filters(self):
+        """It should Query Pets that match every filter given"""
+        for category, available, day in (("dog", True, 1), ("dog", True, 10), ("dog", False, 10), ("cat", True, 10)):
+            PetFactory(category=category, available=available, birthday=date(2020, 1, day)).create()
+        resp = self.app.get(BASE_URL, query_string="category=dog&available=true&born_after=2020-01-05")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual((data[0]["category"], data[0]["available"], data[0]["birthday"]), ("dog", True, "2020-01-10"))
+        resp = self.app.get(BASE_URL, query_string="category=dog&available=true")
+        self.assertEqual(len(resp.get_json()), 2)
+        resp = self.app.get(BASE_URL, query_string="available=true&born_before=2020-01-05")
+        self.assertEqual([pet["birthday"] for pet in resp.get_json()], ["2020-01-01"])
+        resp = self.app.get(BASE_URL, query_string="q=fido&category=dog")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_by_bad_birthday(self):
+        """It should not Query Pets with a bad date"""
+        resp = self.app.get(BASE_URL, query_string="born_after=yesterday")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_sort_and_page(self):
+        """It should return a sorted page of Pets"""
+        for name in ("Rex", "Fido", "Ace", "Max"):
+            PetFactory(name=name, category="dog").create()
+        PetFactory(name="Tom", category="cat").create()
+        resp = self.app.get(BASE_URL, query_string="sort=name&page=2&page_size=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([pet["name"] for pet in resp.get_json()], ["Max", "Rex"])
+        resp = self.app.get(BASE_URL, query_string="category=dog&sort=name&order=desc&page_size=3")
+        self.assertEqual([pet["name"] for pet in resp.get_json()], ["Rex", "Max", "Fido"])
+        resp = self.app.get(BASE_URL, query_string="sort=color")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_page_with_cursor(self):
+        """It should continue a sorted list from the cursor of the page before"""
+        for name in ("Rex", "Fido", "Ace", "Max", "Bo"):
+            PetFactory(name=name, category="dog").create()
+        names = []
+        query = "sort=name&order=desc&page_size=2"
+        resp = self.app.get(BASE_URL, query_string=query)
+        while True:
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            names.extend(pet["name"] for pet in resp.get_json())
+            if "X-Next-Cursor" not in resp.headers:
+                break
+            resp = self.app.get(BASE_URL, query_string=f"{query}&cursor={resp.headers['X-Next-Cursor']}")
+        self.assertEqual(names, ["Rex", "Max", "Fido", "Bo", "Ace"])
+        query = "category=dog&sort=name&page_size=2"
+        resp = self.app.get(BASE_URL, query_string=query)
+        resp = self.app.get(BASE_URL, query_string=f"{query}&cursor={resp.headers['X-Next-Cursor']}")
+        self.assertEqual([pet["name"] for pet in resp.get_json()], ["Fido", "Max"])
+
+    def test_page_with_bad_cursor(self):
+        """It should not page with a cursor that can't be used"""
+        self._create_pets(3)
+        for query in (
+            "sort=name&cursor=bm9wZQ",
+            "sort=name&page_size=2&page=2&cursor=MQ==",
+            "q=fido&page_size=2&cursor=MQ==",
+            "sort=name&page_size=2&cursor=%%%",
+            "available=true&born_before=2100-01-01&sort=name&page_size=2&cursor=MQ==",
+            "order=desc",
+        ):
+            resp = self.app.get(BASE_URL, query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+
+    def test_search_bad_page_size(self):
+        """It should not Search with a page size that is too big"""
+        resp = self.app.get(BASE_URL, query_string="q=fido&page_size=1000")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     # test_query_by_availability() does not work because of the way CouchDB
     # handles deletions. Need to upgrade to newer ibmcloudant library
 
@@ -354,11 +725,219 @@ class TestPetActions(BaseTestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
 
+    def test_purchase_with_stale_snapshot(self):
+        """It should not Purchase a Pet twice while the snapshot still shows it available"""
+        test_pet = PetFactory(available=True)
+        test_pet.create()
+        snapshot = MagicMock()
+        snapshot.get.return_value = dict(test_pet.serialize(), _id=test_pet.id)
+        with patch.object(Pet, "shared_snapshot", return_value=snapshot):
+            resp = self.app.put(f"{BASE_URL}/{test_pet.id}/purchase")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            resp = self.app.put(f"{BASE_URL}/{test_pet.id}/purchase")
+            self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+            # plain reads still come from the snapshot
+            self.assertTrue(self.app.get(f"{BASE_URL}/{test_pet.id}").get_json()["available"])
+
     def test_purchase_does_not_exist(self):
         """It should not Purchase a Pet that doesn't exist"""
         resp = self.app.put(f"{BASE_URL}/0/purchase", content_type=CONTENT_TYPE_JSON)
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+
+class TestWriteBehind(BaseTestCase):
+    """Write behind tests"""
+
+    def setUp(self):
+        super().setUp()
+        self.folder = tempfile.mkdtemp()
+        self.writer = WriteBehind(Pet.apply_changes, os.path.join(self.folder, "journal"))
+        app.extensions["write_behind"] = self.writer
+
+    def tearDown(self):
+        self.writer.stop()
+        del app.extensions["write_behind"]
+        shutil.rmtree(self.folder)
+        super().tearDown()
+
+    def test_purchase_accepted(self):
+        """It should accept a Purchase and write it in the background"""
+        test_pet = PetFactory(available=True)
+        test_pet.create()
+        resp = self.app.put(f"{BASE_URL}/{test_pet.id}/purchase")
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        status_url = resp.headers["Location"]
+        resp = self.app.put(f"{BASE_URL}/{test_pet.id}/purchase")
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertTrue(self.writer.drain(5))
+        resp = self.app.get(status_url)
+        self.assertEqual(resp.get_json()["status"], "done")
+        self.assertFalse(Pet.find(test_pet.id).available)
+
+    def test_purchase_while_writing(self):
+        """It should not accept a second Purchase while the first is being written"""
+        test_pet = PetFactory(available=True)
+        test_pet.create()
+        started, release = threading.Event(), threading.Event()
+
+        def blocked_flush(changes):
+            started.set()
+            release.wait(5)
+            return Pet.apply_changes(changes)
+
+        self.writer.flush = blocked_flush
+        resp = self.app.put(f"{BASE_URL}/{test_pet.id}/purchase")
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        self.assertTrue(started.wait(5))
+        resp = self.app.put(f"{BASE_URL}/{test_pet.id}/purchase")
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        release.set()
+        self.assertTrue(self.writer.drain(5))
+        self.assertFalse(Pet.find(test_pet.id).available)
+
+    def test_update_accepted(self):
+        """It should accept an Update and write it in the background"""
+        test_pet = PetFactory()
+        test_pet.create()
+        data = test_pet.serialize()
+        data["name"] = "Renamed"
+        resp = self.app.put(f"{BASE_URL}/{test_pet.id}", json=data, headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(resp.get_json()["name"], "Renamed")
+        self.assertTrue(self.writer.drain(5))
+        self.assertEqual(Pet.find(test_pet.id).name, "Renamed")
+        self.assertEqual(self.app.get("/metrics").get_json()["write_behind"]["written"], 1)
+
+    def test_write_status_not_found(self):
+        """It should not return the status of an unknown write"""
+        resp = self.app.get("/api/writes/unknown")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    @patch("service.common.write_behind.WriteBehind.submit")
+    def test_queue_full(self, submit_mock):
+        """It should write a Purchase itself when the queue is full"""
+        submit_mock.return_value = None
+        test_pet = PetFactory(available=True)
+        test_pet.create()
+        resp = self.app.put(f"{BASE_URL}/{test_pet.id}/purchase")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertFalse(Pet.find(test_pet.id).available)
+
+
+class TestIdempotency(BaseTestCase):
+    """Idempotency-Key tests"""
+
+    def test_create_pet_replayed(self):
+        """It should Create a Pet only once for a repeated Idempotency-Key"""
+        test_pet = PetFactory()
+        headers = dict(self.headers, **{"Idempotency-Key": "create-1"})
+        first = self.app.post(BASE_URL, json=test_pet.serialize(), headers=headers)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        second = self.app.post(BASE_URL, json=test_pet.serialize(), headers=headers)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(second.headers["Location"], first.headers["Location"])
+        self.assertEqual(second.get_json(), first.get_json())
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 1)
+
+    def test_key_reused_for_other_request(self):
+        """It should not accept an Idempotency-Key used for a different request"""
+        headers = dict(self.headers, **{"Idempotency-Key": "create-2"})
+        resp = self.app.post(BASE_URL, json=PetFactory().serialize(), headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.post(BASE_URL, json=PetFactory().serialize(), headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_key_in_progress(self):
+        """It should not run a request while another with the same key is running"""
+        test_pet = PetFactory()
+        headers = dict(self.headers, **{"Idempotency-Key": "create-3"})
+        resp = self.app.post(BASE_URL, json=test_pet.serialize(), headers=headers)
+        name = f"idempotency-{routes.api_key_id(app.config['API_KEY'])}-create-3"
+        record = Pet.load_local(name)
+        del record["status"]
+        Pet.save_local(name, record)
+        resp = self.app.post(BASE_URL, json=test_pet.serialize(), headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
+    def test_key_too_long(self):
+        """It should not accept an Idempotency-Key that is too long"""
+        headers = dict(self.headers, **{"Idempotency-Key": "x" * 256})
+        resp = self.app.post(BASE_URL, json=PetFactory().serialize(), headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_purchase_replayed(self):
+        """It should return the first Purchase for a repeated Idempotency-Key"""
+        test_pet = PetFactory(available=True)
+        test_pet.create()
+        headers = {"Idempotency-Key": "purchase-1"}
+        for _ in range(2):
+            resp = self.app.put(f"{BASE_URL}/{test_pet.id}/purchase", headers=headers)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["available"], False)
+
+    def test_failed_request_not_kept(self):
+        """It should let a failed request run again with the same key"""
+        headers = {"Idempotency-Key": "purchase-2"}
+        resp = self.app.put(f"{BASE_URL}/0/purchase", headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIsNone(Pet.load_local("idempotency-public-purchase-2"))
+
+    @patch("service.models.Pet.delete_local")
+    @patch("service.models.Pet.save_local")
+    def test_response_not_saved(self, save_mock, delete_mock):
+        """It should still respond when the response can't be kept, and give up the claim"""
+        save_mock.side_effect = ["1-a", HTTPError()]
+        headers = dict(self.headers, **{"Idempotency-Key": "create-4"})
+        resp = self.app.post(BASE_URL, json=PetFactory().serialize(), headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        delete_mock.assert_called_once_with(f"idempotency-{routes.api_key_id(app.config['API_KEY'])}-create-4", "1-a")
+        delete_mock.side_effect = HTTPError()
+        save_mock.side_effect = ["1-b", HTTPError()]
+        resp = self.app.post(BASE_URL, json=PetFactory().serialize(), headers=dict(headers, **{"Idempotency-Key": "create-5"}))
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+    @patch("service.models.Pet.save_local")
+    def test_claim_is_short(self, save_mock):
+        """It should claim a key only for as long as the request may take"""
+        save_mock.return_value = "1-a"
+        headers = dict(self.headers, **{"Idempotency-Key": "create-6", "X-Request-Timeout": "5"})
+        started = time.time()
+        self.app.post(BASE_URL, json=PetFactory().serialize(), headers=headers)
+        claim = save_mock.call_args_list[0].args[1]
+        self.assertNotIn("status", claim)
+        self.assertLessEqual(claim["expires"], started + 6)
+        stored = save_mock.call_args_list[1].args[1]
+        self.assertGreater(stored["expires"], started + app.config["IDEMPOTENCY_TTL"] - 60)
+
+    def test_keys_are_kept_apart(self):
+        """It should keep the same Idempotency-Key of different API keys apart"""
+        with patch.dict(app.extensions, {"api_keys": {"other": (0, 10)}}):
+            for api_key in (app.config["API_KEY"], "other"):
+                headers = {"X-Api-Key": api_key, "Idempotency-Key": "create-7"}
+                resp = self.app.post(BASE_URL, json=PetFactory().serialize(), headers=headers)
+                self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+                self.assertNotIn("Idempotent-Replayed", resp.headers)
+
+    def test_sweep_expired_records(self):
+        """It should delete the idempotency records whose time is up"""
+        Pet.save_local("idempotency-public-old", {"expires": time.time() - 1})
+        Pet.save_local("idempotency-public-new", {"expires": time.time() + 60})
+        self.assertEqual(Pet.expire_local("idempotency-"), 1)
+        self.assertIsNone(Pet.load_local("idempotency-public-old"))
+        self.assertIsNotNone(Pet.load_local("idempotency-public-new"))
+
+    @patch("service.models.Pet.expire_local")
+    def test_sweep_in_background(self, expire_mock):
+        """It should sweep at most once an interval, without failing the request"""
+        expire_mock.side_effect = HTTPError("down")
+        routes.idempotency_sweep["due"] = 0.0
+        with app.test_request_context():
+            routes.sweep_idempotency_records()
+            routes.sweep_idempotency_records()
+        time.sleep(0.1)
+        self.assertEqual(expire_mock.call_count, 1)
+
     ######################################################################
     #  P A T C H   A N D   M O C K   T E S T   C A S E S
     ######################################################################
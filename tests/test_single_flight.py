@@ -0,0 +1,126 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Single Flight Test Suite
+
+Test cases can be run with the following:
+pytest tests/test_single_flight.py
+"""
+
+import threading
+from unittest import TestCase
+from concurrent.futures import ThreadPoolExecutor
+from service.common import deadline
+from service.common.single_flight import SingleFlight
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSingleFlight(TestCase):
+    """Single Flight tests"""
+
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.release = threading.Event()
+        self.count = 0
+
+    def _slow_call(self):
+        """Counts the call and waits to be released"""
+        self.count += 1
+        self.release.wait(5)
+        return self.count
+
+    def _wait_for_shared(self, shared: int):
+        """Waits until the given number of callers are sharing a call"""
+        while self.flight.shared < shared:
+            threading.Event().wait(0.01)
+
+    def test_concurrent_calls_are_shared(self):
+        """It should make one call for concurrent callers with the same key"""
+        with ThreadPoolExecutor(4) as executor:
+            futures = [executor.submit(self.flight.do, "key", self._slow_call) for _ in range(4)]
+            self._wait_for_shared(3)
+            self.release.set()
+            results = [future.result() for future in futures]
+        self.assertEqual(results, [1, 1, 1, 1])
+        self.assertEqual(self.count, 1)
+        self.assertEqual(self.flight.stats(), {"calls": 4, "shared": 3, "coalescing_rate": 0.75})
+
+    def test_errors_are_shared(self):
+        """It should raise the error of a shared call in every caller"""
+
+        def failing_call():
+            self.release.wait(5)
+            raise KeyError("boom")
+
+        with ThreadPoolExecutor(2) as executor:
+            futures = [executor.submit(self.flight.do, "key", failing_call) for _ in range(2)]
+            self._wait_for_shared(1)
+            self.release.set()
+            for future in futures:
+                self.assertRaises(KeyError, future.result)
+
+    def test_wait_ends_at_deadline(self):
+        """It should not wait for a shared call past the caller's deadline"""
+
+        def impatient():
+            deadline.start(0.05)
+            return self.flight.do("key", self._slow_call)
+
+        with ThreadPoolExecutor(2) as executor:
+            leader = executor.submit(self.flight.do, "key", self._slow_call)
+            while not self.count:
+                threading.Event().wait(0.01)
+            follower = executor.submit(impatient)
+            self.assertRaises(deadline.DeadlineExceeded, follower.result, 1)
+            self.release.set()
+            self.assertEqual(leader.result(), 1)
+
+    def test_leader_deadline_not_shared(self):
+        """It should call again for the callers waiting on a leader that ran out of time"""
+
+        def leader_call():
+            self.count += 1
+            if self.count == 1:
+                self.release.wait(5)
+                raise deadline.DeadlineExceeded("out of time")
+            return "fresh"
+
+        with ThreadPoolExecutor(2) as executor:
+            futures = [executor.submit(self.flight.do, "key", leader_call) for _ in range(2)]
+            self._wait_for_shared(1)
+            self.release.set()
+            outcomes = []
+            for future in futures:
+                try:
+                    outcomes.append(future.result())
+                except deadline.DeadlineExceeded:
+                    outcomes.append("expired")
+        self.assertEqual(sorted(outcomes), ["expired", "fresh"])
+        self.assertEqual(self.count, 2)
+
+    def test_sequential_calls_are_not_shared(self):
+        """It should call again once the previous call has finished"""
+        self.release.set()
+        self.assertEqual(self.flight.do("key", self._slow_call), 1)
+        self.assertEqual(self.flight.do("key", self._slow_call), 2)
+        self.assertEqual(self.flight.stats()["shared"], 0)
+
+    def test_empty_stats(self):
+        """It should report a zero rate before any calls"""
+        self.assertEqual(self.flight.stats()["coalescing_rate"], 0.0)
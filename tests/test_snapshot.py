@@ -0,0 +1,167 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Snapshot Test Suite
+
+Test cases can be run with the following:
+pytest tests/test_snapshot.py
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+from service.common.snapshot import Snapshot, SnapshotBuilder, write_snapshot
+
+DOCS = {
+    "b": {"_id": "b", "name": "Fido", "category": "dog", "available": True},
+    "a": {"_id": "a", "name": "Kitty", "category": "cat", "available": False},
+    "c": {"_id": "c", "name": "Rex", "category": "dog", "available": False},
+}
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSnapshot(TestCase):
+    """Snapshot tests"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "pets.snapshot")
+        self.snapshot = Snapshot(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_not_ready(self):
+        """It should have nothing to read until the file is written"""
+        self.assertFalse(self.snapshot.ready())
+        self.assertIsNone(self.snapshot.seq)
+        self.assertIsNone(self.snapshot.get("a"))
+        self.assertEqual(self.snapshot.find("category", "dog"), [])
+
+    def test_get(self):
+        """It should look documents up by id"""
+        write_snapshot(self.path, DOCS, "3-x", ("category", "available"))
+        self.assertTrue(self.snapshot.ready())
+        self.assertEqual(self.snapshot.seq, "3-x")
+        for doc_id, doc in DOCS.items():
+            self.assertEqual(self.snapshot.get(doc_id), doc)
+        self.assertIsNone(self.snapshot.get("0"))
+        self.assertIsNone(self.snapshot.get("bb"))
+        self.assertIsNone(self.snapshot.get("z"))
+
+    def test_find(self):
+        """It should look documents up by their indexed fields"""
+        write_snapshot(self.path, DOCS, "3-x", ("category", "available"))
+        self.assertEqual([doc["_id"] for doc in self.snapshot.find("category", "dog")], ["b", "c"])
+        self.assertEqual([doc["_id"] for doc in self.snapshot.find("available", False)], ["a", "c"])
+        self.assertEqual(self.snapshot.find("category", "fish"), [])
+
+    def test_follow_new_file(self):
+        """It should read the new file once it replaces the old one"""
+        write_snapshot(self.path, DOCS, "3-x", ("category",))
+        self.assertIsNotNone(self.snapshot.get("a"))
+        write_snapshot(self.path, {"d": {"_id": "d", "category": "fish"}}, "4-x", ("category",))
+        self.assertEqual(self.snapshot.seq, "4-x")
+        self.assertIsNone(self.snapshot.get("a"))
+        self.assertEqual(len(self.snapshot.find("category", "fish")), 1)
+
+    def test_not_a_snapshot(self):
+        """It should refuse to read a file that isn't a snapshot"""
+        with open(self.path, "wb") as file:
+            file.write(b"\0" * 64)
+        self.assertRaises(ValueError, self.snapshot.ready)
+
+
+class TestSnapshotBuilder(TestCase):
+    """Snapshot Builder tests"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "pets.snapshot")
+        self.feed = []
+        self.generation = "one"
+        self.builder = SnapshotBuilder(self.path, self._read_changes, lambda: self.generation, ("category",), 0.01)
+
+    def tearDown(self):
+        self.builder.stop()
+        shutil.rmtree(self.folder)
+
+    def _read_changes(self, since: str) -> tuple:
+        """Returns the rows of the fake feed after a sequence"""
+        start = int(since)
+        return self.feed[start:], str(len(self.feed))
+
+    def test_refresh(self):
+        """It should apply new changes and skip design documents"""
+        self.feed += [
+            {"id": "a", "doc": DOCS["a"]},
+            {"id": "_design/pets", "doc": {}},
+            {"id": "b", "doc": DOCS["b"]},
+        ]
+        self.assertTrue(self.builder.refresh())
+        self.assertFalse(self.builder.refresh())
+        self.feed.append({"id": "a", "deleted": True})
+        self.assertTrue(self.builder.refresh())
+        snapshot = Snapshot(self.path)
+        self.assertIsNone(snapshot.get("a"))
+        self.assertEqual(snapshot.get("b"), DOCS["b"])
+        self.assertIsNone(snapshot.get("_design/pets"))
+        self.assertEqual(snapshot.seq, "4")
+
+    def test_database_recreated(self):
+        """It should start over when the database is recreated"""
+        self.feed.append({"id": "a", "doc": DOCS["a"]})
+        self.builder.refresh()
+        self.feed = [{"id": "b", "doc": DOCS["b"]}]
+        self.generation = "two"
+        self.assertTrue(self.builder.refresh())
+        snapshot = Snapshot(self.path)
+        self.assertIsNone(snapshot.get("a"))
+        self.assertEqual(snapshot.get("b"), DOCS["b"])
+
+    def test_one_writer(self):
+        """It should let one process at a time write the snapshot"""
+        other = SnapshotBuilder(self.path, self._read_changes, lambda: "one", ("category",))
+        self.assertTrue(self.builder.acquire())
+        self.assertFalse(other.acquire())
+        self.builder.stop()
+        self.assertTrue(other.acquire())
+        other.stop()
+
+    def test_background_refresh(self):
+        """It should write the snapshot on a background thread"""
+        self.feed.append({"id": "c", "doc": DOCS["c"]})
+        self.builder.start()
+        self.builder.start()
+        snapshot = Snapshot(self.path)
+        for _ in range(500):
+            if snapshot.ready():
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(snapshot.get("c"), DOCS["c"])
+        self.assertTrue(self.builder.leader)
+
+    def test_refresh_failure(self):
+        """It should keep running when a refresh fails"""
+        self.builder.read_changes = None
+        self.builder.start()
+        threading.Event().wait(0.05)
+        self.assertEqual(self.builder.refreshes, 0)
@@ -0,0 +1,187 @@
+######################################################################
+# Copyright 2016, 2023 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Write Behind Test Suite
+
+Test cases can be run with the following:
+pytest tests/test_write_behind.py
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+from service.common.write_behind import WriteBehind, DONE, FAILED
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestWriteBehind(TestCase):
+    """Write Behind tests"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.journal = os.path.join(self.folder, "journal")
+        self.batches = []
+        self.errors = {}
+        self.writer = WriteBehind(self.flush, self.journal, max_pending=2, interval=0.01)
+        self.writer.retry_delay = 0.01
+
+    def tearDown(self):
+        self.writer.stop()
+        shutil.rmtree(self.folder)
+
+    def flush(self, changes: dict) -> dict:
+        """Records each batch it is asked to write"""
+        self.batches.append(changes)
+        return self.errors
+
+    def test_changes_are_coalesced(self):
+        """It should write several changes to one key together"""
+        release = threading.Event()
+        self.writer.flush = lambda changes: release.wait() and self.flush(changes)
+        self.writer.submit("fido", {"name": "Fido"})
+        self.writer.submit("fido", {"available": False})
+        self.assertEqual(self.writer.pending("fido"), {"name": "Fido", "available": False})
+        release.set()
+        self.assertTrue(self.writer.drain(5))
+        self.assertEqual(self.batches, [{"fido": {"name": "Fido", "available": False}}])
+        self.assertIsNone(self.writer.pending("fido"))
+
+    def test_changes_being_written(self):
+        """It should count changes as pending until their batch is written"""
+        started, release = threading.Event(), threading.Event()
+        self.writer.flush = lambda changes: started.set() or release.wait() and self.flush(changes)
+        self.writer.submit("fido", {"available": False})
+        self.assertTrue(started.wait(5))
+        self.assertEqual(self.writer.pending("fido"), {"available": False})
+        release.set()
+        self.assertTrue(self.writer.drain(5))
+        self.assertIsNone(self.writer.pending("fido"))
+
+    def test_status(self):
+        """It should report when a change was written or failed"""
+        self.errors = {"rex": "not_found"}
+        fido = self.writer.submit("fido", {"available": False})
+        rex = self.writer.submit("rex", {"available": False})
+        self.writer.drain(5)
+        self.assertEqual(self.writer.status(fido)["status"], DONE)
+        self.assertEqual(self.writer.status(rex), {"status": FAILED, "error": "not_found"})
+        self.assertIsNone(self.writer.status("unknown"))
+        self.assertEqual(self.writer.stats()["written"], 2)
+
+    @patch("service.common.write_behind.MAX_STATUSES", 2)
+    def test_statuses_are_forgotten(self):
+        """It should only remember the status of the last MAX_STATUSES changes"""
+        tickets = [self.writer.submit(key, {}) for key in ("fido", "rex")]
+        self.writer.drain(5)
+        tickets.append(self.writer.submit("tom", {}))
+        self.writer.drain(5)
+        self.assertIsNone(self.writer.status(tickets[0]))
+        self.assertEqual([self.writer.status(ticket)["status"] for ticket in tickets[1:]], [DONE, DONE])
+
+    def test_queue_full(self):
+        """It should turn away new keys when the queue is full"""
+        release = threading.Event()
+        self.writer.flush = lambda changes: release.wait() and self.flush(changes)
+        self.assertIsNotNone(self.writer.submit("a", {}))
+        self.assertIsNotNone(self.writer.submit("b", {}))
+        self.assertIsNone(self.writer.submit("c", {}))
+        self.assertIsNotNone(self.writer.submit("a", {"name": "A"}))
+        self.assertEqual(self.writer.stats()["rejected"], 1)
+        release.set()
+
+    def test_failed_batches_are_retried(self):
+        """It should write a batch again when writing it raises"""
+        failures = [ConnectionError()]
+
+        def flaky(changes):
+            if failures:
+                raise failures.pop()
+            return self.flush(changes)
+
+        self.writer.flush = flaky
+        self.writer.submit("fido", {"available": False})
+        self.assertTrue(self.writer.drain(5))
+        self.assertEqual(self.batches, [{"fido": {"available": False}}])
+
+    def test_journal_is_replayed(self):
+        """It should write changes left in the journal of a process that died"""
+        with open(f"{self.journal}.999999999", "w", encoding="utf-8") as journal:
+            journal.write(json.dumps({"ticket": "1", "key": "fido", "fields": {"name": "Fido"}}) + "\n")
+            journal.write(json.dumps({"ticket": "2", "key": "rex", "fields": {"name": "Rex"}}) + "\n")
+            journal.write(json.dumps({"done": ["1"]}) + "\n")
+            journal.write('{"ticket": "3", "ke')
+        self.writer.submit("tom", {"name": "Tom"})
+        self.writer.drain(5)
+        written = {key for batch in self.batches for key in batch}
+        self.assertEqual(written, {"rex", "tom"})
+        self.assertFalse(os.path.exists(f"{self.journal}.999999999"))
+
+    def test_journal_is_emptied(self):
+        """It should empty the journal once everything in it was written"""
+        self.writer.submit("fido", {"available": False})
+        self.writer.drain(5)
+        self.assertEqual(os.path.getsize(f"{self.journal}.{os.getpid()}"), 0)
+
+    def test_journal_is_compacted(self):
+        """It should rewrite the journal with the changes a batch left waiting"""
+        self.writer.batch_size = 1
+        self.writer.interval = 10
+        self.writer.submit("fido", {"name": "Fido"})
+        self.writer.submit("rex", {"name": "Rex"})
+        self.writer.submit("rex", {"available": False})
+        with self.writer._cond:
+            self.assertTrue(self.writer._write_batch())
+            with open(f"{self.journal}.{os.getpid()}", encoding="utf-8") as journal:
+                records = [json.loads(line) for line in journal]
+        changes = [(record["key"], record["fields"]) for record in records]
+        self.assertEqual(changes, [("rex", {"name": "Rex", "available": False})])
+
+    def test_started_before_first_change(self):
+        """It should replay old journals when it is started"""
+        with open(f"{self.journal}.999999999", "w", encoding="utf-8") as journal:
+            journal.write(json.dumps({"ticket": "1", "key": "fido", "fields": {"name": "Fido"}}) + "\n")
+        self.writer.start()
+        self.assertTrue(self.writer.drain(5))
+        self.assertEqual(self.batches, [{"fido": {"name": "Fido"}}])
+
+    def test_journal_of_live_process(self):
+        """It should leave the journals of running processes alone"""
+        other = f"{self.journal}.1"
+        with open(other, "w", encoding="utf-8") as journal:
+            journal.write(json.dumps({"ticket": "1", "key": "fido", "fields": {}}) + "\n")
+        self.writer.submit("tom", {"name": "Tom"})
+        self.writer.drain(5)
+        self.assertTrue(os.path.exists(other))
+
+    def test_stop_writes_what_is_left(self):
+        """It should write queued changes when it stops"""
+        self.writer.interval = 10
+        self.writer.submit("fido", {"available": False})
+        self.writer.stop()
+        self.assertEqual(self.batches, [{"fido": {"available": False}}])
+
+    def test_drain_times_out(self):
+        """It should stop waiting for changes that can't be written"""
+        self.writer.flush = lambda changes: (_ for _ in ()).throw(ConnectionError())
+        self.writer.submit("fido", {"available": False})
+        self.assertFalse(self.writer.drain(0.1))